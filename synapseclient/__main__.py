@@ -137,8 +137,13 @@ def get(args, syn):
         if args.version is not None or args.id is not None:
             raise ValueError('You cannot specify a version or id when you are downloading a query.')
         ids = _getIdsFromQuery(args.queryString, syn)
-        for id in ids:
-            syn.get(id, downloadLocation=args.downloadLocation)
+        failed = 0
+        for result in syn.getMany(ids, downloadLocation=args.downloadLocation):
+            if result.error is not None:
+                failed += 1
+                syn.logger.error('Unable to get %s: %s' % (result.id, result.error))
+        if failed:
+            raise SynapseError('%d of %d entities could not be downloaded.' % (failed, len(ids)))
     else:
         # search by MD5
         if isinstance(args.id, six.string_types) and os.path.isfile(args.id):
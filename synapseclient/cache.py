@@ -15,19 +15,45 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import collections
+import contextlib
 import datetime
+import errno
 import json
 import operator
 import os
-import re
 import shutil
 import six
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
 from math import floor
-from synapseclient.lock import Lock
+from synapseclient import pool_provider
+from synapseclient.lock import get_lock
+from synapseclient.cache_index import SqliteCacheIndex, INDEX_FILE_NAME
+from synapseclient.dict_object import DictObject
 from synapseclient.exceptions import *
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
 
 CACHE_ROOT_DIR = os.path.join('~', '.synapseCache')
+# ways of keeping track of cached files: a .cacheMap file in each file handle's cache directory, or a single database
+CACHE_MAP_INDEX = 'cachemap'
+SQLITE_INDEX = 'sqlite'
+INDEX_TYPES = [CACHE_MAP_INDEX, SQLITE_INDEX]
+CACHE_MAPS_IMPORTED_KEY = 'cache_maps_imported'
+CACHED_FILES_TRACKED_KEY = 'cached_files_tracked'
+# ioctl request that makes a file share the blocks of another on Linux file systems supporting copy-on-write
+FICLONE = 0x40049409
+# counters kept by each Cache, see Cache.stats
+COUNTERS = ['hits', 'content_hits', 'misses', 'stale_entries', 'bytes_served', 'lock_wait_time', 'map_read_time',
+            'map_write_time']
 
 
 def epoch_time_to_iso(epoch_time):
@@ -69,6 +95,163 @@ def _get_modified_time(path):
     return None
 
 
+def _stat_signature(path):
+    """
+    :returns: a tuple of the size and modification time in nanoseconds of a file, which change when its content does
+    """
+    stat = os.stat(path)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        # Python 2
+        mtime_ns = int(stat.st_mtime * 10**9)
+    return stat.st_size, mtime_ns
+
+
+def _numbered_subdirs(path):
+    """
+    :returns: the paths of the subdirectories of a directory whose names are numbers, like those of the cache
+    """
+    if hasattr(os, 'scandir'):
+        # the type of an entry is usually known from the directory listing itself, saving a stat call per entry
+        return [entry.path for entry in os.scandir(path) if entry.name.isdigit() and entry.is_dir()]
+    return [os.path.join(path, name) for name in os.listdir(path)
+            if name.isdigit() and os.path.isdir(os.path.join(path, name))]
+
+
+def _most_recent_unmodified_file(cache_map):
+    """
+    :returns: a tuple of the most recently cached file of a cache map that has not been modified since, or None, and
+              the number of more recently cached files passed over because they were missing or modified
+    """
+    stale = 0
+    for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
+        if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
+            return cached_file_path, stale
+        stale += 1
+    return None, stale
+
+
+def _reflink(source, destination):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise
+
+
+def _hardlink(source, destination):
+    if not hasattr(os, 'link'):
+        raise OSError(errno.EOPNOTSUPP, "hardlinks are not supported on this platform")
+    os.link(source, destination)
+
+
+def _symlink(source, destination):
+    if not hasattr(os, 'symlink'):
+        raise OSError(errno.EOPNOTSUPP, "symlinks are not supported on this platform")
+    os.symlink(os.path.abspath(source), destination)
+
+
+# ways of making a cached file available at another path, other than copying it
+_LINK_FUNCTIONS = OrderedDict([('reflink', _reflink), ('hardlink', _hardlink), ('symlink', _symlink)])
+MATERIALIZE_METHODS = ['copy'] + list(_LINK_FUNCTIONS)
+
+
+def materialize(source, destination, method='copy'):
+    """
+    Make a file available at another path, replacing any existing file there. Never changes the modification time of
+    the source, on which the validity of its cache entries depends.
+
+    :param method: one of
+
+                   - "copy": an independent copy of the file
+                   - "reflink": a copy-on-write clone, which shares disk blocks with the source until either is changed.
+                     Only supported by some Linux file systems, such as Btrfs and XFS.
+                   - "hardlink": another name for the same file, so that changing one changes the other
+                   - "symlink": a symbolic link to the source
+
+                   Methods other than "copy" fall back to a copy if they aren't possible, for example because the
+                   source and the destination are on different file systems.
+
+    :returns: the method used
+    """
+    return _materialize(source, destination, [method])
+
+
+def clone_file(source, destination, hardlink=False):
+    """
+    Make a copy of a file as cheaply as the file system allows: a copy-on-write reflink where supported, otherwise a
+    hardlink if allowed, otherwise a plain copy. An existing file at the destination is replaced.
+
+    :param hardlink: whether the copy may share its content with the source, so that changing one changes the other
+
+    :returns: the method used, one of "reflink", "hardlink" or "copy"
+    """
+    return _materialize(source, destination, ['reflink', 'hardlink'] if hardlink else ['reflink'])
+
+
+def _materialize(source, destination, methods):
+    for method in methods:
+        if method not in MATERIALIZE_METHODS:
+            raise ValueError('Unknown materialize method "%s", expected one of: %s' %
+                             (method, ", ".join(MATERIALIZE_METHODS)))
+
+    # lexists so that a dangling symlink is replaced as well
+    if os.path.lexists(destination):
+        os.remove(destination)
+    parent = os.path.dirname(destination)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+
+    for method in methods:
+        if method in _LINK_FUNCTIONS:
+            try:
+                _LINK_FUNCTIONS[method](source, destination)
+                return method
+            except (IOError, OSError):
+                # e.g. the files are on different file systems
+                pass
+    shutil.copy(source, destination)
+    return 'copy'
+
+
+class ReadOnlyCacheTier(object):
+    """
+    A cache root that is looked in but never written to or locked, such as a cache on a parallel file system shared by
+    many machines. Its contents must not change while it is in use.
+
+    Its index is used if it has one and the Python version can open it read-only, otherwise its .cacheMap files.
+
+    :param cache_root_dir:  the root directory of the cache
+    :param fanout:          the number of subdirectories of the root over which file handles are spread
+    """
+
+    def __init__(self, cache_root_dir, fanout=1000):
+        self.cache_root_dir = os.path.expandvars(os.path.expanduser(cache_root_dir))
+        self.fanout = fanout
+        self.cache_map_file_name = ".cacheMap"
+        self.index = None
+        if os.path.exists(os.path.join(self.cache_root_dir, INDEX_FILE_NAME)):
+            try:
+                self.index = SqliteCacheIndex(self.cache_root_dir, read_only=True)
+            except (NotImplementedError, sqlite3.Error):
+                pass
+
+    def get_cache_map(self, file_handle_id):
+        if self.index is not None:
+            return self.index.get_cache_map(file_handle_id)
+        cache_map_file = os.path.join(self.cache_root_dir, str(int(file_handle_id) % self.fanout),
+                                      str(file_handle_id), self.cache_map_file_name)
+        try:
+            with open(cache_map_file, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+
 class Cache:
     """
     Represent a cache in which files are accessed by file handle ID.
@@ -83,14 +266,57 @@ class Cache:
                 os.makedirs(value)
         self.__dict__[key] = value
 
-    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000):
+    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000, index=None, max_size=None, metrics_callback=None,
+                 read_only_roots=None, promote=False):
+        """
+        :param cache_root_dir:  the directory under which files and their meta data are stored
+        :param fanout:          the number of subdirectories of the root over which file handles are spread
+        :param index:           how cached copies are tracked, either "cachemap" for a .cacheMap JSON file in each
+                                file handle's cache directory, or "sqlite" for a single database under the cache root.
+                                Existing .cacheMap files are imported the first time the "sqlite" index is used.
+                                Defaults to "sqlite" if a max_size is given and "cachemap" otherwise.
+        :param max_size:        the most bytes that files stored under the cache root may take up, as a number or a
+                                string such as "100GB". Least recently used files are evicted once it is exceeded,
+                                counting the accesses recorded by the "sqlite" index before it was set. Requires the
+                                "sqlite" index.
+        :param metrics_callback: an optional function called with the name and the increment of a counter each time
+                                 one of the counters reported by :py:func:`Cache.stats` changes, e.g. to export them
+                                 to a monitoring system. It is called from whichever thread uses the cache and
+                                 should return quickly without raising.
+        :param read_only_roots: an ordered list of the root directories of other caches to look in when a file isn't
+                                in this one, see :py:class:`ReadOnlyCacheTier`. They must use the same fanout.
+        :param promote:         whether to copy files found in the read_only_roots into this cache, so that later
+                                lookups find them on local storage
+        """
         # set root dir of cache in which meta data will be stored and files
         # will be stored here by default, but other locations can be specified
         self.cache_root_dir = cache_root_dir
         self.fanout = fanout
         self.cache_map_file_name = ".cacheMap"
+        self.max_size = None if max_size is None else utils.parse_size(max_size)
+        # MD5s of local files when there is no index to keep them in, see md5_for_file
+        self._fingerprints = {}
+        self.metrics_callback = metrics_callback
+        self.read_only_tiers = [ReadOnlyCacheTier(root, fanout) for root in read_only_roots or []]
+        self.promote = promote
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._counters_lock = threading.Lock()
 
-    def get_cache_dir(self, file_handle_id):
+        if index is None:
+            index = CACHE_MAP_INDEX if self.max_size is None else SQLITE_INDEX
+        if index not in INDEX_TYPES:
+            raise ValueError('Unknown cache index "%s", expected one of: %s' % (index, ", ".join(INDEX_TYPES)))
+        if self.max_size is not None and index != SQLITE_INDEX:
+            raise ValueError('A cache max_size requires the "%s" index' % SQLITE_INDEX)
+        self.index = None
+        if index == SQLITE_INDEX:
+            self.index = SqliteCacheIndex(self.cache_root_dir)
+            if self.index.get_metadata(CACHE_MAPS_IMPORTED_KEY) is None:
+                self.import_cache_maps()
+            if self.index.get_metadata(CACHED_FILES_TRACKED_KEY) is None:
+                self._track_cached_files()
+
+    def _get_file_handle_id(self, file_handle_id):
         if isinstance(file_handle_id, collections.Mapping):
             if 'dataFileHandleId' in file_handle_id:
                 file_handle_id = file_handle_id['dataFileHandleId']
@@ -98,28 +324,154 @@ class Cache:
                     and 'id' in file_handle_id \
                     and file_handle_id['concreteType'].startswith('org.sagebionetworks.repo.model.file'):
                 file_handle_id = file_handle_id['id']
+        return file_handle_id
+
+    def get_cache_dir(self, file_handle_id):
+        file_handle_id = self._get_file_handle_id(file_handle_id)
         return os.path.join(self.cache_root_dir, str(int(file_handle_id) % self.fanout), str(file_handle_id))
 
+    def in_cache_root(self, path):
+        """
+        :param path: a normalized path, see :py:func:`synapseclient.utils.normalize_path`
+
+        :returns: True if the path is under the cache root directory
+        """
+        return path.startswith(utils.normalize_path(self.cache_root_dir) + '/')
+
+    def _cached_file_size(self, path):
+        """
+        :returns: the size of the file if it is stored under the cache root and so counts towards the max_size,
+                  otherwise None
+        """
+        return os.path.getsize(path) if self.in_cache_root(path) else None
+
+    def _record(self, counter, value=1):
+        with self._counters_lock:
+            self._counters[counter] += value
+        if self.metrics_callback is not None:
+            self.metrics_callback(counter, value)
+
+    @contextlib.contextmanager
+    def _timed(self, counter):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._record(counter, time.time() - start)
+
+    @contextlib.contextmanager
+    def _cache_map_lock(self, cache_dir, shared=False):
+        start = time.time()
+        with get_lock(self.cache_map_file_name, dir=cache_dir, shared=shared):
+            self._record('lock_wait_time', time.time() - start)
+            yield
+
+    def _record_lookup(self, path, stale, hit_counter='hits'):
+        if stale:
+            self._record('stale_entries', stale)
+        if path is None:
+            self._record('misses')
+            return
+        self._record(hit_counter)
+        try:
+            self._record('bytes_served', os.path.getsize(path))
+        except OSError:
+            pass
+
     def _read_cache_map(self, cache_dir):
         cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
 
         if not os.path.exists(cache_map_file):
             return {}
 
-        with open(cache_map_file, 'r') as f:
+        with self._timed('map_read_time'), open(cache_map_file, 'r') as f:
             cache_map = json.load(f)
         return cache_map
 
+    def _read_cache_map_shared(self, cache_dir):
+        try:
+            with self._cache_map_lock(cache_dir, shared=True):
+                return self._read_cache_map(cache_dir)
+        except ValueError:
+            # a shared lock doesn't exclude clients that only lock the cache with a directory, so one of them may have
+            # been writing the file while it was read. Read it again while excluding them
+            with self._cache_map_lock(cache_dir):
+                return self._read_cache_map(cache_dir)
+
     def _write_cache_map(self, cache_dir, cache_map):
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
         cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
 
-        with open(cache_map_file, 'w') as f:
+        with self._timed('map_write_time'), open(cache_map_file, 'w') as f:
             json.dump(cache_map, f)
             f.write('\n')  # For compatibility with R's JSON parser
 
+    def _get_cache_map(self, file_handle_id):
+        """
+        :returns: a dictionary from the path of each cached copy of the file to the time it was cached
+        """
+        if self.index is not None:
+            with self._timed('map_read_time'):
+                return self.index.get_cache_map(self._get_file_handle_id(file_handle_id))
+
+        cache_dir = self.get_cache_dir(file_handle_id)
+        if not os.path.exists(cache_dir):
+            return {}
+        return self._read_cache_map_shared(cache_dir)
+
+    def _add_cache_map_entry(self, file_handle_id, path, cached_time, md5=None):
+        if self.index is not None:
+            size = self._cached_file_size(path)
+            with self._timed('map_write_time'):
+                return self.index.add(self._get_file_handle_id(file_handle_id), path, cached_time, size, md5)
+
+        cache_dir = self.get_cache_dir(file_handle_id)
+        with self._cache_map_lock(cache_dir):
+            cache_map = self._read_cache_map(cache_dir)
+            cache_map[path] = cached_time
+            self._write_cache_map(cache_dir, cache_map)
+        return cache_map
+
+    def _remove_cache_map_entries(self, file_handle_id, path=None):
+        if self.index is not None:
+            with self._timed('map_write_time'):
+                return self.index.remove(self._get_file_handle_id(file_handle_id), path)
+
+        removed = []
+        cache_dir = self.get_cache_dir(file_handle_id)
+        with self._cache_map_lock(cache_dir):
+            cache_map = self._read_cache_map(cache_dir)
+            if path is None:
+                removed = list(cache_map)
+                cache_map = {}
+            elif path in cache_map:
+                del cache_map[path]
+                removed.append(path)
+            self._write_cache_map(cache_dir, cache_map)
+        return removed
+
+    def _discard_cache_map_entries(self, file_handle_id, invalid_entries):
+        """
+        Remove entries pointing to files that no longer exist or have been modified, unless they were replaced after
+        being read.
+
+        :param invalid_entries: a dictionary from path to the cached time that was read
+        """
+        if self.index is not None:
+            with self._timed('map_write_time'):
+                self.index.discard(self._get_file_handle_id(file_handle_id), invalid_entries)
+            return
+
+        cache_dir = self.get_cache_dir(file_handle_id)
+        with self._cache_map_lock(cache_dir):
+            cache_map = self._read_cache_map(cache_dir)
+            for path, cached_time in six.iteritems(invalid_entries):
+                if cache_map.get(path) == cached_time:
+                    del cache_map[path]
+            self._write_cache_map(cache_dir, cache_map)
+
     def contains(self, file_handle_id, path):
         """
         Given a file and file_handle_id, return True if an unmodified cached
@@ -127,18 +479,13 @@ class Cache:
         :param file_handle_id:
         :param path: file path at which to look for a cached copy
         """
-        cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
-            return False
+        cache_map = self._get_cache_map(file_handle_id)
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
-
-            path = utils.normalize_path(path)
+        path = utils.normalize_path(path)
 
-            cached_time = cache_map.get(path, None)
-            if cached_time:
-                return compare_timestamps(_get_modified_time(path), cached_time)
+        cached_time = cache_map.get(path, None)
+        if cached_time:
+            return compare_timestamps(_get_modified_time(path), cached_time)
         return False
 
     def get(self, file_handle_id, path=None):
@@ -155,77 +502,254 @@ class Cache:
         :returns: Either a file path, if an unmodified cached copy of the file
                   exists in the specified location or None if it does not
         """
-        cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
+        found, stale = self._find(file_handle_id, path)
+        if found is None and (path is None or os.path.isdir(path)):
+            found = self._find_in_read_only_tiers(file_handle_id)
+        self._record_lookup(found, stale)
+        return self._accessed(found)
+
+    def _find_in_read_only_tiers(self, file_handle_id):
+        """
+        :returns: the path of an unmodified cached copy of the file in the first read-only tier that has one, or of
+                  its promoted copy, or None
+        """
+        file_handle_id = self._get_file_handle_id(file_handle_id)
+        for tier in self.read_only_tiers:
+            found, _ = _most_recent_unmodified_file(tier.get_cache_map(file_handle_id))
+            if found is not None:
+                if self.promote:
+                    promoted = os.path.join(self.get_cache_dir(file_handle_id), os.path.basename(found))
+                    clone_file(found, promoted)
+                    self.add(file_handle_id, promoted)
+                    return utils.normalize_path(promoted)
+                return utils.normalize_path(found)
+        return None
+
+    def _find(self, file_handle_id, path):
+        """
+        :returns: a tuple of the path found by :py:func:`Cache.get` or None and the number of stale entries seen
+        """
+        cache_map = self._get_cache_map(file_handle_id)
+
+        path = utils.normalize_path(path)
+
+        # If the caller specifies a path and that path exists in the cache
+        # but has been modified, we need to indicate no match by returning
+        # None. The logic for updating a synapse entity depends on this to
+        # determine the need to upload a new file.
+
+        if path is not None:
+            # If we're given a path to a directory, look for a cached file in that directory
+            if os.path.isdir(path):
+                matching_unmodified_directory = None
+                invalid_entries = {}  # entries to be removed from the cache map
+
+                for cached_file_path, cached_time in six.iteritems(cache_map):
+                    if path == os.path.dirname(cached_file_path):
+                        # compare_timestamps has an implicit check for whether the path exists
+                        if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
+                            # "break" instead of "return" to remove invalid entries from the cache if necessary
+                            matching_unmodified_directory = cached_file_path
+                            break
+                        else:
+                            # remove invalid cache entries pointing to files that that no longer exist
+                            # or have been modified
+                            invalid_entries[cached_file_path] = cached_time
+
+                if invalid_entries:
+                    self._discard_cache_map_entries(file_handle_id, invalid_entries)
+
+                if matching_unmodified_directory is not None:
+                    return matching_unmodified_directory, len(invalid_entries)
+
+                found, stale = _most_recent_unmodified_file(cache_map)
+                return found, stale + len(invalid_entries)
+
+            # if we're given a full file path, look up a matching file in the cache
+            else:
+                cached_time = cache_map.get(path, None)
+                if cached_time:
+                    if compare_timestamps(_get_modified_time(path), cached_time):
+                        return path, 0
+                    return None, 1
+
+        # return most recently cached and unmodified file OR
+        # None if there are no unmodified files
+        return _most_recent_unmodified_file(cache_map)
+
+    def _accessed(self, path):
+        # access times are kept whenever there is an index to keep them in, so that they count towards choosing what to
+        # evict also if a max_size is only set later
+        if path is not None and self.index is not None:
+            self.index.touch([path])
+        return path
+
+    def get_many(self, file_handle_ids):
+        """
+        Look up cached copies of many files at once. Equivalent to calling :py:func:`Cache.get` without a path for each
+        file handle, but with the cache maps read in bulk and the file system checks spread over a thread pool.
+
+        :param file_handle_ids: an iterable of file handle IDs
+
+        :returns: a dictionary from file handle ID, as given, to the path of an unmodified cached copy of the file, for
+                  those file handles that have one
+        """
+        file_handle_ids = list(OrderedDict.fromkeys(file_handle_ids))
+        if not file_handle_ids:
+            return {}
+
+        pool = pool_provider.get_pool()
+        try:
+            if self.index is not None:
+                with self._timed('map_read_time'):
+                    cache_maps = self.index.get_cache_maps(file_handle_ids)
+
+                def find(file_handle_id):
+                    path, stale = _most_recent_unmodified_file(cache_maps.get(int(file_handle_id), {}))
+                    if path is None:
+                        path = self._find_in_read_only_tiers(file_handle_id)
+                    return path, stale
+
+                paths = []
+                for path, stale in pool.map(find, file_handle_ids):
+                    self._record_lookup(path, stale)
+                    paths.append(path)
+            else:
+                paths = pool.map(self.get, file_handle_ids)
+        finally:
+            pool.terminate()
+        found = {file_handle_id: path for file_handle_id, path in zip(file_handle_ids, paths) if path is not None}
+        if self.index is not None:
+            self.index.touch(set(found.values()))
+        return found
+
+    def get_by_md5(self, md5):
+        """
+        Look for a cached copy of any file handle with the given content. Requires the "sqlite" index.
+
+        :param md5: the MD5 hex digest of the content, as in the file handle's contentMd5
+
+        :returns: the path of the most recently cached, unmodified file with that MD5 or None
+        """
+        if self.index is None or not md5:
             return None
+        with self._timed('map_read_time'):
+            cache_map = self.index.get_cache_map_by_md5(md5)
+        found, stale = _most_recent_unmodified_file(cache_map)
+        if found is not None:
+            self._record_lookup(found, stale, hit_counter='content_hits')
+        elif stale:
+            # misses aren't counted here, the lookup by file handle that comes first already counted one
+            self._record('stale_entries', stale)
+        return self._accessed(found)
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+    def _get_fingerprint(self, path):
+        if self.index is not None:
+            return self.index.get_fingerprint(path)
+        return self._fingerprints.get(path)
 
-            path = utils.normalize_path(path)
+    def _set_fingerprint(self, path, signature, md5):
+        size, mtime_ns = signature
+        if self.index is not None:
+            self.index.set_fingerprint(path, size, mtime_ns, md5)
+        else:
+            self._fingerprints[path] = (size, mtime_ns, md5)
 
-            # If the caller specifies a path and that path exists in the cache
-            # but has been modified, we need to indicate no match by returning
-            # None. The logic for updating a synapse entity depends on this to
-            # determine the need to upload a new file.
-
-            if path is not None:
-                # If we're given a path to a directory, look for a cached file in that directory
-                if os.path.isdir(path):
-                    matching_unmodified_directory = None
-                    removed_entry_from_cache = False  # determines if cache_map needs to be rewritten to disk
-
-                    # iterate a copy of cache_map to allow modifying original cache_map
-                    for cached_file_path, cached_time in six.iteritems(dict(cache_map)):
-                        if path == os.path.dirname(cached_file_path):
-                            # compare_timestamps has an implicit check for whether the path exists
-                            if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                                # "break" instead of "return" to write removed invalid entries to disk if necessary
-                                matching_unmodified_directory = cached_file_path
-                                break
-                            else:
-                                # remove invalid cache entries pointing to files that that no longer exist
-                                # or have been modified
-                                del cache_map[cached_file_path]
-                                removed_entry_from_cache = True
-                                
-                    if removed_entry_from_cache:
-                        # write cache_map with non-existent entries removed
-                        self._write_cache_map(cache_dir, cache_map)
-
-                    if matching_unmodified_directory is not None:
-                        return matching_unmodified_directory
-
-                # if we're given a full file path, look up a matching file in the cache
-                else:
-                    cached_time = cache_map.get(path, None)
-                    if cached_time:
-                        return path if compare_timestamps(_get_modified_time(path), cached_time) else None
-
-            # return most recently cached and unmodified file OR
-            # None if there are no unmodified files
-            for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
-                if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                    return cached_file_path
+    def get_md5(self, path):
+        """
+        Look up the MD5 of a local file as recorded by :py:func:`Cache.md5_for_file` or when the file was cached, without
+        reading the file. The "sqlite" index keeps MD5s across sessions, otherwise they are only kept in memory.
+
+        :returns: the MD5 hex digest, or None if none was recorded or the size or modification time of the file has
+                  changed since
+        """
+        path = utils.normalize_path(path)
+        try:
+            signature = _stat_signature(path)
+        except OSError:
             return None
+        fingerprint = self._get_fingerprint(path)
+        if fingerprint is not None and tuple(fingerprint[:2]) == signature:
+            return fingerprint[2]
+        return None
+
+    def md5_for_file(self, path, hash_file=None):
+        """
+        Calculate the MD5 of a local file, unless it is known from an earlier call or from caching the file and the
+        size and modification time of the file are unchanged since.
+
+        :param hash_file: (optional) a function that reads the file at the path it is given and returns its MD5 hex
+                          digest, e.g. to compute other digests in the same pass. Defaults to
+                          :py:func:`synapseclient.utils.md5_for_file`.
+
+        :returns: the MD5 hex digest
+        """
+        md5 = self.get_md5(path)
+        if md5 is None:
+            path = utils.normalize_path(path)
+            signature = _stat_signature(path)
+            md5 = utils.md5_for_file(path).hexdigest() if hash_file is None else hash_file(path)
+            # don't keep an MD5 that may be of neither version of a file that changed while it was read
+            if _stat_signature(path) == signature:
+                self._set_fingerprint(path, signature, md5)
+        return md5
 
-    def add(self, file_handle_id, path):
+    def add(self, file_handle_id, path, md5=None):
         """
         Add a file to the cache
+
+        :param md5: the MD5 of the file handle's content, which lets :py:func:`Cache.get_by_md5` find the file for other
+                    file handles with the same content. Only kept by the "sqlite" index. It is also recorded as the MD5
+                    of the file, see :py:func:`Cache.get_md5`.
         """
         if not path or not os.path.exists(path):
             raise ValueError("Can't find file \"%s\"" % path)
 
-        cache_dir = self.get_cache_dir(file_handle_id)
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+        path = utils.normalize_path(path)
+        if md5 is not None:
+            self._set_fingerprint(path, _stat_signature(path), md5)
+        # write .000 milliseconds for backward compatibility
+        cache_map = self._add_cache_map_entry(file_handle_id, path, epoch_time_to_iso(floor(_get_modified_time(path))),
+                                              md5)
+        self._evict(keep=[path])
+        return cache_map
 
-            path = utils.normalize_path(path)
-            # write .000 milliseconds for backward compatibility
-            cache_map[path] = epoch_time_to_iso(floor(_get_modified_time(path)))
-            self._write_cache_map(cache_dir, cache_map)
+    def add_many(self, file_handle_ids_and_paths):
+        """
+        Add many files to the cache at once, spreading the file system work over a thread pool.
 
-        return cache_map
+        :param file_handle_ids_and_paths: an iterable of (file_handle_id, path) tuples
+        """
+        entries_by_file_handle = OrderedDict()
+        for file_handle_id, path in file_handle_ids_and_paths:
+            if not path or not os.path.exists(path):
+                raise ValueError("Can't find file \"%s\"" % path)
+            entries_by_file_handle.setdefault(self._get_file_handle_id(file_handle_id), []) \
+                .append(utils.normalize_path(path))
+
+        def add_entries(item):
+            file_handle_id, paths = item
+            entries = [(file_handle_id, path, epoch_time_to_iso(floor(_get_modified_time(path))),
+                        self._cached_file_size(path)) for path in paths]
+            if self.index is None:
+                # one read and write of the .cacheMap per file handle
+                cache_dir = self.get_cache_dir(file_handle_id)
+                with self._cache_map_lock(cache_dir):
+                    cache_map = self._read_cache_map(cache_dir)
+                    cache_map.update((path, cached_time) for _, path, cached_time, _ in entries)
+                    self._write_cache_map(cache_dir, cache_map)
+            return entries
+
+        pool = pool_provider.get_pool()
+        try:
+            entries = pool.map(add_entries, list(entries_by_file_handle.items()))
+        finally:
+            pool.terminate()
+
+        if self.index is not None:
+            with self._timed('map_write_time'):
+                self.index.add_many(entry for file_handle_entries in entries for entry in file_handle_entries)
+            self._evict(keep=[path for paths in entries_by_file_handle.values() for path in paths])
 
     def remove(self, file_handle_id, path=None, delete=None):
         """
@@ -238,67 +762,264 @@ class Cache:
 
         :returns: A list of files removed
         """
-        removed = []
-        cache_dir = self.get_cache_dir(file_handle_id)
-
         # if we've passed an entity and not a path, get path from entity
         if path is None and isinstance(file_handle_id, collections.Mapping) and 'path' in file_handle_id:
             path = file_handle_id['path']
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+        removed = self._remove_cache_map_entries(file_handle_id, utils.normalize_path(path))
+        if delete is True:
+            for removed_path in removed:
+                if os.path.exists(removed_path):
+                    os.remove(removed_path)
+        return removed
 
-            if path is None:
-                for path in cache_map:
-                    if delete is True and os.path.exists(path):
-                        os.remove(path)
-                    removed.append(path)
-                cache_map = {}
-            else:
-                path = utils.normalize_path(path)
-                if path in cache_map:
-                    if delete is True and os.path.exists(path):
-                        os.remove(path)
-                    del cache_map[path]
-                    removed.append(path)
+    def _evict(self, keep=()):
+        """
+        Delete the least recently used files stored under the cache root until their total size is within the
+        max_size, looking only at the index.
 
-            self._write_cache_map(cache_dir, cache_map)
+        :param keep: paths not to be evicted, such as those of files just added
 
-        return removed
+        :returns: the list of paths evicted
+        """
+        if self.max_size is None:
+            return []
+        _, total_size = self.index.usage()
+        keep = set(keep)
+        evicted = []
+        skipped = 0
+        while total_size > self.max_size:
+            candidates = self.index.least_recently_used(offset=skipped)
+            if not candidates:
+                break
+            for path, size in candidates:
+                if path in keep:
+                    skipped += 1
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        # leave files we can't delete in place and carry on with the next one
+                        skipped += 1
+                        continue
+                self.index.evict(path)
+                evicted.append(path)
+                total_size -= size
+                if total_size <= self.max_size:
+                    break
+        return evicted
+
+    def _track_cached_files(self):
+        """
+        Record the sizes of files stored under the cache root that are in the index but not yet counted towards the
+        max_size, as is the case for entries indexed by an earlier version of the client.
+        """
+        sizes = []
+        for path in self.index.untracked_paths():
+            if self.in_cache_root(path) and os.path.isfile(path):
+                sizes.append((path, os.path.getsize(path)))
+        self.index.track_files(sizes)
+        self.index.set_metadata(CACHED_FILES_TRACKED_KEY, epoch_time_to_iso(time.time()))
+
+    def stats(self):
+        """
+        Report the current usage of the cache.
+
+        :returns: a dictionary with the cache_root_dir, the index type, the max_size in bytes (or None) and, with the
+                  "sqlite" index, the file_count and size in bytes of the files stored under the cache root. These
+                  last two are None with the "cachemap" index, which would have to walk the whole cache to find them.
+
+                  It also holds the counters kept since this Cache was created:
+
+                  - hits: lookups by file handle that found an unmodified cached copy
+                  - content_hits: lookups by MD5 that found a copy cached for another file handle
+                  - misses: lookups by file handle that found nothing
+                  - stale_entries: entries found pointing to files that are missing or were modified
+                  - bytes_served: the total size of the files found by hits and content hits
+                  - lock_wait_time: seconds spent waiting for .cacheMap locks
+                  - map_read_time, map_write_time: seconds spent reading and writing .cacheMap files or the index
+        """
+        file_count, size = self.index.usage() if self.index is not None else (None, None)
+        stats = {'cache_root_dir': self.cache_root_dir,
+                 'index': CACHE_MAP_INDEX if self.index is None else SQLITE_INDEX,
+                 'max_size': self.max_size,
+                 'file_count': file_count,
+                 'size': size}
+        with self._counters_lock:
+            stats.update(self._counters)
+        return stats
 
     def _cache_dirs(self):
         """
         Generate a list of all cache dirs, directories of the form:
         [cache.cache_root_dir]/949/59949
+
+        The fanout directories are listed across a thread pool.
         """
-        for item1 in os.listdir(self.cache_root_dir):
-            path1 = os.path.join(self.cache_root_dir, item1)
-            if os.path.isdir(path1) and re.match('\d+', item1):
-                for item2 in os.listdir(path1):
-                    path2 = os.path.join(path1, item2)
-                    if os.path.isdir(path2) and re.match('\d+', item2):
-                        yield path2
+        pool = pool_provider.get_pool()
+        try:
+            for cache_dirs in pool.imap_unordered(_numbered_subdirs, _numbered_subdirs(self.cache_root_dir)):
+                for cache_dir in cache_dirs:
+                    yield cache_dir
+        finally:
+            pool.terminate()
 
-    def purge(self, before_date, dry_run=False):
+    def purge(self, before_date, dry_run=False, progress=None):
         """
         Purge the cache. Use with caution. Delete files whose cache maps were last updated prior to the given date.
 
         Deletes .cacheMap files and files stored in the cache.cache_root_dir, but does not delete files stored outside
-        the cache.
+        the cache. Cache directories are checked and deleted across a thread pool. The entries of uploads that were last
+        recorded before the date are deleted as well, see :py:mod:`synapseclient.upload_journal`.
+
+        :param before_date: a datetime or seconds since the unix epoch
+        :param dry_run:     if True, only report the cache directories that would be deleted
+        :param progress:    an optional function called with the results so far after each cache directory is checked
+
+        :returns: a dictionary with the keys
+
+                  - dry_run: as given
+                  - scanned: the number of cache directories checked
+                  - purged: a list of the cache directories deleted, or that would be deleted in a dry run
+                  - errors: a list of dictionaries with the path and the error of cache directories that couldn't be
+                    checked or deleted
+                  - purged_journals: a list of the upload journal entries deleted, or that would be deleted in a dry
+                    run
         """
+        # imported here because the journal uses the cache's file signatures
+        from synapseclient import upload_journal
+
         if isinstance(before_date, datetime.datetime):
             before_date = utils.to_unix_epoch_time_secs(before_date)
-        count = 0
-        for cache_dir in self._cache_dirs():
-            # _get_modified_time returns None if the cache map file doesn't
-            # exist and n > None evaluates to True in python 2.7(wtf?). I'm guessing it's
-            # OK to purge directories in the cache that have no .cacheMap file
-            last_modified_time = _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
-            if last_modified_time is None or before_date > last_modified_time:
-                if dry_run:
-                    print(cache_dir)
+
+        def purge_cache_dir(cache_dir):
+            try:
+                if self.index is not None:
+                    last_modified_time = self.index.last_updated(os.path.basename(cache_dir))
                 else:
+                    last_modified_time = _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
+                # it's OK to purge directories in the cache that have no .cacheMap file
+                if last_modified_time is not None and before_date <= last_modified_time:
+                    return cache_dir, False, None
+                if not dry_run:
                     shutil.rmtree(cache_dir)
-                count += 1
+                    if self.index is not None:
+                        self.index.remove(os.path.basename(cache_dir))
+                return cache_dir, True, None
+            except (IOError, OSError) as ex:
+                return cache_dir, False, str(ex)
+
+        results = DictObject(dry_run=dry_run, scanned=0, purged=[], errors=[],
+                             purged_journals=upload_journal.prune(self.cache_root_dir, before_date, dry_run))
+        pool = pool_provider.get_pool()
+        try:
+            for cache_dir, purged, error in pool.imap_unordered(purge_cache_dir, self._cache_dirs()):
+                results.scanned += 1
+                if purged:
+                    results.purged.append(cache_dir)
+                if error is not None:
+                    results.errors.append(DictObject(path=cache_dir, error=error))
+                if progress is not None:
+                    progress(results)
+        finally:
+            pool.terminate()
+        return results
+
+    def verify(self, check_md5=False, dry_run=False, progress=None):
+        """
+        Check that the cached copies of files still exist and are unmodified since they were cached, and remove the
+        entries of those that aren't from the cache. Cache maps are read and checked across a thread pool.
+
+        :param check_md5:   if True, also read each unmodified file and compare its MD5 to the content MD5 of its file
+                            handle. Requires the "sqlite" index, which records the content MD5s of downloaded files.
+        :param dry_run:     if True, only report invalid entries without removing them
+        :param progress:    an optional function called with the results so far after each file handle is checked
+
+        :returns: a dictionary with the keys
+
+                  - dry_run: as given
+                  - scanned: the number of cached copies checked
+                  - valid: the number of those that are valid
+                  - invalid: a list of dictionaries with the file_handle_id, path and reason of invalid entries, the
+                    reason being one of "missing", "modified" or "md5_mismatch"
+                  - errors: a list of dictionaries with the path and the error of cache directories or files that
+                    couldn't be checked
+        """
+        def verify_cache_map(item):
+            file_handle_id, cache_map, md5, cache_dir = item
+            invalid = []
+            errors = []
+            try:
+                if cache_map is None:
+                    cache_map = self._read_cache_map_shared(cache_dir)
+            except (IOError, OSError, ValueError) as ex:
+                return 0, invalid, [DictObject(path=cache_dir, error=str(ex))]
+
+            invalid_entries = {}
+            for path, cached_time in six.iteritems(cache_map):
+                modified_time = _get_modified_time(path)
+                reason = None
+                if modified_time is None:
+                    reason = 'missing'
+                elif not compare_timestamps(modified_time, cached_time):
+                    reason = 'modified'
+                elif check_md5 and md5 is not None:
+                    try:
+                        if utils.md5_for_file(path).hexdigest() != md5:
+                            reason = 'md5_mismatch'
+                    except (IOError, OSError) as ex:
+                        errors.append(DictObject(path=path, error=str(ex)))
+                        continue
+                if reason is not None:
+                    invalid.append(DictObject(file_handle_id=file_handle_id, path=path, reason=reason))
+                    invalid_entries[path] = cached_time
+            if invalid_entries and not dry_run:
+                self._discard_cache_map_entries(file_handle_id, invalid_entries)
+            return len(cache_map), invalid, errors
+
+        if self.index is not None:
+            items = ((file_handle_id, cache_map, md5, None)
+                     for file_handle_id, cache_map, md5 in self.index.iter_cache_maps())
+        else:
+            items = ((os.path.basename(cache_dir), None, None, cache_dir) for cache_dir in self._cache_dirs()
+                     if os.path.exists(os.path.join(cache_dir, self.cache_map_file_name)))
+
+        results = DictObject(dry_run=dry_run, scanned=0, valid=0, invalid=[], errors=[])
+        pool = pool_provider.get_pool()
+        try:
+            for scanned, invalid, errors in pool.imap_unordered(verify_cache_map, items):
+                results.scanned += scanned
+                results.valid += scanned - len(invalid)
+                results.invalid.extend(invalid)
+                results.errors.extend(errors)
+                if progress is not None:
+                    progress(results)
+        finally:
+            pool.terminate()
+        return results
+
+    def import_cache_maps(self):
+        """
+        Load the .cacheMap files of all cache directories into the index. Entries already in the index are kept.
+
+        :returns: the number of .cacheMap files imported
+        """
+        if self.index is None:
+            raise SynapseFileCacheError("The cache at %s has no index to import into." % self.cache_root_dir)
+        cache_maps = []
+        for cache_dir in self._cache_dirs():
+            last_modified_time = _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
+            if last_modified_time is None:
+                continue
+            try:
+                cache_map = self._read_cache_map_shared(cache_dir)
+            except ValueError:
+                # skip .cacheMap files that were left unparseable
+                continue
+            cache_maps.append((os.path.basename(cache_dir), cache_map, last_modified_time))
+        count = self.index.import_cache_maps(cache_maps)
+        self.index.set_metadata(CACHE_MAPS_IMPORTED_KEY, epoch_time_to_iso(time.time()))
+        self._track_cached_files()
         return count
 
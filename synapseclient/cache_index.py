@@ -0,0 +1,383 @@
+# Note: Even though this has Sphinx format, this is not meant to be part of the public docs
+
+"""
+***********
+Cache Index
+***********
+
+An optional index for the file cache, kept in a single `SQLite <https://www.sqlite.org/>`_ database under the cache
+root directory. It holds the same information as the per-directory .cacheMap files, which lets
+:py:class:`synapseclient.cache.Cache` look up a file handle with one indexed query instead of taking a lock and parsing
+a JSON file.
+
+The database runs in `write-ahead logging <https://www.sqlite.org/wal.html>`_ mode so that any number of readers may
+proceed while one process writes. Each thread (and each forked process) gets its own connection. Note that WAL mode
+relies on shared memory and is not safe for a cache root on a network file system shared between machines.
+
+This is part of the internal implementation of the client and should not be accessed directly by users of the client.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import itertools
+import operator
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+INDEX_FILE_NAME = '.cacheIndex.sqlite'
+# seconds that a connection waits on a database locked by another writer before giving up
+DEFAULT_BUSY_TIMEOUT = 70
+# SQLite limits the number of host parameters in a single statement to 999 by default
+MAX_QUERY_PARAMETERS = 900
+
+# Each item upgrades the schema by one version. The version of an existing database is kept in PRAGMA user_version.
+SCHEMA_UPGRADES = [
+    [
+        """CREATE TABLE cache_map (
+               file_handle_id INTEGER NOT NULL,
+               path TEXT NOT NULL,
+               cached_time TEXT NOT NULL,
+               updated REAL NOT NULL,
+               PRIMARY KEY (file_handle_id, path))""",
+        """CREATE TABLE metadata (
+               key TEXT PRIMARY KEY,
+               value TEXT)""",
+    ],
+    [
+        # files stored under the cache root, with their sizes and the times they were last handed out by the cache
+        """CREATE TABLE cached_file (
+               path TEXT PRIMARY KEY,
+               size INTEGER NOT NULL,
+               last_access REAL NOT NULL)""",
+        """CREATE INDEX cached_file_last_access ON cached_file (last_access)""",
+    ],
+    [
+        # the MD5 of the file handle's content, which lets a copy cached for one file handle serve another
+        """ALTER TABLE cache_map ADD COLUMN md5 TEXT""",
+        """CREATE INDEX cache_map_md5 ON cache_map (md5)""",
+    ],
+    [
+        # MD5s of local files, valid for as long as the size and modification time of the file are unchanged
+        """CREATE TABLE fingerprint (
+               path TEXT PRIMARY KEY,
+               size INTEGER NOT NULL,
+               mtime_ns INTEGER NOT NULL,
+               md5 TEXT NOT NULL)""",
+    ],
+]
+
+
+# the MD5 belongs to the file handle, so an entry added without one takes it from the file handle's other entries
+_INSERT_CACHE_MAP_ENTRY = ('INSERT OR REPLACE INTO cache_map (file_handle_id, path, cached_time, updated, md5)'
+                           ' VALUES (?, ?, ?, ?, COALESCE(?, (SELECT md5 FROM cache_map'
+                           ' WHERE file_handle_id=? AND md5 IS NOT NULL LIMIT 1)))')
+
+
+def _chunks(items, size=MAX_QUERY_PARAMETERS):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _forget_unreferenced_files(connection, paths):
+    # a file stays in the cached_file table for as long as any file handle's cache map refers to it
+    connection.executemany('DELETE FROM cached_file WHERE path=?'
+                           ' AND NOT EXISTS (SELECT 1 FROM cache_map WHERE cache_map.path=cached_file.path)',
+                           [(path,) for path in paths])
+
+
+class SqliteCacheIndex(object):
+    """
+    Maps file handle IDs to the paths of cached copies of their files and the modification times recorded when the
+    copies were added, equivalent to the contents of the .cacheMap files.
+
+    :param cache_root_dir:  the directory holding the index database
+    :param busy_timeout:    seconds to wait on a database locked by another writer
+    :param read_only:       open an existing database without ever writing to it or its directory, for a cache on
+                            storage that is read-only or shared between machines. The database must not change while
+                            it is open. Requires Python 3.4 or later.
+    """
+
+    def __init__(self, cache_root_dir, busy_timeout=DEFAULT_BUSY_TIMEOUT, read_only=False):
+        self.path = os.path.join(cache_root_dir, INDEX_FILE_NAME)
+        self.busy_timeout = busy_timeout
+        self.read_only = read_only
+        self._local = threading.local()
+        if read_only:
+            if sys.version_info < (3, 4):
+                raise NotImplementedError("Opening a cache index read-only requires Python 3.4 or later")
+            # fail now rather than on first use if the database can't be read
+            self._connection().execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        else:
+            self._upgrade_schema()
+
+    def _connect(self):
+        if self.read_only:
+            url = 'file:' + pathname2url(os.path.abspath(self.path))
+            try:
+                connection = sqlite3.connect(url + '?mode=ro', isolation_level=None, uri=True)
+                connection.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                return connection
+            except sqlite3.Error:
+                # WAL mode needs its shared memory file, which can't be created on read-only storage. An immutable
+                # database needs no locking at all, but changes still in the write-ahead log are not seen, so the
+                # database should be checkpointed before it is made read-only.
+                return sqlite3.connect(url + '?immutable=1', isolation_level=None, uri=True)
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _connection(self):
+        # sqlite connections must not be shared across threads, nor inherited through a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run a block of statements as a single write transaction. The write lock is taken up front so that a
+        read-modify-write sequence can't be interleaved with another writer.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _upgrade_schema(self):
+        connection = self._connection()
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= len(SCHEMA_UPGRADES):
+            return
+        with self._transaction() as connection:
+            # check again now that we hold the write lock, another process may have upgraded in the meantime
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for statements in SCHEMA_UPGRADES[version:]:
+                for statement in statements:
+                    connection.execute(statement)
+            connection.execute('PRAGMA user_version=%d' % len(SCHEMA_UPGRADES))
+
+    def get_metadata(self, key):
+        row = self._connection().execute('SELECT value FROM metadata WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, key, value):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', (key, value))
+
+    def get_cache_map(self, file_handle_id):
+        """
+        :returns: a dictionary from path to cached time for the given file handle, empty if nothing is cached
+        """
+        rows = self._connection().execute('SELECT path, cached_time FROM cache_map WHERE file_handle_id=?',
+                                          (int(file_handle_id),))
+        return dict(rows)
+
+    def get_cache_maps(self, file_handle_ids):
+        """
+        :returns: a dictionary from file handle ID to its cache map, for each of the given file handles that has
+                  entries in the index
+        """
+        cache_maps = {}
+        connection = self._connection()
+        for chunk in _chunks(set(int(file_handle_id) for file_handle_id in file_handle_ids)):
+            rows = connection.execute('SELECT file_handle_id, path, cached_time FROM cache_map'
+                                      ' WHERE file_handle_id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for file_handle_id, path, cached_time in rows:
+                cache_maps.setdefault(file_handle_id, {})[path] = cached_time
+        return cache_maps
+
+    def get_cache_map_by_md5(self, md5):
+        """
+        :returns: a dictionary from path to cached time of the copies of any file handle with the given MD5
+        """
+        rows = self._connection().execute('SELECT path, MAX(cached_time) FROM cache_map WHERE md5=? GROUP BY path',
+                                          (md5,))
+        return dict(rows)
+
+    def add(self, file_handle_id, path, cached_time, size=None, md5=None):
+        """
+        Record a cached copy of a file.
+
+        :param size: the size of the file in bytes if it is stored under the cache root, otherwise None
+        :param md5:  the MD5 of the file handle's content, if known
+
+        :returns: the cache map of the file handle including the new entry
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(_INSERT_CACHE_MAP_ENTRY, (int(file_handle_id), path, cached_time, now, md5,
+                                                         int(file_handle_id)))
+            if size is not None:
+                connection.execute('INSERT OR REPLACE INTO cached_file (path, size, last_access) VALUES (?, ?, ?)',
+                                   (path, size, now))
+            rows = connection.execute('SELECT path, cached_time FROM cache_map WHERE file_handle_id=?',
+                                      (int(file_handle_id),))
+            return dict(rows)
+
+    def add_many(self, entries):
+        """
+        Record cached copies of many files in a single transaction.
+
+        :param entries: an iterable of (file_handle_id, path, cached_time, size) tuples, where size is None for files
+                        stored outside of the cache root
+        """
+        entries = list(entries)
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(_INSERT_CACHE_MAP_ENTRY,
+                                   [(int(file_handle_id), path, cached_time, now, None, int(file_handle_id))
+                                    for file_handle_id, path, cached_time, _ in entries])
+            connection.executemany('INSERT OR REPLACE INTO cached_file (path, size, last_access) VALUES (?, ?, ?)',
+                                   [(path, size, now) for _, path, _, size in entries if size is not None])
+
+    def remove(self, file_handle_id, path=None):
+        """
+        Remove the entry for the given path, or all entries of the file handle if path is None.
+
+        :returns: the list of paths removed
+        """
+        with self._transaction() as connection:
+            if path is None:
+                rows = connection.execute('SELECT path FROM cache_map WHERE file_handle_id=?', (int(file_handle_id),))
+                removed = [row[0] for row in rows]
+                connection.execute('DELETE FROM cache_map WHERE file_handle_id=?', (int(file_handle_id),))
+            else:
+                cursor = connection.execute('DELETE FROM cache_map WHERE file_handle_id=? AND path=?',
+                                            (int(file_handle_id), path))
+                removed = [path] if cursor.rowcount > 0 else []
+            _forget_unreferenced_files(connection, removed)
+        return removed
+
+    def discard(self, file_handle_id, cache_map):
+        """
+        Remove entries found to be invalid, unless another writer has replaced them since they were read.
+
+        :param cache_map: a dictionary from path to the cached time that was read
+        """
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM cache_map WHERE file_handle_id=? AND path=? AND cached_time=?',
+                                   [(int(file_handle_id), path, cached_time)
+                                    for path, cached_time in cache_map.items()])
+            _forget_unreferenced_files(connection, cache_map)
+
+    def iter_cache_maps(self):
+        """
+        Generate (file_handle_id, cache_map, md5) tuples for every file handle in the index.
+        """
+        rows = self._connection().execute('SELECT file_handle_id, path, cached_time, md5 FROM cache_map'
+                                          ' ORDER BY file_handle_id').fetchall()
+        for file_handle_id, entries in itertools.groupby(rows, key=operator.itemgetter(0)):
+            entries = list(entries)
+            md5 = next((entry[3] for entry in entries if entry[3] is not None), None)
+            yield file_handle_id, {path: cached_time for _, path, cached_time, _ in entries}, md5
+
+    def last_updated(self, file_handle_id):
+        """
+        :returns: the time in seconds since the epoch at which an entry of the file handle was last written or None
+        """
+        row = self._connection().execute('SELECT MAX(updated) FROM cache_map WHERE file_handle_id=?',
+                                         (int(file_handle_id),)).fetchone()
+        return row[0]
+
+    def import_cache_maps(self, cache_maps):
+        """
+        Load the contents of .cacheMap files into the index. Entries already in the index take precedence.
+
+        :param cache_maps: an iterable of (file_handle_id, cache_map, last_modified_time) tuples
+
+        :returns: the number of file handles imported
+        """
+        count = 0
+        with self._transaction() as connection:
+            for file_handle_id, cache_map, last_modified_time in cache_maps:
+                connection.executemany('INSERT OR IGNORE INTO cache_map (file_handle_id, path, cached_time, updated)'
+                                       ' VALUES (?, ?, ?, ?)',
+                                       [(int(file_handle_id), path, cached_time, last_modified_time)
+                                        for path, cached_time in cache_map.items()])
+                count += 1
+        return count
+
+    def touch(self, paths):
+        """
+        Record that cached files were just handed out, which makes them the last to be evicted.
+        """
+        paths = list(paths)
+        if not paths:
+            return
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany('UPDATE cached_file SET last_access=? WHERE path=?', [(now, path) for path in paths])
+
+    def untracked_paths(self):
+        """
+        :returns: the paths in the cache maps that have no entry in the cached_file table
+        """
+        rows = self._connection().execute('SELECT DISTINCT path FROM cache_map'
+                                          ' WHERE path NOT IN (SELECT path FROM cached_file)')
+        return [row[0] for row in rows]
+
+    def track_files(self, sizes):
+        """
+        Add files stored under the cache root to the cached_file table, keeping the access times of known files.
+
+        :param sizes: an iterable of (path, size) tuples
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR IGNORE INTO cached_file (path, size, last_access) VALUES (?, ?, ?)',
+                                   [(path, size, now) for path, size in sizes])
+
+    def usage(self):
+        """
+        :returns: a tuple of the number of files stored under the cache root and their total size in bytes
+        """
+        count, total_size = self._connection().execute('SELECT COUNT(*), SUM(size) FROM cached_file').fetchone()
+        return count, total_size or 0
+
+    def least_recently_used(self, limit=100, offset=0):
+        """
+        :returns: a list of (path, size) tuples for the files under the cache root in order of their last access
+        """
+        rows = self._connection().execute('SELECT path, size FROM cached_file ORDER BY last_access, path'
+                                          ' LIMIT ? OFFSET ?', (limit, offset))
+        return rows.fetchall()
+
+    def evict(self, path):
+        """
+        Remove a file stored under the cache root and all cache map entries pointing to it.
+        """
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM cache_map WHERE path=?', (path,))
+            connection.execute('DELETE FROM cached_file WHERE path=?', (path,))
+            connection.execute('DELETE FROM fingerprint WHERE path=?', (path,))
+
+    def get_fingerprint(self, path):
+        """
+        :returns: a tuple of the size, modification time in nanoseconds and MD5 recorded for the file or None
+        """
+        return self._connection().execute('SELECT size, mtime_ns, md5 FROM fingerprint WHERE path=?',
+                                          (path,)).fetchone()
+
+    def set_fingerprint(self, path, size, mtime_ns, md5):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO fingerprint (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?)',
+                               (path, size, mtime_ns, md5))
@@ -41,13 +41,15 @@ except ImportError:
     import ConfigParser as configparser
 
 import collections
+import itertools
+import io
 import os
 import errno
 import sys
 import re
 import time
-import hashlib
 import six
+from six.moves import queue
 
 try:
     from urllib.parse import urlparse
@@ -93,10 +95,18 @@ from .table import Schema, SchemaBase, Column, TableQueryResult, CsvFileTable, T
 from .team import UserProfile, Team, TeamMember, UserGroupHeader
 from .wiki import Wiki, WikiAttachment
 from .retry import _with_retry
-from .multipart_upload import multipart_upload, multipart_upload_string
+from .multipart_upload import multipart_upload, multipart_upload_string, multipart_upload_stream, new_upload_session
+from . import multipart_download
+from . import download_urls
+from . import download_stream
+from . import download_writer
+from . import remote_file
+from . import resumable_md5
+from . import pool_provider
 from .remote_file_storage_wrappers import S3ClientWrapper, SFTPWrapper
 from .upload_functions import upload_file_handle, upload_synapse_s3
 from .dozer import doze
+from .lock import single_flight
 
 
 PRODUCTION_ENDPOINTS = {'repoEndpoint': 'https://repo-prod.prod.sagebase.org/repo/v1',
@@ -112,6 +122,9 @@ STAGING_ENDPOINTS = {'repoEndpoint': 'https://repo-staging.prod.sagebase.org/rep
 CONFIG_FILE = os.path.join(os.path.expanduser('~'), '.synapseConfig')
 SESSION_FILENAME = '.session'
 FILE_BUFFER_SIZE = 2*MB
+MD5_CHECKPOINT_INTERVAL = resumable_md5.CHUNK_SIZE  # bytes downloaded between saves of the MD5s of a partial download
+DOWNLOAD_LOCK_NAME = '.download'  # held in a file handle's cache dir while it is being downloaded
+DEFAULT_CONCURRENT_BULK_DOWNLOADS = 3  # zip files downloaded at once by downloadTableColumns
 CHUNK_SIZE = 5*MB
 QUERY_LIMIT = 1000
 CHUNK_UPLOAD_POLL_INTERVAL = 1  # second
@@ -196,8 +209,16 @@ class Synapse(object):
     def __init__(self, repoEndpoint=None, authEndpoint=None, fileHandleEndpoint=None, portalEndpoint=None,
                  debug=None, skip_checks=False, configPath=CONFIG_FILE):
         self._requests_session = requests.Session()
+        # parts of uploads are PUT to pre-signed URLs outside of Synapse over connections that are kept open
+        self._upload_session = new_upload_session()
 
         cache_root_dir = cache.CACHE_ROOT_DIR
+        cache_index = None
+        cache_max_size = None
+        cache_read_only_locations = None
+        cache_promote = False
+        self.parallel_download_threshold = multipart_download.DEFAULT_THRESHOLD
+        self.parallel_download_part_size = multipart_download.DEFAULT_PART_SIZE
 
         config_debug = None
         # Check for a config file
@@ -206,13 +227,30 @@ class Synapse(object):
             config = self.getConfigFile(configPath)
             if config.has_option('cache', 'location'):
                 cache_root_dir = config.get('cache', 'location')
+            if config.has_option('cache', 'index'):
+                cache_index = config.get('cache', 'index')
+            if config.has_option('cache', 'max_size'):
+                cache_max_size = config.get('cache', 'max_size')
+            if config.has_option('cache', 'read_only_locations'):
+                cache_read_only_locations = [location.strip() for location in
+                                             config.get('cache', 'read_only_locations').split(',') if location.strip()]
+            if config.has_option('cache', 'promote'):
+                cache_promote = config.getboolean('cache', 'promote')
+            if config.has_option('transfer', 'parallel_download_threshold'):
+                self.parallel_download_threshold = utils.parse_size(
+                    config.get('transfer', 'parallel_download_threshold'))
+            if config.has_option('transfer', 'parallel_download_part_size'):
+                self.parallel_download_part_size = utils.parse_size(
+                    config.get('transfer', 'parallel_download_part_size'))
             if config.has_section('debug'):
                 debug = True
 
         if debug is None:
             debug = config_debug if config_debug is not None else DEBUG_DEFAULT
 
-        self.cache = cache.Cache(cache_root_dir)
+        self.cache = cache.Cache(cache_root_dir, index=cache_index, max_size=cache_max_size,
+                                 read_only_roots=cache_read_only_locations, promote=cache_promote)
+        self._download_urls = download_urls.DownloadURLResolver(self)
 
         self.setEndpoints(repoEndpoint, authEndpoint, fileHandleEndpoint, portalEndpoint, skip_checks)
 
@@ -590,6 +628,11 @@ class Synapse(object):
         :param limitSearch:      a Synanpse ID used to limit the search in Synapse if entity is specified as a local
                                  file.  That is, if the file is stored in multiple locations in Synapse only the ones
                                  in the specified folder/project will be returned.
+        :param materialize:      How a file that is already cached is placed in the downloadLocation.
+                                 May be "copy", "reflink" (a copy-on-write clone), "hardlink" or "symlink". Links fall
+                                 back to a copy when not possible, e.g. when the cache is on another file system.
+                                 Note that changing a hardlinked or symlinked file also changes the cached copy.
+                                 Defaults to "copy".
 
         :returns: A new Synapse Entity object of the appropriate type
 
@@ -632,6 +675,259 @@ class Synapse(object):
 
         return self._getWithEntityBundle(entityBundle=bundle, entity=entity, **kwargs)
 
+    def getMany(self, entities, max_workers=None, **kwargs):
+        """
+        Gets many entities from the repository service, fetching them and downloading their files concurrently.
+
+        :param entities:         Synapse IDs, Synapse Entity objects or plain dictionaries in which 'id' maps to a
+                                 Synapse ID
+        :param max_workers:      The number of entities fetched or downloaded at a time.
+                                 Defaults to 8.
+        :param downloadFile:     Whether associated files(s) should be downloaded.
+                                 Defaults to True
+        :param downloadLocation: Directory where to download the Synapse File Entities.
+                                 Defaults to the local cache.
+        :param followLink:       Whether links return their target Entities.
+                                 Defaults to False
+        :param ifcollision:      Determines how to handle file collisions.
+                                 May be "overwrite.local", "keep.local", or "keep.both".
+                                 Defaults to "keep.both".
+        :param materialize:      How files that are already cached are placed in the downloadLocation.
+                                 See :py:func:`synapseclient.Synapse.get`.
+
+        :returns: A generator of results in the order in which they complete. Each has the requested 'id', the
+                  'entity' and the 'error' raised while getting it or downloading its file, which is None if there
+                  was no error. An error doesn't stop the other entities from being fetched.
+
+        Example::
+
+            for result in syn.getMany(['syn1906479', 'syn1906480'], downloadLocation='.'):
+                if result.error is not None:
+                    print('Could not get %s: %s' % (result.id, result.error))
+                else:
+                    print(result.entity.path)
+
+        """
+        unexpected = set(kwargs) - {'downloadFile', 'downloadLocation', 'followLink', 'ifcollision', 'materialize'}
+        if unexpected:
+            raise TypeError('Unexpected **kwargs: %r' % {key: kwargs[key] for key in unexpected})
+        downloadFile = kwargs.get('downloadFile', True)
+        downloadLocation = kwargs.get('downloadLocation', None)
+        followLink = kwargs.get('followLink', False)
+        ifcollision = kwargs.get('ifcollision', None)
+        materialize = kwargs.get('materialize', 'copy')
+        if downloadLocation is not None:
+            downloadLocation = os.path.expandvars(os.path.expanduser(downloadLocation))
+
+        def get_entity(entity):
+            result = DictObject(id=entity, entity=None, error=None)
+            try:
+                result.id = id_of(entity)
+                bundle = self._getEntityBundle(entity)
+                self._check_entity_restrictions(bundle['restrictionInformation'], entity, downloadFile)
+                result.entity = self._getWithEntityBundle(entityBundle=bundle, entity=entity, downloadFile=False,
+                                                          followLink=followLink)
+            except Exception as ex:
+                result.error = ex
+            return (False, result)
+
+        def download_file(result, plan):
+            try:
+                self._download_file_entity(downloadLocation, result.entity, ifcollision, None, materialize, plan)
+            except Exception as ex:
+                result.error = ex
+            return (True, result)
+
+        # bundles are fetched and files downloaded by separate pools, so that fetching the next entities doesn't wait
+        # for the downloads queued before them. The results of both come back through the done queue, tagged with
+        # whether they were downloaded.
+        pool_size = max_workers or pool_provider.DEFAULT_POOL_SIZE
+        fetch_pool = pool_provider.get_pool(pool_size)
+        download_pool = pool_provider.get_pool(pool_size)
+        done = queue.Queue()
+        try:
+            entities = iter(entities)
+            fetching = 0
+            downloading = 0
+            for entity in itertools.islice(entities, download_urls.MAX_BATCH_SIZE):
+                fetch_pool.apply_async(get_entity, (entity,), callback=done.put)
+                fetching += 1
+            to_download = []
+            # the paths of the files of this call, which may not exist yet, so that files with the same name don't
+            # end up at the same path
+            reserved_paths = set()
+            while fetching or downloading:
+                # take all the results that are ready, so that the downloads they lead to can share a batch of URLs
+                ready = [done.get()]
+                while True:
+                    try:
+                        ready.append(done.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for downloaded, result in ready:
+                    if downloaded:
+                        downloading -= 1
+                        yield result
+                        continue
+                    fetching -= 1
+                    for entity in itertools.islice(entities, 1):
+                        fetch_pool.apply_async(get_entity, (entity,), callback=done.put)
+                        fetching += 1
+                    if downloadFile and result.error is None and isinstance(result.entity, File):
+                        if result.entity._file_handle.get('id') is not None:
+                            to_download.append(result)
+                            continue
+                        self._warn_no_download_permission()
+                    yield result
+
+                # start the downloads once there are enough of them for a batch of URLs, or workers free for them
+                if to_download and (len(to_download) >= download_urls.MAX_BATCH_SIZE or not fetching
+                                    or downloading < pool_size):
+                    plans = []
+                    for result in to_download:
+                        try:
+                            plan = self._plan_file_entity_download(downloadLocation, result.entity, ifcollision,
+                                                                   reserved_paths)
+                        except Exception as ex:
+                            result.error = ex
+                            yield result
+                            continue
+                        location, path, cached_path = plan
+                        if path is not None:
+                            reserved_paths.add(path)
+                        plans.append((result, plan))
+                    # files that are already cached or that aren't downloaded don't need a URL
+                    self._prefetch_file_handle_downloads([result.entity for result, (location, path, cached_path)
+                                                          in plans if path is not None and cached_path is None])
+                    for result, plan in plans:
+                        download_pool.apply_async(download_file, (result, plan), callback=done.put)
+                        downloading += 1
+                    to_download = []
+        finally:
+            fetch_pool.terminate()
+            download_pool.terminate()
+
+    def iter_bytes(self, entity, chunk_size=FILE_BUFFER_SIZE, version=None, use_cache=True):
+        """
+        Reads the file of a Synapse File entity in chunks, streaming it from Synapse without writing it to disk.
+
+        :param entity:     A Synapse ID, a Synapse File object or a plain dictionary in which 'id' maps to a Synapse ID
+        :param chunk_size: The most bytes in each chunk.
+                           Defaults to 2MB
+        :param version:    The specific version to read.
+                           Defaults to the most recent version.
+        :param use_cache:  Whether to read a copy of the file that is already in the cache, if there is one, instead of
+                           streaming it from Synapse. Streamed files are never added to the cache.
+                           Defaults to True
+
+        :returns: A generator of bytes. The MD5 of the file is checked as it is read, raising a
+                  SynapseMd5MismatchError after the last chunk if it doesn't match.
+
+        Example::
+
+            with open('copy.csv', 'wb') as f:
+                for chunk in syn.iter_bytes('syn1906479'):
+                    f.write(chunk)
+
+        """
+        entity = self._get_file_entity_to_stream(entity, version)
+        if use_cache:
+            cached_path = self.cache.get(entity.dataFileHandleId)
+            if cached_path is not None:
+                return download_stream.iter_file(cached_path, chunk_size)
+
+        fileResult = self._getFileHandleDownload(entity.dataFileHandleId, entity.id, 'FileEntity')
+        url = fileResult.get('preSignedURL')
+        scheme = urlparse(url).scheme if url else None
+        if scheme == 'file':
+            return download_stream.iter_file(utils.file_url_to_path(url), chunk_size)
+        elif scheme not in ('http', 'https'):
+            raise SynapseError("The file of %s can't be streamed, use syn.get() to download it instead" % entity.id)
+        return download_stream.iter_url(self, url, chunk_size, size=fileResult['fileHandle'].get('contentSize'),
+                                        expected_md5=fileResult['fileHandle'].get('contentMd5'))
+
+    def open(self, entity, mode='rb', chunk_size=FILE_BUFFER_SIZE, version=None, use_cache=True, seekable=False,
+             block_size=remote_file.DEFAULT_BLOCK_SIZE):
+        """
+        Opens the file of a Synapse File entity for reading, streaming it from Synapse without writing it to disk.
+        See :py:func:`synapseclient.Synapse.iter_bytes` for the other parameters.
+
+        :param mode:       Only "rb" is supported.
+        :param seekable:   Whether to return a seekable file object, which reads only the parts of the file that are
+                           read from it with range requests. This suits reading the header or a slice of a large file,
+                           e.g. with pysam or pyarrow. Its MD5 is not checked.
+                           Defaults to False
+        :param block_size: The number of bytes requested at a time by a seekable file object.
+                           Defaults to 2MB
+
+        :returns: A read only binary file object
+
+        Example::
+
+            import io
+            import json
+
+            with syn.open('syn1906479') as f:
+                data = json.load(io.TextIOWrapper(f, encoding='utf-8'))
+
+            # read the last kilobyte of a large file
+            with syn.open('syn1906480', seekable=True) as f:
+                f.seek(-1024, io.SEEK_END)
+                tail = f.read()
+
+        """
+        if mode != 'rb':
+            raise ValueError('Synapse files can only be opened in "rb" mode, not "%s"' % mode)
+        if not seekable:
+            return io.BufferedReader(download_stream.IteratorReader(self.iter_bytes(entity, chunk_size, version,
+                                                                                    use_cache)),
+                                     buffer_size=chunk_size)
+
+        entity = self._get_file_entity_to_stream(entity, version)
+        if use_cache:
+            cached_path = self.cache.get(entity.dataFileHandleId)
+            if cached_path is not None:
+                return io.open(cached_path, 'rb')
+
+        def get_url(refresh=False):
+            if refresh:
+                self._download_urls.forget(entity.dataFileHandleId, entity.id, 'FileEntity')
+            return self._getFileHandleDownload(entity.dataFileHandleId, entity.id, 'FileEntity')['preSignedURL']
+
+        url = get_url()
+        scheme = urlparse(url).scheme if url else None
+        if scheme == 'file':
+            return io.open(utils.file_url_to_path(url), 'rb')
+        elif scheme not in ('http', 'https') or entity._file_handle.get('contentSize') is None:
+            raise SynapseError("The file of %s can't be opened as seekable, use syn.get() to download it instead"
+                               % entity.id)
+        return remote_file.RemoteFile(self, get_url, entity._file_handle['contentSize'],
+                                      name=entity._file_handle.get('fileName'), block_size=block_size)
+
+    def _get_file_entity_to_stream(self, entity, version=None):
+        if not (isinstance(entity, File) and entity._file_handle.get('id') is not None and version is None):
+            bundle = self._getEntityBundle(entity, version)
+            self._check_entity_restrictions(bundle['restrictionInformation'], entity, True)
+            entity = self._getWithEntityBundle(entityBundle=bundle, entity=entity, downloadFile=False)
+        if not isinstance(entity, File):
+            raise ValueError("%s is not a File entity" % entity.id)
+        if entity._file_handle.get('id') is None:
+            raise SynapseError("You have READ permission on %s but not DOWNLOAD permission" % entity.id)
+        return entity
+
+    def _prefetch_file_handle_downloads(self, entities):
+        """
+        Resolves the download URLs of the files of File entities together, ahead of their downloads.
+        """
+        if not entities:
+            return
+        try:
+            self._download_urls.resolve([(entity.dataFileHandleId, entity.id, 'FileEntity') for entity in entities])
+        except SynapseError:
+            # each download will get its own URL instead, reporting its own error
+            self.logger.debug("Unable to get the download URLs of %d files" % len(entities), exc_info=True)
+
     def _check_entity_restrictions(self, restrictionInformation, entity, downloadFile):
         if restrictionInformation['hasUnmetAccessRequirement']:
             warning_message = ("\nThis entity has access restrictions. Please visit the web page for this entity "
@@ -649,7 +945,7 @@ class Synapse(object):
         :param filepath:        path to local file
         :param limitSearch:     Limits the places in Synapse where the file is searched for.
         """
-        results = self.restGET('/entity/md5/%s' % utils.md5_for_file(filepath).hexdigest())['results']
+        results = self.restGET('/entity/md5/%s' % self.cache.md5_for_file(filepath))['results']
         if limitSearch is not None:
             # Go through and find the path of every entity found
             paths = [self.restGET('/entity/%s/path' % ent['id']) for ent in results]
@@ -715,6 +1011,7 @@ class Synapse(object):
         submission = kwargs.pop('submission', None)
         followLink = kwargs.pop('followLink', False)
         path = kwargs.pop('path', None)
+        materialize = kwargs.pop('materialize', 'copy')
 
         # make sure user didn't accidentlaly pass a kwarg that we don't handle
         if kwargs:  # if there are remaining items in the kwargs
@@ -746,20 +1043,69 @@ class Synapse(object):
 
             if downloadFile:
                 if file_handle:
-                    self._download_file_entity(downloadLocation, entity, ifcollision, submission)
+                    self._download_file_entity(downloadLocation, entity, ifcollision, submission, materialize)
                 else:  # no filehandle means that we do not have DOWNLOAD permission
-                    warning_message = "WARNING: You have READ permission on this file entity but not DOWNLOAD " \
-                                      "permission. The file has NOT been downloaded."
-                    self.logger.warning('\n' + '!'*len(warning_message)+'\n' + warning_message + '\n'
-                                        + '!'*len(warning_message)+'\n')
+                    self._warn_no_download_permission()
         return entity
 
-    def _download_file_entity(self, downloadLocation, entity, ifcollision, submission):
+    def _warn_no_download_permission(self):
+        warning_message = "WARNING: You have READ permission on this file entity but not DOWNLOAD " \
+                          "permission. The file has NOT been downloaded."
+        self.logger.warning('\n' + '!'*len(warning_message)+'\n' + warning_message + '\n'
+                            + '!'*len(warning_message)+'\n')
+
+    def _download_file_entity(self, downloadLocation, entity, ifcollision, submission, materialize='copy',
+                              plan=None):
+        """
+        :param plan: (optional) the result of :py:func:`_plan_file_entity_download` for the entity, if the path of its
+                     file was already decided
+        """
         # set the initial local state
         entity.path = None
         entity.files = []
         entity.cacheDir = None
 
+        if plan is None:
+            plan = self._plan_file_entity_download(downloadLocation, entity, ifcollision)
+        downloadLocation, downloadPath, cached_file_path = plan
+        if downloadPath is None:
+            return
+
+        if cached_file_path is not None:  # copy from cache
+            if downloadPath != cached_file_path:
+                # create the foider if it does not exist already
+                if not os.path.exists(downloadLocation):
+                    os.makedirs(downloadLocation)
+                cache.materialize(cached_file_path, downloadPath, materialize)
+                # so that the file is found in the downloadLocation next time instead of being placed there again
+                self.cache.add(entity.dataFileHandleId, downloadPath)
+
+        else:  # download the file from URL (could be a local file)
+            objectType = 'FileEntity' if submission is None else 'SubmissionAttachment'
+            objectId = entity['id'] if submission is None else submission
+
+            # reassign downloadPath because if url points to local file (e.g. file://~/someLocalFile.txt)
+            # it won't be "downloaded" and, instead, downloadPath will just point to '~/someLocalFile.txt'
+            # _downloadFileHandle may also return None to indicate that the download failed
+            downloadPath = self._downloadFileHandle(entity.dataFileHandleId, objectId, objectType, downloadPath,
+                                                    expected_md5=entity._file_handle.get('contentMd5'))
+
+            if downloadPath is None or not os.path.exists(downloadPath):
+                return
+
+        entity.path = downloadPath
+        entity.files = [os.path.basename(downloadPath)]
+        entity.cacheDir = os.path.dirname(downloadPath)
+
+    def _plan_file_entity_download(self, downloadLocation, entity, ifcollision, reserved_paths=()):
+        """
+        Decide where the file of a File entity goes.
+
+        :param reserved_paths: paths that are taken by the files of other entities, although they might not exist yet
+
+        :returns: a tuple of the directory of the file, its path, which is None if it isn't to be downloaded, and the
+                  path of an unmodified copy of it that is already cached or None
+        """
         # check to see if an UNMODIFIED version of the file (since it was last downloaded) already exists
         # this location could be either in .synapseCache or a user specified location to which the user previously
         # downloaded the file
@@ -786,35 +1132,11 @@ class Synapse(object):
         # resolve file path collisions by either overwriting, renaming, or not downloading, depending on the
         # ifcollision value
         downloadPath = self._resolve_download_path_collisions(downloadLocation, file_name, ifcollision,
-                                                              synapseCache_location, cached_file_path)
-        if downloadPath is None:
-            return
-
-        if cached_file_path is not None:  # copy from cache
-            if downloadPath != cached_file_path:
-                # create the foider if it does not exist already
-                if not os.path.exists(downloadLocation):
-                    os.makedirs(downloadLocation)
-                shutil.copy(cached_file_path, downloadPath)
-
-        else:  # download the file from URL (could be a local file)
-            objectType = 'FileEntity' if submission is None else 'SubmissionAttachment'
-            objectId = entity['id'] if submission is None else submission
-
-            # reassign downloadPath because if url points to local file (e.g. file://~/someLocalFile.txt)
-            # it won't be "downloaded" and, instead, downloadPath will just point to '~/someLocalFile.txt'
-            # _downloadFileHandle may also return None to indicate that the download failed
-            downloadPath = self._downloadFileHandle(entity.dataFileHandleId, objectId, objectType, downloadPath)
-
-            if downloadPath is None or not os.path.exists(downloadPath):
-                return
-
-        entity.path = downloadPath
-        entity.files = [os.path.basename(downloadPath)]
-        entity.cacheDir = os.path.dirname(downloadPath)
+                                                              synapseCache_location, cached_file_path, reserved_paths)
+        return downloadLocation, downloadPath, cached_file_path
 
     def _resolve_download_path_collisions(self, downloadLocation, file_name, ifcollision, synapseCache_location,
-                                          cached_file_path):
+                                          cached_file_path, reserved_paths=()):
         # always overwrite if we are downloading to .synapseCache
         if utils.normalize_path(downloadLocation) == synapseCache_location:
             if ifcollision is not None:
@@ -827,7 +1149,7 @@ class Synapse(object):
 
         downloadPath = utils.normalize_path(os.path.join(downloadLocation, file_name))
         # resolve collison
-        if os.path.exists(downloadPath):
+        if os.path.exists(downloadPath) or downloadPath in reserved_paths:
             if ifcollision == "overwrite.local":
                 pass
             elif ifcollision == "keep.local":
@@ -835,7 +1157,7 @@ class Synapse(object):
                 return None
             elif ifcollision == "keep.both":
                 if downloadPath != cached_file_path:
-                    return utils.unique_filename(downloadPath)
+                    return utils.unique_filename(downloadPath, reserved_paths)
             else:
                 raise ValueError('Invalid parameter: "%s" is not a valid value '
                                  'for "ifcollision"' % ifcollision)
@@ -1229,6 +1551,34 @@ class Synapse(object):
         """
         return upload_file_handle(self, parent, path, synapseStore, md5, file_size, mimetype)
 
+    def upload_stream(self, readable, filename, contentType=None, expected_size=None, storageLocationId=None):
+        """
+        Uploads data that is produced on the fly, e.g. by a compressor, to Synapse managed storage without it having
+        to be written to a file first. Synapse needs the size and MD5 of a file before its upload can start, so the data
+        is written to a temporary file in the cache while it is read and hashed, which is removed after the upload.
+
+        :param readable:          A file-like object opened for reading, or an iterable of bytes such as a generator
+        :param filename:          The name of the uploaded file
+        :param contentType:       The MIME type of the file.
+                                  Defaults to a type guessed from the filename.
+        :param expected_size:     The number of bytes that the stream is expected to have, if known. Streams of more
+                                  than 80GB need it to choose the size of the parts they're uploaded in.
+        :param storageLocationId: The id of the storage location to upload to.
+                                  Defaults to Synapse's default S3 storage.
+
+        :returns: a dict of a new FileHandle that represents the uploaded file
+
+        Example::
+
+            with gzip.open('variants.vcf.gz', 'rb') as f:
+                file_handle = syn.upload_stream(f, 'variants.vcf')
+            syn.store(File(parentId='syn123', name='variants.vcf', dataFileHandleId=file_handle['id']))
+
+        """
+        file_handle_id = multipart_upload_stream(self, readable, filename, contentType=contentType,
+                                                 storageLocationId=storageLocationId, expected_size=expected_size)
+        return self._getFileHandle(file_handle_id)
+
     ############################################################
     #                    Deprecated methods                    #
     ############################################################
@@ -1694,15 +2044,11 @@ class Synapse(object):
         :param objectId:       The ID of the object associated with the file e.g. syn234
         :param objectType:     Type of object associated with a file e.g. FileEntity, TableEntity
 
+        URLs are reused until they are about to expire, see :py:class:`synapseclient.download_urls.DownloadURLResolver`.
+
         :returns: dictionary with keys: fileHandle, fileHandleId and preSignedURL
         """
-        body = {'includeFileHandles': True, 'includePreSignedURLs': True,
-                'requestedFiles': [{'fileHandleId': fileHandleId,
-                                    'associateObjectId': objectId,
-                                    'associateObjectType': objectType}]}
-        response = self.restPOST('/fileHandle/batch', body=json.dumps(body),
-                                 endpoint=self.fileHandleEndpoint)
-        result = response['requestedFiles'][0]
+        result = self._download_urls.resolve([(fileHandleId, objectId, objectType)])[0]
         failure = result.get('failureCode')
         if failure == 'NOT_FOUND':
             raise exceptions.SynapseFileNotFoundError("The fileHandleId %s could not be found" % fileHandleId)
@@ -1712,7 +2058,26 @@ class Synapse(object):
 
         return result
 
-    def _downloadFileHandle(self, fileHandleId, objectId, objectType, destination, retries=5):
+    def _getFileHandleDownloads(self, associations):
+        """
+        Gets the URLs and the metadata of many filehandles with a single request. Downloads should go through
+        self._download_urls instead, which splits any number of files into these requests and reuses their results.
+
+        :param associations: a list of at most download_urls.MAX_BATCH_SIZE (fileHandleId, objectId, objectType) tuples
+
+        :returns: a list of dictionaries with keys fileHandleId, fileHandle and preSignedURL, or failureCode if the
+                  file can't be downloaded, in the same order as associations
+        """
+        body = {'includeFileHandles': True, 'includePreSignedURLs': True,
+                'requestedFiles': [{'fileHandleId': fileHandleId,
+                                    'associateObjectId': objectId,
+                                    'associateObjectType': objectType}
+                                   for fileHandleId, objectId, objectType in associations]}
+        response = self.restPOST('/fileHandle/batch', body=json.dumps(body),
+                                 endpoint=self.fileHandleEndpoint)
+        return response['requestedFiles']
+
+    def _downloadFileHandle(self, fileHandleId, objectId, objectType, destination, retries=5, expected_md5=None):
         """
         Download a file from the given URL to the local file system.
 
@@ -1721,6 +2086,11 @@ class Synapse(object):
         :param objectType:   type of the Synapse object that uses the FileHandle e.g. "FileEntity"
         :param destination:  destination on local file system
         :param retries:      (default=5) Number of download retries attempted before throwing an exception.
+        :param expected_md5: (optional) the contentMd5 of the FileHandle. If given, a cached copy of another FileHandle
+                             with the same content is cloned instead of downloading the file.
+
+        Threads and processes that ask for a file handle while another one is downloading it wait for that download and
+        then get a copy of the cached file.
 
         :returns: path to downloaded file
         """
@@ -1729,34 +2099,62 @@ class Synapse(object):
         except OSError as exception:
             if exception.errno != errno.EEXIST:
                 raise
-        while retries > 0:
-            try:
-                fileResult = self._getFileHandleDownload(fileHandleId, objectId, objectType)
-                fileHandle = fileResult['fileHandle']
-                if fileHandle['concreteType'] == concrete_types.EXTERNAL_OBJECT_STORE_FILE_HANDLE:
-                    profile = self._get_client_authenticated_s3_profile(fileHandle['endpointUrl'], fileHandle['bucket'])
-                    downloaded_path = S3ClientWrapper.download_file(fileHandle['bucket'], fileHandle['endpointUrl'],
-                                                                    fileHandle['fileKey'], destination,
-                                                                    profile_name=profile)
-                else:
-                    downloaded_path = self._download_from_URL(fileResult['preSignedURL'], destination, fileHandle['id'],
-                                                              expected_md5=fileHandle.get('contentMd5'))
-                self.cache.add(fileHandle['id'], downloaded_path)
-                return downloaded_path
-            except Exception as ex:
-                exc_info = sys.exc_info()
-                ex.progress = 0 if not hasattr(ex, 'progress') else ex.progress
-                self.logger.debug("\nRetrying download on error: [%s] after progressing %i bytes" %
-                                  (exc_info[0], ex.progress), exc_info=True)  # this will include stack trace
-                if ex.progress == 0:  # No progress was made reduce remaining retries.
-                    retries -= 1
-                if retries <= 0:
-                    # Re-raise exception
-                    raise exc_info[0](exc_info[1])
+
+        # jobs started together often ask for the same file at once, only the first downloads it and the others wait
+        # for it to finish and then use the copy it cached
+        with single_flight(DOWNLOAD_LOCK_NAME, self.cache.get_cache_dir(fileHandleId)) as waited:
+            cached_path = self.cache.get(fileHandleId) if waited else None
+            if cached_path is None:
+                cached_path = self.cache.get_by_md5(expected_md5)
+            if cached_path is not None:
+                if not utils.equal_paths(cached_path, destination):
+                    # hardlinks are only made within the cache, where files aren't expected to be modified
+                    method = cache.clone_file(cached_path, destination,
+                                              hardlink=self.cache.in_cache_root(utils.normalize_path(destination)))
+                    self.logger.debug("Made a %s of %s to %s instead of downloading file handle %s" %
+                                      (method, cached_path, destination, fileHandleId))
+                self.cache.add(fileHandleId, destination, md5=expected_md5)
+                return destination
+
+            def refresh_url():
+                self._download_urls.forget(fileHandleId, objectId, objectType)
+                return self._getFileHandleDownload(fileHandleId, objectId, objectType)['preSignedURL']
+
+            while retries > 0:
+                try:
+                    fileResult = self._getFileHandleDownload(fileHandleId, objectId, objectType)
+                    fileHandle = fileResult['fileHandle']
+                    if fileHandle['concreteType'] == concrete_types.EXTERNAL_OBJECT_STORE_FILE_HANDLE:
+                        profile = self._get_client_authenticated_s3_profile(fileHandle['endpointUrl'],
+                                                                            fileHandle['bucket'])
+                        downloaded_path = S3ClientWrapper.download_file(fileHandle['bucket'], fileHandle['endpointUrl'],
+                                                                        fileHandle['fileKey'], destination,
+                                                                        profile_name=profile)
+                    else:
+                        downloaded_path = self._download_from_URL(fileResult['preSignedURL'], destination,
+                                                                  fileHandle['id'],
+                                                                  expected_md5=fileHandle.get('contentMd5'),
+                                                                  expected_size=fileHandle.get('contentSize'),
+                                                                  refresh_url=refresh_url)
+                    self.cache.add(fileHandle['id'], downloaded_path, md5=fileHandle.get('contentMd5'))
+                    return downloaded_path
+                except Exception as ex:
+                    exc_info = sys.exc_info()
+                    # the failure may be due to the URL having expired, so the retry gets a new one
+                    self._download_urls.forget(fileHandleId, objectId, objectType)
+                    ex.progress = 0 if not hasattr(ex, 'progress') else ex.progress
+                    self.logger.debug("\nRetrying download on error: [%s] after progressing %i bytes" %
+                                      (exc_info[0], ex.progress), exc_info=True)  # this will include stack trace
+                    if ex.progress == 0:  # No progress was made reduce remaining retries.
+                        retries -= 1
+                    if retries <= 0:
+                        # Re-raise exception
+                        raise exc_info[0](exc_info[1])
 
         raise Exception("should not reach this line")
 
-    def _download_from_URL(self, url, destination, fileHandleId=None, expected_md5=None):
+    def _download_from_URL(self, url, destination, fileHandleId=None, expected_md5=None, expected_size=None,
+                           refresh_url=None):
         """
         Download a file from the given URL to the local file system.
 
@@ -1766,6 +2164,12 @@ class Synapse(object):
                                 handle id which allows resuming partial downloads of the same file from previous
                                 sessions
         :param expected_md5:    (optional) if given, check that the MD5 of the downloaded file matched the expected MD5
+        :param expected_size:   (optional) the size of the file in bytes. Files of at least
+                                parallel_download_threshold bytes are downloaded in parts over several connections.
+        :param refresh_url:     (optional) a function that returns a new pre-signed URL of the file. It is used instead
+                                of url when url is about to expire or is refused with 403 Forbidden, so that a download
+                                that outlasts its URL resumes rather than fails. url is taken to have been handed out
+                                when this is called, which tells how long it is valid for if it doesn't say itself.
 
         :returns: path to downloaded file
         """
@@ -1773,7 +2177,14 @@ class Synapse(object):
         destination = os.path.abspath(destination)
         actual_md5 = None
         redirect_count = 0
+        # the URL of the file, as opposed to one it redirected to, which is refreshed when it expires
+        urls = download_urls.RefreshingURL(url, refresh_url, obtained=time.time())
+        redirected = False
+        refreshed = False
         delete_on_md5_mismatch = True
+        # the size is needed to split the file into parts and the file handle id to resume them later
+        parallel = bool(self.parallel_download_threshold) and fileHandleId is not None and expected_size is not None \
+            and expected_size >= self.parallel_download_threshold and not os.path.isdir(destination)
         while redirect_count < REDIRECT_LIMIT:
             redirect_count += 1
             scheme = urlparse(url).scheme
@@ -1791,11 +2202,30 @@ class Synapse(object):
                 urlretrieve(url, destination)
                 break
             elif scheme == 'http' or scheme == 'https':
+                if not redirected:
+                    url = requested_url = urls.get()
                 # if a partial download exists with the temporary name,
                 # find it and restart the download from where it left off
                 temp_destination = utils.temp_download_filename(destination, fileHandleId)
+                if parallel:
+                    try:
+                        actual_md5 = multipart_download.download_file(self,
+                                                                      download_urls.RefreshingURL(url) if redirected
+                                                                      else urls,
+                                                                      destination, temp_destination, expected_size,
+                                                                      self.parallel_download_part_size)
+                        break
+                    except multipart_download.RangeRequestsNotSupportedError:
+                        self.logger.debug("Range requests aren't supported for %s, downloading it over a single "
+                                          "connection" % url, exc_info=True)
+                        parallel = False
+                resume = os.path.exists(temp_destination) \
+                    and not multipart_download.discard_partial_download(temp_destination)
+                # only hash what was downloaded since the MD5 was last saved, if it was. This is done before asking
+                # for the rest of the file as it may find that the end of the partial download needs downloading again
+                checkpoint = resumable_md5.load_checkpoint(temp_destination) if resume else None
                 range_header = {"Range": "bytes={start}-".format(start=os.path.getsize(temp_destination))} \
-                    if os.path.exists(temp_destination) else {}
+                    if resume else {}
                 response = _with_retry(
                     lambda: self._requests_session.get(url,
                                                        headers=self._generateSignedHeaders(url, range_header),
@@ -1813,12 +2243,21 @@ class Synapse(object):
                         # and break out of the loop to perform the MD5 check.
                         # If it fails the user can retry with another download.
                         shutil.move(temp_destination, destination)
+                        resumable_md5.remove_checkpoint(temp_destination)
                         break
+                    elif err.response.status_code == 403 and not refreshed and urls.replace(requested_url):
+                        # most likely the URL expired, so resume from a new one, which isn't counted as a redirect
+                        refreshed = True
+                        redirected = False
+                        redirect_count -= 1
+                        continue
                     raise
+                refreshed = False
 
                 # handle redirects
                 if response.status_code in [301, 302, 303, 307, 308]:
                     url = response.headers['location']
+                    redirected = True
                     # don't break, loop again
                 else:
                     # get filename from content-disposition, if we don't have it already
@@ -1840,40 +2279,64 @@ class Synapse(object):
                         previouslyTransferred = os.path.getsize(temp_destination)
                         toBeTransferred += previouslyTransferred
                         transferred += previouslyTransferred
-                        sig = utils.md5_for_file(temp_destination)
+                        if checkpoint is not None:
+                            sig = utils.md5_for_file(temp_destination, md5=checkpoint.md5, offset=checkpoint.offset)
+                        else:
+                            sig = utils.md5_for_file(temp_destination, md5=resumable_md5.new())
                     else:
                         mode = 'wb'
                         previouslyTransferred = 0
-                        sig = hashlib.md5()
+                        sig = resumable_md5.new()
+                        # the file is overwritten, and its checkpoint can't always be saved in place of the old one
+                        resumable_md5.remove_checkpoint(temp_destination)
+                    # the number of bytes in the file that sig has hashed and the number when its state was last
+                    # saved, updated on the writer thread
+                    hashed = [previouslyTransferred, previouslyTransferred]
+                    resumable_md5.save_checkpoint(temp_destination, sig, previouslyTransferred)
+                    t0 = time.time()
+
+                    def written(offset, progress):
+                        hashed[0] = offset
+                        if offset - hashed[1] >= MD5_CHECKPOINT_INTERVAL:
+                            fd.flush()
+                            resumable_md5.save_checkpoint(temp_destination, sig, offset)
+                            hashed[1] = offset
+                        if progress is not None:
+                            utils.printTransferProgress(progress, toBeTransferred, 'Downloading ',
+                                                        os.path.basename(destination), dt=time.time()-t0)
 
                     try:
                         with open(temp_destination, mode) as fd:
-                            t0 = time.time()
-                            for nChunks, chunk in enumerate(response.iter_content(FILE_BUFFER_SIZE)):
-                                fd.write(chunk)
-                                sig.update(chunk)
-
-                                # the 'content-length' header gives the total number of bytes that will be transferred
-                                # to us len(chunk) cannot be used to track progress because iter_content automatically
-                                # decodes the chunks if the response body is encoded so the len(chunk) could be
-                                # different from the total number of bytes we've read read from the response body
-                                # response.raw.tell() is the total number of response body bytes transferred over the
-                                # wire so far
-                                transferred = response.raw.tell() + previouslyTransferred
-                                utils.printTransferProgress(transferred, toBeTransferred, 'Downloading ',
-                                                            os.path.basename(destination), dt=time.time()-t0)
+                            if toBeTransferred > 0:
+                                download_writer.preallocate(fd, int(toBeTransferred))
+                            # the disk writes, MD5 and progress updates happen on the writer's thread, so that they
+                            # don't hold up receiving the file
+                            with download_writer.DownloadWriter(fd, sig, previouslyTransferred,
+                                                                on_written=written) as writer:
+                                for chunk in response.iter_content(FILE_BUFFER_SIZE):
+                                    # the 'content-length' header gives the total number of bytes that will be
+                                    # transferred to us len(chunk) cannot be used to track progress because
+                                    # iter_content automatically decodes the chunks if the response body is encoded so
+                                    # the len(chunk) could be different from the total number of bytes we've read read
+                                    # from the response body response.raw.tell() is the total number of response body
+                                    # bytes transferred over the wire so far
+                                    transferred = response.raw.tell() + previouslyTransferred
+                                    writer.write(chunk, transferred)
                     except Exception as ex:  # We will add a progress parameter then push it back to retry.
                         ex.progress = transferred-previouslyTransferred
+                        resumable_md5.save_checkpoint(temp_destination, sig, hashed[0])
                         raise
 
                     # verify that the file was completely downloaded and retry if it is not complete
                     if toBeTransferred > 0 and transferred < toBeTransferred:
                         self.logger.warning("\nRetrying download because the connection ended early.\n")
+                        resumable_md5.save_checkpoint(temp_destination, sig, hashed[0])
                         continue
 
                     actual_md5 = sig.hexdigest()
                     # rename to final destination
                     shutil.move(temp_destination, destination)
+                    resumable_md5.remove_checkpoint(temp_destination)
                     break
             else:
                 self.logger.error('Unable to download URLs of type %s' % scheme)
@@ -1895,6 +2358,24 @@ class Synapse(object):
 
         return destination
 
+    def _get_url_range(self, url, start, end=None):
+        """
+        Request bytes start through end, inclusive, of the file at the given URL. Servers that support range requests
+        respond with 206 Partial Content, others with the whole file.
+
+        :param end: (optional) the last byte to request. Defaults to the end of the file.
+
+        :returns: a streaming response, which the caller should close
+        """
+        range_header = {"Range": "bytes={start}-{end}".format(start=start, end='' if end is None else end)} \
+            if start or end is not None else {}
+        response = _with_retry(
+            lambda: self._requests_session.get(url, headers=self._generateSignedHeaders(url, range_header),
+                                               stream=True),
+            verbose=self.debug, **STANDARD_RETRY_PARAMS)
+        exceptions._raise_for_status(response, verbose=self.debug)
+        return response
+
     def _createExternalFileHandle(self, externalURL, mimetype=None, md5=None, fileSize=None):
         """Create a new FileHandle representing an external URL."""
 
@@ -1917,7 +2398,7 @@ class Synapse(object):
         file_handle = {'concreteType': 'org.sagebionetworks.repo.model.file.ExternalObjectStoreFileHandle',
                        'fileKey': s3_file_key,
                        'fileName': os.path.basename(file_path),
-                       'contentMd5': utils.md5_for_file(file_path).hexdigest(),
+                       'contentMd5': self.cache.md5_for_file(file_path),
                        'contentSize': os.stat(file_path).st_size,
                        'storageLocationId': storage_location_id,
                        'contentType': mimetype}
@@ -3169,6 +3650,8 @@ class Synapse(object):
 
         :param table:            table query result
         :param columns:           a list of column names as strings
+        :param max_concurrent_batches: the number of zip files of up to max_files_per_request files each that are
+                                       built by the server and downloaded at the same time. Defaults to 3.
 
         :returns: a dictionary from file handle ID to path in the local file system.
 
@@ -3191,6 +3674,7 @@ class Synapse(object):
         RETRIABLE_FAILURE_CODES = ["EXCEEDS_SIZE_LIMIT"]
         MAX_DOWNLOAD_TRIES = 100
         max_files_per_request = kwargs.get('max_files_per_request', 2500)
+        max_concurrent_batches = kwargs.get('max_concurrent_batches', DEFAULT_CONCURRENT_BULK_DOWNLOADS)
         # Rowset tableQuery result not allowed
         if isinstance(table, TableQueryResult):
             raise ValueError("downloadTableColumn doesn't work with rowsets. Please use default tableQuery settings.")
@@ -3206,55 +3690,35 @@ class Synapse(object):
 
         permanent_failures = OrderedDict()
 
+        def download_batch(batch):
+            try:
+                return self._download_table_file_batch(table, batch, RETRIABLE_FAILURE_CODES)
+            except Exception as ex:
+                # returned rather than raised so that the other batches are downloaded and cached first
+                return ex
+
         attempts = 0
         while len(file_handle_associations) > 0 and attempts < MAX_DOWNLOAD_TRIES:
             attempts += 1
 
-            file_handle_associations_batch = file_handle_associations[:max_files_per_request]
-
-            # ------------------------------------------------------------
-            # call async service to build zip file
-            # ------------------------------------------------------------
-
-            # returns a BulkFileDownloadResponse:
-            #   http://docs.synapse.org/rest/org/sagebionetworks/repo/model/file/BulkFileDownloadResponse.html
-            request = dict(
-                concreteType="org.sagebionetworks.repo.model.file.BulkFileDownloadRequest",
-                requestedFiles=file_handle_associations_batch)
-            response = self._waitForAsync(uri='/file/bulk/async', request=request, endpoint=self.fileHandleEndpoint)
-
-            # ------------------------------------------------------------
-            # download zip file
-            # ------------------------------------------------------------
-
-            temp_dir = tempfile.mkdtemp()
-            zipfilepath = os.path.join(temp_dir, "table_file_download.zip")
+            # the batches are downloaded concurrently, so that while one zip file is downloaded and extracted the
+            # server is already building the next ones
+            batches = [file_handle_associations[i:i + max_files_per_request]
+                       for i in range(0, len(file_handle_associations), max_files_per_request)]
+            errors = []
+            mp = pool_provider.get_pool(min(len(batches), max_concurrent_batches))
             try:
-                zipfilepath = self._downloadFileHandle(response['resultZipFileHandleId'], table.tableId, 'TableEntity',
-                                                       zipfilepath)
-                # TODO handle case when no zip file is returned
-                # TODO test case when we give it partial or all bad file handles
-                # TODO test case with deleted fileHandleID
-                # TODO return null for permanent failures
-
-                # ------------------------------------------------------------
-                # unzip into cache
-                # ------------------------------------------------------------
-
-                with zipfile.ZipFile(zipfilepath) as zf:
-                    # the directory structure within the zip follows that of the cache:
-                    # {fileHandleId modulo 1000}/{fileHandleId}/{fileName}
-                    for summary in response['fileSummary']:
-                        if summary['status'] == 'SUCCESS':
-                            cache_dir = self.cache.get_cache_dir(summary['fileHandleId'])
-                            filepath = _extract_zip_file_to_directory(zf, summary['zipEntryName'], cache_dir)
-                            self.cache.add(summary['fileHandleId'], filepath)
-                            file_handle_to_path_map[summary['fileHandleId']] = filepath
-                        elif summary['failureCode'] not in RETRIABLE_FAILURE_CODES:
-                            permanent_failures[summary['fileHandleId']] = summary
+                for result in mp.imap_unordered(download_batch, batches):
+                    if isinstance(result, Exception):
+                        errors.append(result)
+                        continue
+                    extracted, failures = result
+                    file_handle_to_path_map.update(extracted)
+                    permanent_failures.update(failures)
             finally:
-                if os.path.exists(zipfilepath):
-                    os.remove(zipfilepath)
+                mp.terminate()
+            if errors:
+                raise errors[0]
 
             # Do we have remaining files to download?
             file_handle_associations = [fha for fha in file_handle_associations
@@ -3265,6 +3729,62 @@ class Synapse(object):
 
         return file_handle_to_path_map
 
+    def _download_table_file_batch(self, table, file_handle_associations, retriable_failure_codes):
+        """
+        Download the files of a batch of file handle associations of a table as a zip file and extract them into the
+        cache.
+
+        :returns: a tuple of a list of the (file handle id, path) of each file extracted and a dictionary from file
+                  handle id to the FileDownloadSummary of each file that failed for a reason other than one of the
+                  retriable_failure_codes
+        """
+        # ------------------------------------------------------------
+        # call async service to build zip file
+        # ------------------------------------------------------------
+
+        # returns a BulkFileDownloadResponse:
+        #   http://docs.synapse.org/rest/org/sagebionetworks/repo/model/file/BulkFileDownloadResponse.html
+        request = dict(
+            concreteType="org.sagebionetworks.repo.model.file.BulkFileDownloadRequest",
+            requestedFiles=file_handle_associations)
+        response = self._waitForAsync(uri='/file/bulk/async', request=request, endpoint=self.fileHandleEndpoint)
+
+        # ------------------------------------------------------------
+        # download zip file
+        # ------------------------------------------------------------
+
+        temp_dir = tempfile.mkdtemp()
+        zipfilepath = os.path.join(temp_dir, "table_file_download.zip")
+        extracted = []
+        failures = OrderedDict()
+        try:
+            zipfilepath = self._downloadFileHandle(response['resultZipFileHandleId'], table.tableId, 'TableEntity',
+                                                   zipfilepath)
+            # TODO handle case when no zip file is returned
+            # TODO test case when we give it partial or all bad file handles
+            # TODO test case with deleted fileHandleID
+            # TODO return null for permanent failures
+
+            # ------------------------------------------------------------
+            # unzip into cache
+            # ------------------------------------------------------------
+
+            with zipfile.ZipFile(zipfilepath) as zf:
+                # the directory structure within the zip follows that of the cache:
+                # {fileHandleId modulo 1000}/{fileHandleId}/{fileName}
+                for summary in response['fileSummary']:
+                    if summary['status'] == 'SUCCESS':
+                        cache_dir = self.cache.get_cache_dir(summary['fileHandleId'])
+                        filepath = _extract_zip_file_to_directory(zf, summary['zipEntryName'], cache_dir)
+                        extracted.append((summary['fileHandleId'], filepath))
+                    elif summary['failureCode'] not in retriable_failure_codes:
+                        failures[summary['fileHandleId']] = summary
+            self.cache.add_many(extracted)
+        finally:
+            if os.path.exists(zipfilepath):
+                os.remove(zipfilepath)
+        return extracted, failures
+
     def _build_table_download_file_handle_list(self, table, columns):
         # ------------------------------------------------------------
         # build list of file handles to download
@@ -3274,24 +3794,28 @@ class Synapse(object):
             raise ValueError("Columns not found: " + ", ".join('"' + col + '"' for col in cols_not_found))
         col_indices = [i for i, h in enumerate(table.headers) if h.name in columns]
         # see: http://docs.synapse.org/rest/org/sagebionetworks/repo/model/file/BulkFileDownloadRequest.html
-        file_handle_associations = []
-        file_handle_to_path_map = OrderedDict()
-        seen_file_handle_ids = set()  # ensure not sending duplicate requests for the same FileHandle IDs
+        file_handle_ids = OrderedDict()  # ensure not sending duplicate requests for the same FileHandle IDs
         for row in table:
             for col_index in col_indices:
                 file_handle_id = row[col_index]
                 if _is_integer(file_handle_id):
-                    path_to_cached_file = self.cache.get(file_handle_id)
-                    if path_to_cached_file:
-                        file_handle_to_path_map[file_handle_id] = path_to_cached_file
-                    elif file_handle_id not in seen_file_handle_ids:
-                        file_handle_associations.append(dict(
-                            associateObjectType="TableEntity",
-                            fileHandleId=file_handle_id,
-                            associateObjectId=table.tableId))
-                    seen_file_handle_ids.add(file_handle_id)
+                    file_handle_ids[file_handle_id] = None
                 else:
                     warnings.warn("Weird file handle: %s" % file_handle_id)
+
+        # look up all the file handles in the cache at once
+        cached_paths = self.cache.get_many(file_handle_ids)
+        file_handle_associations = []
+        file_handle_to_path_map = OrderedDict()
+        for file_handle_id in file_handle_ids:
+            path_to_cached_file = cached_paths.get(file_handle_id)
+            if path_to_cached_file:
+                file_handle_to_path_map[file_handle_id] = path_to_cached_file
+            else:
+                file_handle_associations.append(dict(
+                    associateObjectType="TableEntity",
+                    fileHandleId=file_handle_id,
+                    associateObjectId=table.tableId))
         return file_handle_associations, file_handle_to_path_map
 
     @memoize
@@ -0,0 +1,108 @@
+"""
+*******************
+Streaming Downloads
+*******************
+
+Reads the contents of a file straight from its download URL, without writing it to disk or adding it to the cache.
+This backs :py:func:`synapseclient.Synapse.iter_bytes` and :py:func:`synapseclient.Synapse.open`.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import io
+
+import requests
+
+from .exceptions import SynapseMd5MismatchError
+
+MAX_RETRIES = 5
+
+
+def iter_file(path, chunk_size):
+    """Yields the contents of a local file in chunks of chunk_size bytes."""
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def iter_url(syn, url, chunk_size, size=None, expected_md5=None, retries=MAX_RETRIES):
+    """
+    Yields the contents of the file at url in chunks of at most chunk_size bytes. A connection that is lost is resumed
+    from where it left off.
+
+    :param syn:          a Synapse object
+    :param url:          the download URL of the file
+    :param chunk_size:   the most bytes in each chunk
+    :param size:         (optional) the size of the file, which is used to notice connections that end early
+    :param expected_md5: (optional) the MD5 of the file. A SynapseMd5MismatchError is raised after the last chunk if
+                         the contents don't match it.
+    :param retries:      the number of times the connection is resumed without progress before giving up
+    """
+    md5 = hashlib.md5()
+    transferred = 0
+    attempts = 0
+    while True:
+        response = syn._get_url_range(url, transferred)
+        # a server that ignores the Range header sends the whole file, so skip what has already been read
+        skip = transferred if response.status_code != 206 else 0
+        progress = transferred
+        try:
+            for chunk in response.iter_content(chunk_size):
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk, skip = chunk[skipped:], skip - skipped
+                    if not chunk:
+                        continue
+                md5.update(chunk)
+                transferred += len(chunk)
+                yield chunk
+            if size is None or transferred >= size:
+                break
+            error = IOError('Connection ended early after %d of %d bytes of %s' % (transferred, size, url))
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as ex:
+            error = ex
+        finally:
+            response.close()
+
+        attempts = 0 if transferred > progress else attempts + 1
+        if attempts > retries:
+            raise error
+        syn.logger.debug("Resuming the download of %s after %d bytes: %s" % (url, transferred, error))
+
+    if expected_md5 and md5.hexdigest() != expected_md5:
+        raise SynapseMd5MismatchError("Downloaded content's md5 {md5} does not match expected MD5 of {expected_md5}"
+                                      .format(md5=md5.hexdigest(), expected_md5=expected_md5))
+
+
+class IteratorReader(io.RawIOBase):
+    """
+    A read only, non seekable file object over an iterator of bytes, such as the one returned by :py:func:`iter_url`.
+    Closing it closes the iterator.
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._leftover:
+            try:
+                self._leftover = next(self._iterator)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._leftover))
+        b[:n] = self._leftover[:n]
+        self._leftover = self._leftover[n:]
+        return n
+
+    def close(self):
+        if not self.closed and hasattr(self._iterator, 'close'):
+            self._iterator.close()
+        super(IteratorReader, self).close()
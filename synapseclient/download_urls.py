@@ -0,0 +1,187 @@
+"""
+*********************
+Download URL Resolver
+*********************
+
+Files are downloaded from pre-signed URLs that Synapse hands out for a file handle and the object it is associated
+with, e.g. a FileEntity. The resolver asks for the URLs of many files with each request to /fileHandle/batch and reuses
+them until they are close to expiring, so that downloading many files doesn't cost an extra request per file.
+End users should not need to use it directly.
+
+A download that takes longer than its URL is valid for swaps the URL for a new one before making a request with it
+once it is about to expire, see :py:class:`RefreshingURL`.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlparse
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import urlparse
+    from urlparse import parse_qs
+
+MAX_BATCH_SIZE = 100  # most files that a single request to /fileHandle/batch may ask for
+EXPIRY_MARGIN = 5*60  # most seconds before a URL expires that it is no longer handed out
+DEFAULT_LIFETIME = 60  # seconds that a URL whose expiry can't be told is reused for
+
+
+def _expiry_and_lifetime(url):
+    query = {key.lower(): values[-1] for key, values in parse_qs(urlparse(url).query).items()}
+    try:
+        for prefix in ('x-amz-', 'x-goog-'):
+            if prefix + 'date' in query and prefix + 'expires' in query:
+                signed = calendar.timegm(time.strptime(query[prefix + 'date'], '%Y%m%dT%H%M%SZ'))
+                lifetime = int(query[prefix + 'expires'])
+                return signed + lifetime, lifetime
+        if 'expires' in query:
+            return int(query['expires']), None
+    except ValueError:
+        pass
+    return None, None
+
+
+def url_expiry(url):
+    """
+    Reads the expiry of a pre-signed URL from its query string, which may be signed with AWS signature version 4 or 2
+    or the equivalent Google Cloud Storage signature.
+
+    :returns: the time at which the URL expires in seconds since the epoch or None if it isn't known
+    """
+    return _expiry_and_lifetime(url)[0]
+
+
+def expiry_margin(url, obtained=None):
+    """
+    :param url:      a pre-signed URL
+    :param obtained: (optional) the time at which the URL was handed out, which tells how long it is valid for if the
+                     URL itself doesn't, as with AWS signature version 2
+
+    :returns: how many seconds before it expires the URL is no longer used: EXPIRY_MARGIN, or half of how long the URL
+              is valid for if that is shorter, so that short lived URLs aren't treated as expired when they're issued
+    """
+    expiry, lifetime = _expiry_and_lifetime(url)
+    if lifetime is None and expiry is not None and obtained is not None:
+        lifetime = expiry - obtained
+    return EXPIRY_MARGIN if lifetime is None else max(min(EXPIRY_MARGIN, lifetime / 2), 0)
+
+
+def expires_soon(url, margin=None, obtained=None):
+    """
+    :param margin:   (optional) seconds, defaults to the :py:func:`expiry_margin` of the URL
+    :param obtained: (optional) the time at which the URL was handed out, see :py:func:`expiry_margin`
+
+    :returns: whether url is known to expire within margin seconds
+    """
+    expiry = url_expiry(url)
+    if expiry is None:
+        return False
+    if margin is None:
+        margin = expiry_margin(url, obtained)
+    return expiry - margin <= time.time()
+
+
+def _key(fileHandleId, objectId, objectType):
+    return str(fileHandleId), str(objectId), objectType
+
+
+class DownloadURLResolver(object):
+    """
+    Resolves file handle associations, (fileHandleId, objectId, objectType) tuples, into the FileResults returned by
+    /fileHandle/batch. Results are kept until their pre-signed URLs are close to expiring. Failures are never kept.
+
+    :param syn: a Synapse object, whose _getFileHandleDownloads makes the requests
+    """
+
+    def __init__(self, syn):
+        self._syn = syn
+        self._results = {}  # association key -> (FileResult, time until which it is handed out)
+        self._lock = threading.Lock()
+
+    def resolve(self, associations):
+        """
+        :param associations: (fileHandleId, objectId, objectType) tuples of any number of files
+
+        :returns: a list of dictionaries with keys fileHandleId, fileHandle and preSignedURL, or failureCode if the
+                  file can't be downloaded, in the same order as associations
+        """
+        keys = [_key(*association) for association in associations]
+        now = time.time()
+        with self._lock:
+            results = {key: self._results[key][0] for key in set(keys)
+                       if key in self._results and self._results[key][1] > now}
+
+        missing = [key for key in OrderedDict.fromkeys(keys) if key not in results]
+        for i in range(0, len(missing), MAX_BATCH_SIZE):
+            batch = missing[i:i + MAX_BATCH_SIZE]
+            file_results = self._syn._getFileHandleDownloads(batch)
+            now = time.time()
+            with self._lock:
+                self._results = {key: value for key, value in self._results.items() if value[1] > now}
+                for key, result in zip(batch, file_results):
+                    results[key] = result
+                    if result.get('failureCode') is None:
+                        self._results[key] = (result, self._usable_until(result, now))
+        return [results[key] for key in keys]
+
+    def forget(self, fileHandleId, objectId, objectType):
+        """Stop handing out the URL of a file, e.g. because downloading from it failed."""
+        with self._lock:
+            self._results.pop(_key(fileHandleId, objectId, objectType), None)
+
+    @staticmethod
+    def _usable_until(result, now):
+        url = result.get('preSignedURL') or ''
+        expiry = url_expiry(url)
+        return now + DEFAULT_LIFETIME if expiry is None else expiry - expiry_margin(url, obtained=now)
+
+
+class RefreshingURL(object):
+    """
+    The pre-signed URL of a file that is being downloaded, which is swapped for a new one when it is about to expire or
+    a request made with it is refused. It can be shared by the threads downloading parts of the same file.
+
+    :param url:      the current URL
+    :param refresh:  (optional) a function that returns a new URL of the same file. Without it, the URL is never
+                     swapped.
+    :param obtained: (optional) when url was handed out, see :py:func:`expiry_margin`
+    """
+
+    def __init__(self, url, refresh=None, obtained=None):
+        self._url = url
+        self._obtained = obtained
+        self._refresh = refresh
+        self._lock = threading.Lock()
+
+    def _swap(self):
+        self._url = self._refresh()
+        self._obtained = time.time()
+
+    def get(self):
+        """:returns: the URL, which is swapped for a new one first if it expires soon, see :py:func:`expires_soon`"""
+        with self._lock:
+            if self._refresh is not None and expires_soon(self._url, obtained=self._obtained):
+                self._swap()
+            return self._url
+
+    def replace(self, rejected_url):
+        """
+        Swap the URL for a new one after a request made with rejected_url was refused, presumably because it expired.
+        The URL is only swapped once when several threads report the same rejected_url.
+
+        :returns: whether there is a new URL to retry with
+        """
+        with self._lock:
+            if self._refresh is None:
+                return False
+            if self._url == rejected_url:
+                self._swap()
+            return True
@@ -0,0 +1,172 @@
+"""
+***************
+Download Writer
+***************
+
+Writes a download to disk on a thread of its own, so that receiving the file doesn't wait on the disk, the MD5 or
+progress updates and writing doesn't wait on the network. The chunks received are gathered into large buffers that
+end on multiples of the buffer size in the file, and are handed to the writer thread through a bounded queue, so memory
+use stays fixed however far the disk falls behind. End users should not need to use it directly.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import sys
+import threading
+
+from six.moves import queue
+
+from .utils import MB
+
+WRITE_BUFFER_SIZE = 8*MB
+MAX_QUEUED_BUFFERS = 4
+# fallocate(2) mode that reserves disk space without changing the size of the file
+FALLOC_FL_KEEP_SIZE = 1
+
+_fallocate_function = None
+_fallocate_loaded = False
+
+
+def _load_fallocate(libc):
+    """
+    :returns: fallocate64, which takes 64 bit offsets on every build, or else fallocate, whose off_t is a long unless
+              the C library was built with 64 bit file offsets, which isn't known here
+    """
+    try:
+        function, off_t = libc.fallocate64, ctypes.c_int64
+    except AttributeError:
+        function, off_t = libc.fallocate, ctypes.c_long
+    function.argtypes = [ctypes.c_int, ctypes.c_int, off_t, off_t]
+    function.restype = ctypes.c_int
+    function.max_offset = 2 ** (8 * ctypes.sizeof(off_t) - 1) - 1
+    return function
+
+
+def _fallocate():
+    global _fallocate_function, _fallocate_loaded
+    if not _fallocate_loaded:
+        _fallocate_loaded = True
+        if sys.platform.startswith('linux'):
+            try:
+                _fallocate_function = _load_fallocate(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True))
+            except (OSError, AttributeError):
+                _fallocate_function = None
+    return _fallocate_function
+
+
+def preallocate(fd, size):
+    """
+    Reserve the disk space for a file that will grow to size bytes, so that it isn't fragmented and a full disk fails
+    the download before it starts. Only Linux can do this without changing the size of the file, which partial
+    downloads are resumed from the end of, so elsewhere nothing is done.
+
+    :param fd:   a file open for writing
+    :param size: the size of the complete file in bytes
+
+    :returns: whether the space was reserved
+    """
+    fallocate = _fallocate()
+    if fallocate is None or size <= 0 or size > fallocate.max_offset:
+        return False
+    try:
+        return fallocate(fd.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) == 0
+    except Exception:
+        # it is only an optimization, e.g. the file may not be a real file
+        return False
+
+
+class DownloadWriter(object):
+    """
+    Writes the chunks given to :py:meth:`write` to a file and adds them to an MD5 on a background thread. Use it as a
+    context manager, which waits for everything to be written on exit.
+
+    :param fd:          a file open for writing at offset
+    :param md5:         the MD5 of the first offset bytes of the file, which is updated with what is written
+    :param offset:      the number of bytes already in the file
+    :param on_written:  (optional) a function called on the writer thread with the number of bytes in the file and
+                        hashed and the progress given with the last chunk written, after each buffer is written
+    :param buffer_size: the size of the writes
+    :param max_queued:  the most buffers waiting to be written
+    """
+
+    def __init__(self, fd, md5, offset, on_written=None, buffer_size=WRITE_BUFFER_SIZE,
+                 max_queued=MAX_QUEUED_BUFFERS):
+        self._fd = fd
+        self._md5 = md5
+        self._on_written = on_written
+        self._buffer_size = buffer_size
+        self._chunks = []
+        self._buffered = 0
+        self._buffered_progress = None
+        # bytes in the file and hashed, updated by the writer thread
+        self.offset = offset
+        # the file offset at the end of the buffered chunks
+        self._end = offset
+        self._queue = queue.Queue(max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_buffers)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # what was received before a failure is still written, so that the download can resume after it
+        self.close(raise_error=exc_type is None)
+
+    def write(self, chunk, progress=None):
+        """
+        :param chunk:    bytes to append to the file
+        :param progress: (optional) passed on to on_written once chunk has been written
+        """
+        if self._error is not None:
+            raise self._error
+        # the progress given with the chunks that are already buffered in full
+        pending_progress = self._buffered_progress
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        self._end += len(chunk)
+        # end each buffer on a multiple of the buffer size, so that writes are aligned after the first one
+        to_boundary = self._buffer_size - (self._end - self._buffered) % self._buffer_size
+        while self._buffered >= to_boundary:
+            data = b''.join(self._chunks)
+            self._queue.put((data[:to_boundary], progress if self._buffered == to_boundary else pending_progress))
+            pending_progress = None
+            self._chunks = [data[to_boundary:]] if self._buffered > to_boundary else []
+            self._buffered -= to_boundary
+            to_boundary = self._buffer_size
+        self._buffered_progress = progress if self._buffered else None
+
+    def close(self, raise_error=True):
+        """Wait for all the chunks to be written."""
+        if self._thread is None:
+            return
+        if self._buffered:
+            self._queue.put((b''.join(self._chunks), self._buffered_progress))
+            self._chunks = []
+            self._buffered = 0
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if raise_error and self._error is not None:
+            raise self._error
+
+    def _write_buffers(self):
+        for data, progress in iter(self._queue.get, None):
+            # after a failure keep taking buffers off the queue, so that write doesn't block on a full queue
+            if self._error is not None:
+                continue
+            try:
+                self._fd.write(data)
+                self._md5.update(data)
+                self.offset += len(data)
+                if self._on_written is not None:
+                    self._on_written(self.offset, progress)
+            except Exception as ex:
+                self._error = ex
@@ -3,18 +3,36 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import contextlib
 import errno
 import os
 import shutil
 import sys
+import threading
 import time
 from datetime import timedelta
 from synapseclient.exceptions import *
 from synapseclient.dozer import doze
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where locks fall back to making directories
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 LOCK_DEFAULT_MAX_AGE = timedelta(seconds=10)
 DEFAULT_BLOCKING_TIMEOUT = timedelta(seconds=70)
 CACHE_UNLOCK_WAIT_TIME = 0.5
+# errors raised by flock on file systems that don't implement it (e.g. some NFS mounts)
+FLOCK_UNSUPPORTED_ERRNOS = {errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL}
+
+# (name, dir) -> [lock, number of threads using it], the thread locks of single_flight
+_single_flight_locks = {}
+_single_flight_locks_lock = threading.Lock()
 
 
 class LockedException(Exception):
@@ -83,6 +101,7 @@ class Lock(object):
         if not lock_acquired:
             raise SynapseFileCacheError("Could not obtain a lock on the file cache within timeout: %s  "
                                         "Please try again later" % str(timeout))
+        return True
 
     def release(self):
         """Release lock or do nothing if lock is not held"""
@@ -100,3 +119,278 @@ class Lock(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
+
+
+class FlockLock(object):
+    """
+    Implements a lock with a kernel advisory lock (flock) on a file named [lockname].flock
+
+    Waiting processes and threads sleep in the kernel until the lock is released rather than polling for it, and the
+    kernel releases the lock when its holder exits, so there are no stale locks to break. In shared mode any number of
+    holders may hold the lock at once, excluding only exclusive holders.
+
+    Clients that don't use flock, such as older versions of this one and the R client, lock the same directories with
+    a :py:class:`Lock`, so exclusive holders take that lock as well to exclude them. If the file system doesn't support
+    flock, the :py:class:`Lock` is used on its own, in which case shared mode is not available.
+    """
+    SUFFIX = 'flock'
+
+    def __init__(self, name, dir=None, shared=False, max_age=LOCK_DEFAULT_MAX_AGE,
+                 default_blocking_timeout=DEFAULT_BLOCKING_TIMEOUT):
+        self.name = name
+        self.held = False
+        self.shared = shared
+        self.dir = dir if dir else os.getcwd()
+        self.lock_file_path = os.path.join(self.dir, ".".join([name, FlockLock.SUFFIX]))
+        self._fd = None
+        self._flock_unsupported = False
+        self._directory_lock = Lock(name, dir=self.dir, max_age=max_age,
+                                    default_blocking_timeout=default_blocking_timeout)
+
+    def _flock(self, blocking):
+        """:returns: whether the flock was acquired, or None if the file system doesn't support flock"""
+        if self._flock_unsupported:
+            return None
+
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, operation if blocking else operation | fcntl.LOCK_NB)
+        except (IOError, OSError) as err:
+            os.close(fd)
+            if err.errno in FLOCK_UNSUPPORTED_ERRNOS:
+                self._flock_unsupported = True
+                return None
+            if err.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            return False
+        self._fd = fd
+        return True
+
+    def _unflock(self):
+        # closing the file releases the flock, the file itself is left in place because removing it would race with
+        # other processes that have it open
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _needs_directory_lock(self):
+        return not self.shared or self._flock_unsupported
+
+    def acquire(self, break_old_locks=True):
+        """Try to acquire lock without waiting. Return True on success or False otherwise"""
+        if not self.held:
+            if self._flock(blocking=False) is False:
+                return False
+            if self._needs_directory_lock() and not self._directory_lock.acquire(break_old_locks):
+                self._unflock()
+                return False
+            self.held = True
+        return self.held
+
+    def blocking_acquire(self, timeout=None, break_old_locks=True):
+        """
+        Wait until the lock is acquired.
+
+        Without a timeout the flock is waited for in the kernel, which can't stall on an abandoned lock because a flock
+        is only held by a live process, and the :py:class:`Lock` for up to its default blocking timeout. With a timeout,
+        the flock is polled for and SynapseFileCacheError is raised if the whole lock isn't acquired within it.
+        """
+        if self.held:
+            return True
+        if timeout is None:
+            self._flock(blocking=True)
+        else:
+            deadline = time.time() + timeout.total_seconds()
+            while self._flock(blocking=False) is False:
+                if time.time() >= deadline:
+                    raise SynapseFileCacheError("Could not obtain a lock on the file cache within timeout: %s  "
+                                                "Please try again later" % str(timeout))
+                doze(CACHE_UNLOCK_WAIT_TIME)
+            # try the directory lock at least once however little of the timeout is left
+            timeout = timedelta(seconds=max(deadline - time.time(), CACHE_UNLOCK_WAIT_TIME))
+        if self._needs_directory_lock():
+            try:
+                self._directory_lock.blocking_acquire(timeout, break_old_locks)
+            except Exception:
+                self._unflock()
+                raise
+        self.held = True
+        return True
+
+    def release(self):
+        """Release lock or do nothing if lock is not held"""
+        if self.held:
+            self._directory_lock.release()
+            self._unflock()
+            self.held = False
+
+    # Make the lock object a Context Manager
+    def __enter__(self):
+        self.blocking_acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ExclusiveFileLock(object):
+    """
+    Implements an exclusive lock on a file named [lockname].flock that the operating system releases when its holder
+    exits, so that it never has to be broken by age however long it is held: a flock, or on Windows a lock on the first
+    byte of the file. The file is removed on release.
+
+    Where the file system supports neither, :py:meth:`acquire` returns None and the lock isn't held.
+    """
+    SUFFIX = 'flock'
+
+    def __init__(self, name, dir=None):
+        self.name = name
+        self.held = False
+        self.dir = dir if dir else os.getcwd()
+        self.lock_file_path = os.path.join(self.dir, ".".join([name, ExclusiveFileLock.SUFFIX]))
+        self._fd = None
+        self._unsupported = fcntl is None and msvcrt is None
+
+    def _lock(self, fd, blocking):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except (IOError, OSError) as err:
+            if err.errno in FLOCK_UNSUPPORTED_ERRNOS:
+                self._unsupported = True
+            elif err.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK, errno.EDEADLK):
+                raise
+            return False
+
+    def _is_current(self, fd):
+        # a holder removes the file when it releases the lock, so a lock taken on a file that was opened before that
+        # is on a file that others no longer find
+        try:
+            opened, current = os.fstat(fd), os.stat(self.lock_file_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+    def acquire(self, blocking=False):
+        """
+        Acquire the lock, waiting for it if blocking.
+
+        :returns: True if the lock is held, False if another holder has it and blocking is False, or None if the file
+                  system doesn't support it
+        """
+        while not self.held:
+            if self._unsupported:
+                return None
+            if not os.path.exists(self.dir):
+                try:
+                    os.makedirs(self.dir)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+            fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+            if not self._lock(fd, blocking):
+                os.close(fd)
+                if self._unsupported:
+                    # nobody can hold a lock on the file, so it isn't needed
+                    self._remove_file()
+                    return None
+                if not blocking:
+                    return False
+                # Windows can't wait for the lock in the kernel
+                doze(CACHE_UNLOCK_WAIT_TIME)
+            elif fcntl is not None and not self._is_current(fd):
+                os.close(fd)
+            else:
+                self._fd = fd
+                self.held = True
+        return True
+
+    def release(self):
+        """Release lock or do nothing if lock is not held"""
+        if not self.held:
+            return
+        if fcntl is not None:
+            # removed while still locked, so that whoever is waiting on it sees that it was removed and opens it again
+            self._remove_file()
+            os.close(self._fd)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            os.close(self._fd)
+            # Windows doesn't remove files that another process has open, which then removes it when it's done
+            self._remove_file()
+        self._fd = None
+        self.held = False
+
+    def _remove_file(self):
+        try:
+            os.remove(self.lock_file_path)
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.EACCES):
+                raise
+
+
+def get_lock(name, dir=None, shared=False):
+    """
+    Get the best available lock for a directory: a :py:class:`FlockLock` where flock is available, otherwise a
+    :py:class:`Lock`.
+
+    :param name:    the name of the lock
+    :param dir:     the directory in which the lock is kept
+    :param shared:  if True, request a shared (read) lock that other shared holders may hold at the same time
+    """
+    if fcntl is not None:
+        return FlockLock(name, dir=dir, shared=shared)
+    return Lock(name, dir=dir)
+
+
+@contextlib.contextmanager
+def single_flight(name, dir):
+    """
+    Let only one thread or process at a time into the block guarded by the lock called name in dir, so that work like
+    downloading a file is done once by whoever gets there first rather than by everyone at the same time.
+
+    Threads of this process wait on an in-memory lock, other processes on an :py:class:`ExclusiveFileLock`, which isn't
+    broken however long the work takes. Where the file system doesn't support that lock, only the threads of this
+    process are kept out.
+
+    :param name: the name of the lock
+    :param dir:  the directory in which the lock is kept
+
+    :returns: a context manager giving True if another thread or process held the lock when it was requested, in which
+              case that one has probably already done the work
+    """
+    key = (name, os.path.abspath(dir))
+    with _single_flight_locks_lock:
+        entry = _single_flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        waited = not entry[0].acquire(False)
+        if waited:
+            entry[0].acquire()
+        try:
+            process_lock = ExclusiveFileLock(name, dir=dir)
+            if process_lock.acquire() is False:
+                waited = True
+                process_lock.acquire(blocking=True)
+            try:
+                yield waited
+            finally:
+                process_lock.release()
+        finally:
+            entry[0].release()
+    finally:
+        with _single_flight_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _single_flight_locks[key]
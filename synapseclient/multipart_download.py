@@ -0,0 +1,201 @@
+"""
+**************************
+Synapse Multipart Download
+**************************
+
+Downloads a large file as byte ranges that are fetched concurrently, each over its own connection, and written into
+place in a temporary file of the full size. A single connection to S3 is limited to a fraction of the throughput that
+several ranged requests achieve. End users should not need to call any of these functions directly.
+
+The parts that have been completed are recorded next to the temporary file, so a download that is interrupted resumes
+with the parts that are still missing.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import json
+import os
+import shutil
+import threading
+import time
+
+from . import pool_provider
+from .exceptions import SynapseHTTPError
+from .resumable_md5 import remove_checkpoint
+from .utils import printTransferProgress, md5_for_file, MB
+
+DEFAULT_THRESHOLD = 128*MB
+DEFAULT_PART_SIZE = 16*MB
+MIN_PART_SIZE = 1*MB
+BUFFER_SIZE = 2*MB
+
+
+class RangeRequestsNotSupportedError(Exception):
+    """Raised when a server ignores the Range header and sends the whole file instead of the requested part."""
+
+
+def part_ranges(size, part_size):
+    """
+    Split a file into parts of at most part_size bytes.
+
+    :returns: a list of (start, end) byte offsets of each part, inclusive, as used in a Range header
+    """
+    if part_size < 1:
+        raise ValueError('Part size must be positive.')
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def progress_filename(temp_destination):
+    return temp_destination + '.progress'
+
+
+def _read_progress(temp_destination, size, part_size):
+    """
+    :returns: the start offsets of the parts already written to temp_destination by an earlier download of the same
+              file in the same parts
+    """
+    try:
+        with open(progress_filename(temp_destination), 'r') as f:
+            progress = json.load(f)
+    except (IOError, OSError, ValueError):
+        return set()
+    if progress.get('size') != size or progress.get('partSize') != part_size \
+            or not os.path.exists(temp_destination) or os.path.getsize(temp_destination) != size:
+        return set()
+    return set(progress.get('completed', []))
+
+
+def _write_progress(temp_destination, size, part_size, completed):
+    with open(progress_filename(temp_destination), 'w') as f:
+        json.dump({'size': size, 'partSize': part_size, 'completed': sorted(completed)}, f)
+
+
+def _remove(path):
+    """
+    :returns: whether path existed
+    """
+    try:
+        os.remove(path)
+        return True
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def discard_partial_download(temp_destination):
+    """
+    Remove what is left of an interrupted parallel download. Its temporary file has gaps where parts are missing, so
+    unlike a partial sequential download it can't be resumed by requesting the bytes after its end.
+
+    :returns: whether there was a parallel download to discard
+    """
+    if _remove(progress_filename(temp_destination)):
+        _remove(temp_destination)
+        remove_checkpoint(temp_destination)
+        return True
+    return False
+
+
+def _download_part(syn, url, temp_destination, start, end):
+    response = syn._get_url_range(url, start, end)
+    try:
+        if response.status_code != 206:
+            raise RangeRequestsNotSupportedError('Expected a partial response for bytes %d-%d of %s but got status %d'
+                                                 % (start, end, url, response.status_code))
+        written = 0
+        with open(temp_destination, 'r+b') as fd:
+            fd.seek(start)
+            for chunk in response.iter_content(BUFFER_SIZE):
+                fd.write(chunk)
+                written += len(chunk)
+    finally:
+        response.close()
+    if written != end - start + 1:
+        raise IOError('Connection ended early: received %d of %d bytes for bytes %d-%d of %s'
+                      % (written, end - start + 1, start, end, url))
+
+
+def download_file(syn, urls, destination, temp_destination, size, part_size=DEFAULT_PART_SIZE):
+    """
+    Download a file in parts of part_size bytes fetched concurrently.
+
+    :param syn:              a Synapse object
+    :param urls:             a :py:class:`synapseclient.download_urls.RefreshingURL` of the file, whose URL is
+                             replaced when it is about to expire or a part is refused with 403 Forbidden. The server
+                             must accept Range headers.
+    :param destination:      path the completed file is moved to
+    :param temp_destination: path the file is written to while downloading
+    :param size:             size of the file in bytes
+    :param part_size:        number of bytes fetched by each request
+
+    :returns: the MD5 of the downloaded file as hex
+
+    On failure, the exception has a progress attribute with the number of bytes downloaded before it happened and the
+    completed parts are kept so that calling this again resumes the download.
+    Raises :py:class:`RangeRequestsNotSupportedError` if the server does not support range requests.
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    completed = _read_progress(temp_destination, size, part_size)
+    if not completed:
+        # make room for the whole file, which parts are written into wherever they belong
+        with open(temp_destination, 'wb') as fd:
+            fd.truncate(size)
+        # the MD5 checkpoint of an earlier sequential download of the file no longer matches it
+        remove_checkpoint(temp_destination)
+        _write_progress(temp_destination, size, part_size, completed)
+
+    parts = part_ranges(size, part_size)
+    remaining = [part for part in parts if part[0] not in completed]
+    previously_transferred = sum(end - start + 1 for start, end in parts if start in completed)
+    transferred = [previously_transferred]
+    lock = threading.Lock()
+    filename = os.path.basename(destination)
+    syn.logger.debug("downloading %s in %d parts of %d bytes, %d of which were downloaded previously"
+                     % (destination, len(parts), part_size, len(parts) - len(remaining)))
+
+    t0 = time.time()
+    printTransferProgress(previously_transferred, size, 'Downloading ', filename)
+
+    def download_part(part):
+        start, end = part
+        try:
+            part_url = urls.get()
+            try:
+                _download_part(syn, part_url, temp_destination, start, end)
+            except SynapseHTTPError as ex:
+                # most likely the URL expired, which isn't a failure as long as there is a new one to use instead
+                if ex.response is None or ex.response.status_code != 403 or not urls.replace(part_url):
+                    raise
+                _download_part(syn, urls.get(), temp_destination, start, end)
+        except Exception as ex:
+            # returned rather than raised so that all other parts finish before the download is abandoned
+            syn.logger.debug("failed to download bytes %d-%d" % (start, end), exc_info=True)
+            return ex
+        with lock:
+            completed.add(start)
+            transferred[0] += end - start + 1
+            _write_progress(temp_destination, size, part_size, completed)
+            printTransferProgress(transferred[0], size, 'Downloading ', filename, dt=time.time() - t0,
+                                  previouslyTransferred=previously_transferred)
+
+    mp = pool_provider.get_pool()
+    try:
+        errors = [error for error in mp.map(download_part, remaining) if error is not None]
+    finally:
+        mp.terminate()
+
+    if errors:
+        error = next((e for e in errors if isinstance(e, RangeRequestsNotSupportedError)), errors[0])
+        error.progress = transferred[0] - previously_transferred
+        raise error
+
+    actual_md5 = md5_for_file(temp_destination).hexdigest()
+    shutil.move(temp_destination, destination)
+    _remove(progress_filename(temp_destination))
+    remove_checkpoint(temp_destination)
+    return actual_md5
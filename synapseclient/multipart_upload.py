@@ -16,16 +16,23 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import str
 
+import contextlib
 import hashlib
 import json
 import math
 import mimetypes
+import mmap
 import os
 import requests
+import tempfile
+import threading
 import time
 import warnings
 from ctypes import c_bool
 
+import six
+from six.moves import queue
+
 from . import pool_provider
 
 try:
@@ -36,15 +43,18 @@ except ImportError:
     from urlparse import parse_qs
 
 from . import exceptions
-from .utils import printTransferProgress, md5_for_file, MB
+from .utils import printTransferProgress, MB
 from .dict_object import DictObject
 from .exceptions import SynapseError
 from .exceptions import SynapseHTTPError
+from .upload_journal import UploadJournal
 from .utils import threadsafe_generator
 
 MAX_NUMBER_OF_PARTS = 10000
 MIN_PART_SIZE = 8*MB
 MAX_RETRIES = 7
+READ_BLOCK_SIZE = 8*MB
+MAX_QUEUED_BLOCKS = 4
 
 
 def find_parts_to_upload(part_status):
@@ -88,9 +98,112 @@ def get_file_chunk(filepath, n, chunksize=8*MB):
 
 def get_data_chunk(data, n, chunksize=8*MB):
     """
-    Return the nth chunk of a buffer.
+    Return the nth chunk of a buffer, as a view of it rather than a copy. It can be used as the body of a request and
+    hashed like bytes.
+    """
+    start = (n-1)*chunksize
+    if six.PY2:
+        # Python 2 can't make a memoryview of a memory mapped file
+        return buffer(data, start, chunksize)  # noqa: F821
+    return memoryview(data)[start: start+chunksize]
+
+
+def _map_file(filepath):
+    """
+    Map a file into memory read only, so that its parts can be uploaded and hashed from views of the mapping by
+    :py:func:`get_data_chunk`, which the operating system pages in and out as needed, instead of reading each part into
+    a new buffer.
+
+    :returns: an mmap of the file, or None if it can't be mapped, e.g. because it is empty
     """
-    return data[(n-1)*chunksize: n*chunksize]
+    with open(filepath, 'rb') as f:
+        try:
+            # the mapping stays open until it and the views of it are no longer referenced, also after f is closed
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError, OverflowError):
+            return None
+
+
+@contextlib.contextmanager
+def _file_chunks(filepath):
+    """
+    A context in which the parts of a file can be uploaded. The mapping of the file is closed on exit, so that the file
+    can be removed afterwards, which Windows doesn't allow while it is mapped.
+
+    :returns: a get_chunk_function for :py:func:`_multipart_upload` that returns views of the mapped file, or reads the
+              parts if it can't be mapped
+    """
+    mapped = _map_file(filepath)
+    if mapped is None:
+        yield lambda n, partSize: get_file_chunk(filepath, n, partSize)
+        return
+    try:
+        yield lambda n, partSize: get_data_chunk(mapped, n, partSize)
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # a view of the mapping is still referenced, it is closed once that is released
+            pass
+
+
+def _read_parts(filepath, part_size, block_size=READ_BLOCK_SIZE, max_queued=MAX_QUEUED_BLOCKS):
+    """
+    Read a file from start to end on a background thread, so that reading the next blocks overlaps with whatever is
+    done with the last one. At most max_queued blocks are read ahead.
+
+    :returns: a generator of (part number, block) tuples, where the blocks of each part of part_size bytes are in order
+              and no block spans two parts
+    """
+    blocks = queue.Queue(max_queued)
+    stopped = threading.Event()
+
+    def read():
+        try:
+            with open(filepath, 'rb') as f:
+                part_number = 1
+                while not stopped.is_set():
+                    part_remaining = part_size
+                    while part_remaining and not stopped.is_set():
+                        data = f.read(min(block_size, part_remaining))
+                        if not data:
+                            blocks.put(None)
+                            return
+                        blocks.put((part_number, data))
+                        part_remaining -= len(data)
+                    part_number += 1
+        except Exception as ex:
+            blocks.put(ex)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        for item in iter(blocks.get, None):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # make room for a block that the reader may be waiting to add, after which it sees that it should stop
+        stopped.set()
+        while not blocks.empty():
+            blocks.get_nowait()
+
+
+def md5s_for_file_and_parts(filepath, part_size):
+    """
+    Calculate the MD5 of a file and those of its parts in a single pass over the file, reading ahead of the hashing.
+
+    :returns: a tuple of the MD5 hex digest of the file and a list of those of its parts of part_size bytes
+    """
+    md5 = hashlib.md5()
+    part_md5s = []
+    for part_number, block in _read_parts(filepath, part_size):
+        if part_number > len(part_md5s):
+            part_md5s.append(hashlib.md5())
+        md5.update(block)
+        part_md5s[-1].update(block)
+    return md5.hexdigest(), [part_md5.hexdigest() for part_md5 in part_md5s]
 
 
 def _start_multipart_upload(syn, filename, md5, fileSize, partSize, contentType, preview=True, storageLocationId=None,
@@ -163,8 +276,25 @@ def _complete_multipart_upload(syn, uploadId):
     return DictObject(**syn.restPUT(uri, endpoint=syn.fileHandleEndpoint))
 
 
-def _put_chunk(url, chunk, verbose=False):
-    response = requests.put(url, data=chunk)
+def new_upload_session(pool_size=pool_provider.DEFAULT_POOL_SIZE):
+    """
+    Create the session that the parts of uploads are PUT to their pre-signed URLs with. It keeps up to pool_size
+    connections to each host open, one for each worker uploading parts, so that later parts and files reuse them
+    instead of making a new TCP connection and TLS handshake for each part. Its connection pools are thread safe.
+
+    :param pool_size: the most connections to keep open to each host
+
+    :returns: a requests Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _put_chunk(url, chunk, verbose=False, session=None):
+    response = (session or requests).put(url, data=chunk)
     try:
         # Make sure requests closes response stream?:
         # see: http://docs.python-requests.org/en/latest/user/advanced/#keep-alive
@@ -175,7 +305,7 @@ def _put_chunk(url, chunk, verbose=False):
     exceptions._raise_for_status(response, verbose=verbose)
 
 
-def multipart_upload(syn, filepath, filename=None, contentType=None, storageLocationId=None, **kwargs):
+def multipart_upload(syn, filepath, filename=None, contentType=None, storageLocationId=None, md5=None, **kwargs):
     """
     Upload a file to a Synapse upload destination in chunks.
 
@@ -186,6 +316,8 @@ def multipart_upload(syn, filepath, filename=None, contentType=None, storageLoca
     :param partSize:            number of bytes per part. Minimum 5MB.
     :param storageLocationId:   a id indicating where the file should be stored.
                                 Retrieved from Synapse's UploadDestination
+    :param md5:                 (optional) the MD5 of the file as hex, if it is already known, e.g. because it was
+                                computed while the file was written
 
     :return: a File Handle ID
 
@@ -201,7 +333,24 @@ def multipart_upload(syn, filepath, filename=None, contentType=None, storageLoca
     fileSize = os.path.getsize(filepath)
     if not filename:
         filename = os.path.basename(filepath)
-    md5 = md5_for_file(filepath).hexdigest()
+    partSize = kwargs.pop('partSize', None)
+    journal = UploadJournal(syn.cache.cache_root_dir, filepath)
+    if md5 is None and journal.md5 is not None and partSize in (None, journal.part_size):
+        # an earlier upload of the unchanged file was interrupted, resume it with the same parts
+        md5, partSize, part_md5s = journal.md5, journal.part_size, journal.part_md5s
+        syn.logger.debug("Resuming upload %s of [%s], %d parts were completed" %
+                         (journal.upload_id, filepath, len(journal.completed_parts)))
+    else:
+        partSize = calculate_part_size(fileSize, partSize, MIN_PART_SIZE, MAX_NUMBER_OF_PARTS)
+        part_md5s = []
+        if md5 is None:
+            # Synapse needs the MD5 of the file to start the upload. If it isn't recorded from an earlier upload or
+            # download, the parts are hashed in the same pass as the file so that they needn't be hashed when uploaded
+            def hash_file(path):
+                file_md5, part_md5s[:] = md5s_for_file_and_parts(path, partSize)
+                return file_md5
+            md5 = syn.cache.md5_for_file(filepath, hash_file=hash_file)
+        journal.record_digests(md5, partSize, part_md5s)
 
     if contentType is None:
         (mimetype, enc) = mimetypes.guess_type(filepath, strict=False)
@@ -211,14 +360,16 @@ def multipart_upload(syn, filepath, filename=None, contentType=None, storageLoca
     syn.logger.debug("Initiating multi-part upload for file: [{path}] size={size} md5={md5}, contentType={contentType}"
                      .format(path=filepath, size=fileSize, md5=md5, contentType=contentType))
 
-    def get_chunk_function(n, partSize): return get_file_chunk(filepath, n, partSize)
-
-    status = _multipart_upload(syn, filename, contentType,
-                               get_chunk_function=get_chunk_function,
-                               md5=md5,
-                               fileSize=fileSize,
-                               storageLocationId=storageLocationId,
-                               **kwargs)
+    with _file_chunks(filepath) as get_chunk_function:
+        status = _multipart_upload(syn, filename, contentType,
+                                   get_chunk_function=get_chunk_function,
+                                   md5=md5,
+                                   fileSize=fileSize,
+                                   partSize=partSize,
+                                   storageLocationId=storageLocationId,
+                                   part_md5s=part_md5s,
+                                   journal=journal,
+                                   **kwargs)
     syn.logger.debug("Completed multi-part upload. Result:%s" % status)
     return status["resultFileHandleId"]
 
@@ -264,8 +415,99 @@ def multipart_upload_string(syn, text, filename=None, contentType=None, storageL
     return status["resultFileHandleId"]
 
 
+def _iter_stream(stream, block_size=READ_BLOCK_SIZE):
+    """
+    :returns: a generator of the bytes read from a file-like object or given by an iterable, with text encoded as UTF-8
+    """
+    blocks = iter(lambda: stream.read(block_size) or None, None) if hasattr(stream, 'read') else stream
+    for block in blocks:
+        if isinstance(block, six.text_type):
+            block = block.encode('utf-8')
+        if block:
+            yield block
+
+
+def multipart_upload_stream(syn, stream, filename, contentType=None, storageLocationId=None, expected_size=None,
+                            **kwargs):
+    """
+    Upload the contents of a file-like object or of an iterable of bytes, e.g. a generator, whose length needn't be
+    known in advance.
+
+    Synapse needs the size and MD5 of a file to start uploading it, so the stream is written to a temporary file in the
+    cache root while it is read, hashing the file and its parts as it goes, and that file is uploaded once the stream
+    ends.
+
+    :param syn:                 a Synapse object
+    :param stream:              a file-like object opened for reading, or an iterable of bytes. Text is encoded as
+                                UTF-8.
+    :param filename:            a string containing the base filename
+    :param contentType:         `contentType`_
+    :param partSize:            number of bytes per part. Minimum 5MB.
+    :param storageLocationId:   a id indicating where the file should be stored.
+                                Retrieved from Synapse's UploadDestination
+    :param expected_size:       (optional) the number of bytes the stream is expected to have, which is used to choose
+                                the part size while the parts are hashed. Streams of more than 80GB need it.
+
+    :return: a File Handle ID
+
+    Keyword arguments are passed down to :py:func:`_multipart_upload` and :py:func:`_start_multipart_upload`.
+
+    .. _contentType: https://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.17
+    """
+    if contentType is None:
+        (mimetype, enc) = mimetypes.guess_type(filename, strict=False)
+        contentType = mimetype or "application/octet-stream"
+    partSize = kwargs.pop('partSize', None)
+    expected_part_size = calculate_part_size(expected_size or 0, partSize, MIN_PART_SIZE, MAX_NUMBER_OF_PARTS)
+
+    fd, spool_path = tempfile.mkstemp(prefix='.upload_stream_', dir=syn.cache.cache_root_dir)
+    try:
+        md5 = hashlib.md5()
+        part_md5s = []
+        fileSize = 0
+        with os.fdopen(fd, 'wb') as f:
+            for block in _iter_stream(stream):
+                while block:
+                    # hash each part separately, splitting the blocks that span two parts
+                    part_remaining = expected_part_size - fileSize % expected_part_size
+                    if part_remaining == expected_part_size:
+                        part_md5s.append(hashlib.md5())
+                    data, block = block[:part_remaining], block[part_remaining:]
+                    f.write(data)
+                    md5.update(data)
+                    part_md5s[-1].update(data)
+                    fileSize += len(data)
+
+        if int(math.ceil(float(fileSize) / expected_part_size)) > MAX_NUMBER_OF_PARTS:
+            # the stream was too long for the part size, the parts are hashed when they're uploaded instead
+            syn.logger.debug("[%s] has %d bytes, more than the %s bytes expected" % (filename, fileSize, expected_size))
+            partSize = calculate_part_size(fileSize, partSize, MIN_PART_SIZE, MAX_NUMBER_OF_PARTS)
+            part_md5s = []
+        else:
+            partSize = expected_part_size
+        md5 = md5.hexdigest()
+        syn.logger.debug("Initiating multi-part upload of stream: [{filename}] size={size} md5={md5}, "
+                         "contentType={contentType}".format(filename=filename, size=fileSize, md5=md5,
+                                                            contentType=contentType))
+
+        # the file is unmapped before it is removed
+        with _file_chunks(spool_path) as get_chunk_function:
+            status = _multipart_upload(syn, filename, contentType,
+                                       get_chunk_function=get_chunk_function,
+                                       md5=md5,
+                                       fileSize=fileSize,
+                                       partSize=partSize,
+                                       storageLocationId=storageLocationId,
+                                       part_md5s=[part_md5.hexdigest() for part_md5 in part_md5s],
+                                       **kwargs)
+    finally:
+        os.remove(spool_path)
+    syn.logger.debug("Completed multi-part upload. Result:%s" % status)
+    return status["resultFileHandleId"]
+
+
 def _upload_chunk(part, completed, status, syn, filename, get_chunk_function,
-                  fileSize, partSize, t0, expired, bytes_already_uploaded=0):
+                  fileSize, partSize, t0, expired, bytes_already_uploaded=0, part_md5s=None, journal=None):
     partNumber = part["partNumber"]
     url = part["uploadPresignedUrl"]
 
@@ -276,22 +518,31 @@ def _upload_chunk(part, completed, status, syn, filename, get_chunk_function,
             syn.logger.debug("part %s is returning early because other parts have already expired" % partNumber)
             return
 
+    chunk = None
     try:
         chunk = get_chunk_function(partNumber, partSize)
         syn.logger.debug("start upload part %s" % partNumber)
-        _put_chunk(url, chunk, syn.debug)
-        syn.logger.debug("PUT upload of part %s complete" % partNumber)
-        # compute the MD5 for the chunk
-        md5 = hashlib.md5()
-        md5.update(chunk)
+        put_started = time.time()
+        _put_chunk(url, chunk, syn.debug, session=syn._upload_session)
+        syn.logger.debug("PUT upload of part %s complete, %d bytes in %.3f seconds"
+                         % (partNumber, len(chunk), time.time() - put_started))
+        # compute the MD5 for the chunk, unless it was computed together with that of the file
+        if part_md5s:
+            part_md5 = part_md5s[partNumber - 1]
+        else:
+            md5 = hashlib.md5()
+            md5.update(chunk)
+            part_md5 = md5.hexdigest()
 
         # confirm that part got uploaded
         syn.logger.debug("contacting Synapse to complete part %s" % partNumber)
         add_part_response = _add_part(syn, uploadId=status.uploadId,
-                                      partNumber=partNumber, partMD5Hex=md5.hexdigest())
+                                      partNumber=partNumber, partMD5Hex=part_md5)
         # if part was successfully uploaded, increment progress
         if add_part_response["addPartState"] == "ADD_SUCCESS":
             syn.logger.debug("finished contacting Synapse about adding part %s" % partNumber)
+            if journal is not None:
+                journal.part_completed(partNumber, part_md5)
             with completed.get_lock():
                 completed.value += len(chunk)
             printTransferProgress(completed.value, fileSize, prefix='Uploading', postfix=filename, dt=time.time()-t0,
@@ -309,10 +560,15 @@ def _upload_chunk(part, completed, status, syn, filename, get_chunk_function,
         # If we are not in verbose debug mode we will swallow the error and retry.
         else:
             syn.logger.debug("Encountered an exception: %s. Retrying...\n" % str(type(ex1)), exc_info=True)
+    finally:
+        if isinstance(chunk, memoryview):
+            # release the view now rather than when the last reference to it, e.g. from a request kept by an
+            # exception, is dropped, so that the mapped file it views can be closed
+            chunk.release()
 
 
-def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileSize, 
-                      partSize=None, storageLocationId=None, **kwargs):
+def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileSize,
+                      partSize=None, storageLocationId=None, part_md5s=None, journal=None, **kwargs):
     """
     Multipart Upload.
 
@@ -320,12 +576,15 @@ def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileS
     :param filename:            a string containing the base filename
     :param contentType:         contentType_
     :param get_chunk_function:  a function that takes a part number and size and returns the bytes of that chunk of the
-                                file
+                                file, or a view of them
     :param md5:                 the part's MD5 as hex.
     :param fileSize:            total number of bytes
     :param partSize:            number of bytes per part. Minimum 5MB.
     :param storageLocationId:   a id indicating where the file should be stored. retrieved from Synapse's
                                 UploadDestination
+    :param part_md5s:           (optional) the MD5s of the parts as hex, in order, if they are already known
+    :param journal:             (optional) an :py:class:`synapseclient.upload_journal.UploadJournal` in which the
+                                progress of the upload is recorded
 
     :return: a MultipartUploadStatus_ object
 
@@ -339,6 +598,9 @@ def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileS
     status = _start_multipart_upload(syn, filename, md5, fileSize, partSize, contentType,
                                      storageLocationId=storageLocationId, **kwargs)
 
+    if journal is not None:
+        journal.started(status.uploadId)
+
     # only force restart once
     kwargs['forceRestart'] = False
 
@@ -366,7 +628,8 @@ def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileS
                                                          get_chunk_function=get_chunk_function,
                                                          fileSize=fileSize, partSize=partSize, t0=time_upload_started,
                                                          expired=expired,
-                                                         bytes_already_uploaded=previously_completed_bytes)
+                                                         bytes_already_uploaded=previously_completed_bytes,
+                                                         part_md5s=part_md5s, journal=journal)
 
             syn.logger.debug("fetching pre-signed urls and mapping to Pool")
             url_generator = _get_presigned_urls(syn, status.uploadId, find_parts_to_upload(status.partsState))
@@ -388,6 +651,8 @@ def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileS
                                      " ({completed} >= {size})".format(completed=completed.value, size=fileSize))
                     status = _complete_multipart_upload(syn, status.uploadId)
                     if status.state == "COMPLETED":
+                        if journal is not None:
+                            journal.remove()
                         break
                 except Exception as ex1:
                     syn.logger.error("Attempt to complete the multipart upload failed with exception %s %s"
@@ -395,6 +660,8 @@ def _multipart_upload(syn, filename, contentType, get_chunk_function, md5, fileS
                     syn.logger.debug("multipart upload failed:", exc_info=True)
     finally:
         mp.terminate()
+        if journal is not None:
+            journal.save()
     if status["state"] != "COMPLETED":
         raise SynapseError("Upload {id} did not complete. Try again.".format(id=status["uploadId"]))
 
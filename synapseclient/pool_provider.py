@@ -24,8 +24,15 @@ DEFAULT_POOL_SIZE = 8
 class SingleThreadPool:
 
     def map(self, func, iterable):
-        for item in iterable:
-            func(item)
+        return [func(item) for item in iterable]
+
+    def imap_unordered(self, func, iterable):
+        return (func(item) for item in iterable)
+
+    def apply_async(self, func, args=(), callback=None):
+        result = func(*args)
+        if callback is not None:
+            callback(result)
 
     def terminate(self):
         pass
@@ -49,11 +56,11 @@ class SingleValue:
     def get_lock(self):
         return FakeLock()
 
-def get_pool():
+def get_pool(size=None):
     if config.single_threaded:
         return SingleThreadPool()
     else:
-        return multiprocessing.dummy.Pool(DEFAULT_POOL_SIZE)
+        return multiprocessing.dummy.Pool(size or DEFAULT_POOL_SIZE)
 
 
 def get_value(type, value):
@@ -0,0 +1,151 @@
+"""
+************
+Remote Files
+************
+
+A seekable, read only file object over a file in Synapse that reads it with HTTP range requests, so that only the parts
+that are read are downloaded. Libraries that take file objects, e.g. pysam or pyarrow, can read just the header of a
+large file or a slice of it this way. See :py:func:`synapseclient.Synapse.open`.
+
+The file is read in blocks, the most recently used of which are kept in memory. Blocks that follow on from the
+previous read are fetched ahead of time together with the block being read.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from .exceptions import SynapseHTTPError
+from .utils import MB
+
+DEFAULT_BLOCK_SIZE = 2*MB
+DEFAULT_CACHE_BLOCKS = 32
+DEFAULT_READ_AHEAD = 2
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    :param syn:          a Synapse object
+    :param get_url:      a function that returns the download URL of the file. It is called with refresh=True when the
+                         URL it returned has expired and should return a new one.
+    :param size:         the size of the file in bytes
+    :param name:         (optional) the name of the file
+    :param block_size:   the number of bytes fetched with each request
+    :param cache_blocks: the most blocks kept in memory
+    :param read_ahead:   the number of blocks after the one being read that are fetched with it on sequential reads
+    """
+
+    def __init__(self, syn, get_url, size, name=None, block_size=DEFAULT_BLOCK_SIZE, cache_blocks=DEFAULT_CACHE_BLOCKS,
+                 read_ahead=DEFAULT_READ_AHEAD):
+        if block_size < 1:
+            raise ValueError('Block size must be positive.')
+        self._syn = syn
+        self._get_url = get_url
+        self._size = size
+        self.name = name
+        self._block_size = block_size
+        self._cache_blocks = max(cache_blocks, read_ahead + 1)
+        self._read_ahead = read_ahead
+        self._blocks = OrderedDict()  # block number -> bytes, least recently used first
+        self._last_block = -1
+        self._position = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError('Invalid whence (%r)' % whence)
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        n = 0
+        # unlike most raw files, fill the whole buffer since readers may not expect short reads
+        while n < len(b) and self._position < self._size:
+            block_number = self._position // self._block_size
+            offset = self._position - block_number * self._block_size
+            data = self._get_block(block_number)[offset:offset + len(b) - n]
+            b[n:n + len(data)] = data
+            n += len(data)
+            self._position += len(data)
+        return n
+
+    def close(self):
+        self._blocks.clear()
+        super(RemoteFile, self).close()
+
+    def _get_block(self, block_number):
+        with self._lock:
+            block = self._blocks.pop(block_number, None)
+            if block is None:
+                last = block_number
+                if block_number == self._last_block + 1:
+                    # reading sequentially, so fetch the next few blocks in the same request
+                    last_in_file = (self._size - 1) // self._block_size
+                    while last < min(block_number + self._read_ahead, last_in_file) and last + 1 not in self._blocks:
+                        last += 1
+                fetched = self._fetch(block_number, last)
+                for number in range(block_number + 1, last + 1):
+                    self._store(number, fetched[(number - block_number) * self._block_size:
+                                                (number - block_number + 1) * self._block_size])
+                block = fetched[:self._block_size]
+            self._store(block_number, block)
+            self._last_block = block_number
+            return block
+
+    def _store(self, block_number, block):
+        self._blocks[block_number] = block
+        while len(self._blocks) > self._cache_blocks:
+            self._blocks.popitem(last=False)
+
+    def _fetch(self, first_block, last_block):
+        start = first_block * self._block_size
+        end = min((last_block + 1) * self._block_size, self._size) - 1
+        self._syn.logger.debug("Fetching bytes %d-%d of %s" % (start, end, self.name))
+        try:
+            response = self._syn._get_url_range(self._get_url(), start, end)
+        except SynapseHTTPError as ex:
+            if ex.response is None or ex.response.status_code != 403:
+                raise
+            # the pre-signed URL has expired
+            response = self._syn._get_url_range(self._get_url(refresh=True), start, end)
+        try:
+            data = response.content
+        finally:
+            response.close()
+        if response.status_code != 206:
+            # the server ignored the Range header and sent the whole file
+            data = data[start:end + 1]
+        if len(data) != end - start + 1:
+            raise IOError('Expected %d bytes of %s but received %d' % (end - start + 1, self.name, len(data)))
+        return data
@@ -0,0 +1,174 @@
+"""
+*************
+Resumable MD5
+*************
+
+A partial download keeps the MD5s of each CHUNK_SIZE bytes of it in a checkpoint next to the file, so that it can be
+checked when the download is resumed. A download that is resumed by the same process, e.g. when it is retried after the
+connection dropped, continues from the MD5 it had when it stopped and only hashes the bytes downloaded since. One that
+is resumed by another process has to hash the partial download again, as hashlib's MD5 can't be saved, and checks each
+chunk against the checkpoint as it goes. The download continues from the first chunk that doesn't match, or isn't in
+the checkpoint, and what follows it is downloaded again.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+from .utils import MB
+
+CHUNK_SIZE = 64*MB
+READ_BLOCK_SIZE = 2*MB
+
+Checkpoint = namedtuple('Checkpoint', ['md5', 'offset'])
+
+# the MD5s of the partial downloads of this process by path, see save_checkpoint
+_md5s = {}
+_md5s_lock = threading.Lock()
+
+
+class ResumableMD5(object):
+    """
+    An MD5 hash like those of hashlib that also keeps the MD5s of each chunk_size bytes it hashes.
+
+    :param chunk_size: the number of bytes of each chunk
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.chunk_digests = []
+        self._md5 = hashlib.md5()
+        self._chunk_md5 = hashlib.md5()
+        self._chunk_length = 0
+
+    def update(self, data):
+        self._md5.update(data)
+        while data:
+            remaining = self.chunk_size - self._chunk_length
+            if len(data) < remaining:
+                self._chunk_md5.update(data)
+                self._chunk_length += len(data)
+                return
+            self._chunk_md5.update(data[:remaining])
+            self.chunk_digests.append(self._chunk_md5.hexdigest())
+            self._chunk_md5 = hashlib.md5()
+            self._chunk_length = 0
+            data = data[remaining:]
+
+    def digest(self):
+        return self._md5.digest()
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+    def copy(self):
+        md5 = ResumableMD5(self.chunk_size)
+        md5.chunk_digests = list(self.chunk_digests)
+        md5._md5 = self._md5.copy()
+        md5._chunk_md5 = self._chunk_md5.copy()
+        md5._chunk_length = self._chunk_length
+        return md5
+
+
+def new():
+    """:returns: a new :py:class:`ResumableMD5`"""
+    return ResumableMD5()
+
+
+def checkpoint_filename(path):
+    return path + '.md5state'
+
+
+def save_checkpoint(path, md5, offset):
+    """
+    Save the MD5s of the chunks of the file at path hashed by md5, the MD5 of its first offset bytes, next to the file
+    and keep md5 itself for resuming the download in this process. Writing the checkpoint is best effort, without it
+    resuming falls back to hashing the file again.
+    """
+    if not isinstance(md5, ResumableMD5):
+        return
+    md5 = md5.copy()
+    try:
+        with open(checkpoint_filename(path), 'w') as f:
+            json.dump({'chunk_size': md5.chunk_size, 'chunks': md5.chunk_digests}, f)
+    except (IOError, OSError):
+        pass
+    with _md5s_lock:
+        _md5s[path] = Checkpoint(md5, offset)
+
+
+def _read_checkpoint(path):
+    try:
+        with open(checkpoint_filename(path), 'r') as f:
+            checkpoint = json.load(f)
+        return int(checkpoint['chunk_size']), list(checkpoint['chunks'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def load_checkpoint(path):
+    """
+    Find the MD5 of the start of a partially downloaded file. If the chunks of the file don't match its checkpoint,
+    the file is truncated after the last one that does, so that the rest is downloaded again.
+
+    :param path: the partially downloaded file
+
+    :returns: a Checkpoint with the MD5 of the first offset bytes of the file or None if none was saved
+    """
+    checkpoint = _read_checkpoint(path)
+    if checkpoint is None:
+        return None
+    chunk_size, chunk_digests = checkpoint
+    size = os.path.getsize(path)
+
+    with _md5s_lock:
+        saved = _md5s.get(path)
+    # the checkpoint is still the one this process saved, so the file wasn't replaced since
+    if saved is not None and saved.md5.chunk_size == chunk_size and saved.md5.chunk_digests == chunk_digests \
+            and saved.offset <= size:
+        return Checkpoint(saved.md5.copy(), saved.offset)
+
+    md5 = ResumableMD5(chunk_size)
+    truncate = False
+    with open(path, 'rb') as f:
+        for chunk_digest in chunk_digests:
+            verified = md5.copy()
+            remaining = chunk_size
+            while remaining > 0:
+                data = f.read(min(READ_BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                md5.update(data)
+                remaining -= len(data)
+            if remaining > 0:
+                # the rest of the file is hashed by the caller
+                md5 = verified
+                break
+            if md5.chunk_digests[-1] != chunk_digest:
+                md5 = verified
+                truncate = True
+                break
+    offset = len(md5.chunk_digests) * chunk_size
+    if truncate:
+        # the rest of the file isn't what was downloaded
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+    return Checkpoint(md5, offset)
+
+
+def remove_checkpoint(path):
+    with _md5s_lock:
+        _md5s.pop(path, None)
+    try:
+        os.remove(checkpoint_filename(path))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -4,7 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
-from .utils import is_url, md5_for_file, as_url, file_url_to_path, id_of
+from .utils import is_url, as_url, file_url_to_path, id_of
 from .constants import concrete_types
 from .remote_file_storage_wrappers import S3ClientWrapper, SFTPWrapper
 from .multipart_upload import multipart_upload
@@ -93,7 +93,7 @@ def create_external_file_handle(syn, path, mimetype=None, md5=None, file_size=No
     if is_url(url):
         parsed_url = urlparse(url)
         if parsed_url.scheme == 'file' and os.path.isfile(parsed_url.path):
-            actual_md5 = md5_for_file(parsed_url.path).hexdigest()
+            actual_md5 = syn.cache.md5_for_file(parsed_url.path)
             if md5 is not None and md5 != actual_md5:
                 raise SynapseMd5MismatchError(
                     "The specified md5 [%s] does not match the calculated md5 [%s] for local file [%s]", md5,
@@ -116,7 +116,7 @@ def upload_external_file_handle_sftp(syn, file_path, sftp_url, mimetype=None):
     uploaded_url = SFTPWrapper.upload_file(file_path, unquote(sftp_url), username, password)
 
     file_handle = syn._createExternalFileHandle(uploaded_url, mimetype=mimetype,
-                                                md5=md5_for_file(file_path).hexdigest(),
+                                                md5=syn.cache.md5_for_file(file_path),
                                                 fileSize=os.stat(file_path).st_size)
     syn.cache.add(file_handle['id'], file_path)
     return file_handle
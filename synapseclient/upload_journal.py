@@ -0,0 +1,161 @@
+"""
+**************
+Upload Journal
+**************
+
+Records the progress of a multipart upload of a local file under the cache root, so that an upload that was
+interrupted, e.g. because the machine it ran on was preempted, is resumed by the next process that uploads the file
+without hashing it again. An entry is kept for each path and only used while the size and modification time of the
+file are unchanged. End users should not need to use it directly.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import utils
+from .cache import _stat_signature
+
+JOURNAL_DIR_NAME = '.uploads'
+SAVE_INTERVAL = 10  # most seconds between saves of the parts completed
+
+
+class UploadJournal(object):
+    """
+    The journal entry of a file. Writing it is best effort, an upload doesn't fail because its journal can't be saved.
+
+    :param cache_root_dir: the root directory of the cache, under which the journal is kept
+    :param path:           the file being uploaded
+    """
+
+    def __init__(self, cache_root_dir, path):
+        self.path = utils.normalize_path(path)
+        self._filename = os.path.join(cache_root_dir, JOURNAL_DIR_NAME,
+                                      hashlib.sha1(self.path.encode('utf-8')).hexdigest() + '.json')
+        self._lock = threading.Lock()
+        self._last_saved = 0
+        # taken before the file is hashed, so that an entry of a file that changed while it was hashed isn't used
+        self._signature = _stat_signature(self.path)
+        self._entry = self._load()
+
+    def _load(self):
+        try:
+            with open(self._filename, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if entry.get('path') != self.path or (entry.get('size'), entry.get('mtimeNs')) != self._signature:
+            return {}
+        return entry
+
+    @property
+    def md5(self):
+        """The MD5 of the file as hex, or None if the file has no entry"""
+        return self._entry.get('md5')
+
+    @property
+    def part_size(self):
+        return self._entry.get('partSize')
+
+    @property
+    def part_md5s(self):
+        """The MD5s of all parts of the file as hex, in order, if they were computed together with that of the file"""
+        return self._entry.get('partMD5s', [])
+
+    @property
+    def upload_id(self):
+        return self._entry.get('uploadId')
+
+    @property
+    def completed_parts(self):
+        """A dictionary from the number of each part known to be uploaded to its MD5"""
+        return {int(part_number): md5 for part_number, md5 in self._entry.get('completedParts', {}).items()}
+
+    def record_digests(self, md5, part_size, part_md5s):
+        """Start the entry of the file with its MD5 and those of its parts, before any part is uploaded."""
+        with self._lock:
+            self._entry = {'path': self.path, 'size': self._signature[0], 'mtimeNs': self._signature[1], 'md5': md5,
+                           'partSize': part_size, 'partMD5s': list(part_md5s), 'uploadId': None, 'completedParts': {}}
+            self._save()
+
+    def started(self, upload_id):
+        """Record the id of the upload that Synapse started or resumed."""
+        with self._lock:
+            if self._entry and self._entry['uploadId'] != upload_id:
+                self._entry['uploadId'] = upload_id
+                self._entry['completedParts'] = {}
+                self._save()
+
+    def part_completed(self, part_number, md5):
+        """Record an uploaded part. The journal is saved at most every SAVE_INTERVAL seconds, see :py:meth:`save`."""
+        with self._lock:
+            if self._entry:
+                self._entry['completedParts'][str(part_number)] = md5
+                if time.time() - self._last_saved >= SAVE_INTERVAL:
+                    self._save()
+
+    def save(self):
+        with self._lock:
+            if self._entry:
+                self._save()
+
+    def remove(self):
+        """Remove the entry once the upload is complete."""
+        with self._lock:
+            self._entry = {}
+            try:
+                os.remove(self._filename)
+            except OSError:
+                # a leftover entry is pruned eventually, see prune
+                pass
+
+    def _save(self):
+        temp_filename = self._filename + '.tmp'
+        try:
+            if not os.path.exists(os.path.dirname(self._filename)):
+                os.makedirs(os.path.dirname(self._filename))
+            with open(temp_filename, 'w') as f:
+                json.dump(self._entry, f)
+            # replace the entry in one step, so that a process that is killed while saving leaves the last one intact
+            getattr(os, 'replace', os.rename)(temp_filename, self._filename)
+            self._last_saved = time.time()
+        except (IOError, OSError):
+            pass
+
+
+def prune(cache_root_dir, before_date, dry_run=False):
+    """
+    Remove the entries of uploads that were last recorded before before_date, e.g. because an interrupted upload was
+    never resumed.
+
+    :param cache_root_dir: the root directory of the cache, under which the journal is kept
+    :param before_date:    seconds since the unix epoch
+    :param dry_run:        if True, only report the entries that would be removed
+
+    :returns: a list of the files of the entries removed, or that would be removed in a dry run
+    """
+    journal_dir = os.path.join(cache_root_dir, JOURNAL_DIR_NAME)
+    try:
+        filenames = os.listdir(journal_dir)
+    except OSError:
+        return []
+    pruned = []
+    for filename in filenames:
+        path = os.path.join(journal_dir, filename)
+        try:
+            if os.path.getmtime(path) >= before_date:
+                continue
+            if not dry_run:
+                os.remove(path)
+            pruned.append(path)
+        except OSError:
+            # removed by another process meanwhile, or can't be
+            pass
+    return pruned
@@ -65,7 +65,7 @@ KB = 2**10
 BUFFER_SIZE = 8*KB
 
 
-def md5_for_file(filename, block_size=2*MB):
+def md5_for_file(filename, block_size=2*MB, md5=None, offset=0):
     """
     Calculates the MD5 of the given file.
     See `source <http://stackoverflow.com/questions/1131220/get-md5-hash-of-a-files-without-open-it-in-python>`_.
@@ -73,11 +73,16 @@ def md5_for_file(filename, block_size=2*MB):
     :param filename:   The file to read in
     :param block_size: How much of the file to read in at once (bytes).
                        Defaults to 2 MB
+    :param md5:        (optional) A hash to update, e.g. one of the first offset bytes of the file.
+                       Defaults to a new MD5
+    :param offset:     Where in the file to start reading.
+                       Defaults to 0
     :returns: The MD5
     """
 
-    md5 = hashlib.md5()
+    md5 = hashlib.md5() if md5 is None else md5
     with open(filename, 'rb') as f:
+        f.seek(offset)
         while True:
             data = f.read(block_size)
             if not data:
@@ -697,6 +702,25 @@ def humanizeBytes(bytes):
     return 'Oops larger than Exabytes'
 
 
+_SIZE_UNITS = {'': 1, 'b': 1, 'bytes': 1, 'k': KB, 'kb': KB, 'm': MB, 'mb': MB, 'g': GB, 'gb': GB,
+               't': 2**40, 'tb': 2**40, 'p': 2**50, 'pb': 2**50}
+
+
+def parse_size(size):
+    """
+    Convert a size such as "500MB" or "1.5 GB" into a number of bytes. Units are powers of 1024, like the ones used by
+    :py:func:`humanizeBytes`, and a number without a unit is taken as bytes.
+
+    :param size: a string or a number of bytes
+    """
+    if isinstance(size, Number):
+        return int(size)
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([a-zA-Z]*)\s*$', size)
+    if not match or match.group(2).lower() not in _SIZE_UNITS:
+        raise ValueError('Invalid size: "%s"' % size)
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
 def touch(path, times=None):
     """
     Make sure a file exists. Update its access and modified times.
@@ -730,12 +754,16 @@ def find_data_file_handle(bundle):
     return None
 
 
-def unique_filename(path):
-    """Returns a unique path by appending (n) for some number n to the end of the filename."""
+def unique_filename(path, reserved_paths=()):
+    """
+    Returns a unique path by appending (n) for some number n to the end of the filename.
+
+    :param reserved_paths: paths to avoid as well as those that exist
+    """
 
     base, ext = os.path.splitext(path)
     counter = 0
-    while os.path.exists(path):
+    while os.path.exists(path) or path in reserved_paths:
         counter += 1
         path = base + ("(%d)" % counter) + ext
 
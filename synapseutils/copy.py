@@ -50,11 +50,12 @@ def copyFileHandles(syn, fileHandles, associateObjectTypes, associateObjectIds,
 
 def _copy_cached_file_handles(cache, copiedFileHandles):
     # type: (Cache , dict) -> None
-    for copy_result in copiedFileHandles['copyResults']:
-        if copy_result.get('failureCode') is None:  # sucessfully copied
-            original_cache_path = cache.get(copy_result['originalFileHandleId'])
-            if original_cache_path:
-                cache.add(copy_result['newFileHandle']['id'], original_cache_path)
+    successful_copies = [copy_result for copy_result in copiedFileHandles['copyResults']
+                         if copy_result.get('failureCode') is None]
+    original_cache_paths = cache.get_many(copy_result['originalFileHandleId'] for copy_result in successful_copies)
+    cache.add_many((copy_result['newFileHandle']['id'], original_cache_paths[copy_result['originalFileHandleId']])
+                   for copy_result in successful_copies
+                   if copy_result['originalFileHandleId'] in original_cache_paths)
 
 
 def changeFileMetaData(syn, entity, downloadAs=None, contentType=None):
@@ -23,7 +23,8 @@ DEFAULT_GENERATED_MANIFEST_KEYS = ['path', 'parent', 'name', 'synapseStore', 'co
                                    'activityName', 'activityDescription']
 
 
-def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFiles=None, followLink=False):
+def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFiles=None, followLink=False,
+                    materialize='copy'):
     """Synchronizes all the files in a folder (including subfolders) from Synapse and adds a readme manifest with file
     metadata.
 
@@ -40,6 +41,11 @@ def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFi
     :param followLink:  Determines whether the link returns the target Entity.
                         Defaults to False
 
+    :param materialize: Determines how files that are already cached are placed in the path. May be "copy",
+                        "reflink", "hardlink" or "symlink". Links avoid duplicating files that are in the cache and
+                        fall back to a copy if the cache is on another file system.
+                        See :py:func:`synapseclient.Synapse.get`. Defaults to "copy".
+
     :returns: list of entities (files, tables, links)
 
     This function will crawl all subfolders of the project/folder specified by `entity` and download all files that have
@@ -67,7 +73,8 @@ def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFi
 
     # perform validation check on user input
     if is_synapse_id(entity):
-        entity = syn.get(entity, downloadLocation=path, ifcollision=ifcollision, followLink=followLink)
+        entity = syn.get(entity, downloadLocation=path, ifcollision=ifcollision, followLink=followLink,
+                         materialize=materialize)
 
     if isinstance(entity, File):
         allFiles.append(entity)
@@ -94,10 +101,12 @@ def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFi
             else:
                 new_path = None
             # recursively explore this container's children
-            syncFromSynapse(syn, child['id'], new_path, ifcollision, allFiles, followLink=followLink)
+            syncFromSynapse(syn, child['id'], new_path, ifcollision, allFiles, followLink=followLink,
+                            materialize=materialize)
         else:
             # getting the child
-            ent = syn.get(child['id'], downloadLocation=path, ifcollision=ifcollision, followLink=followLink)
+            ent = syn.get(child['id'], downloadLocation=path, ifcollision=ifcollision, followLink=followLink,
+                          materialize=materialize)
             if isinstance(ent, File):
                 allFiles.append(ent)
 
@@ -75,11 +75,11 @@ def test_randomly_failing_parts():
 
     normal_put_chunk = None
 
-    def _put_chunk_or_fail_randomly(url, chunk, verbose=False):
+    def _put_chunk_or_fail_randomly(url, chunk, verbose=False, session=None):
         if random.random() < FAILURE_RATE:
             raise IOError("Ooops! Artificial upload failure for testing.")
         else:
-            return normal_put_chunk(url, chunk, verbose)
+            return normal_put_chunk(url, chunk, verbose, session=session)
 
     # Mock _put_chunk to fail randomly
     normal_put_chunk = multipart_upload_module._put_chunk
@@ -6,14 +6,16 @@ import six
 
 import re
 import os
+import sys
 import tempfile
 import time
 import random
 from mock import patch
 from nose.tools import assert_equal, assert_is_none, assert_is_not_none, assert_in, assert_false, assert_true,\
-    assert_less
+    assert_less, assert_raises
 from collections import OrderedDict
 from multiprocessing import Process
+from nose import SkipTest
 
 import synapseclient.cache as cache
 import synapseclient.utils as utils
@@ -55,6 +57,23 @@ def test_cache_concurrent_access():
         assert_equal(process_ids, set(range(20)))
 
 
+def test_shared_read_is_retried_exclusively():
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    cache_dir = my_cache.get_cache_dir(101201)
+    path = utils.normalize_path(os.path.join(cache_dir, "file.txt"))
+    utils.touch(path)
+    my_cache.add(101201, path)
+
+    # a client that locks the cache with a directory only was writing the .cacheMap while it was read
+    read_cache_map = my_cache._read_cache_map
+    with patch.object(my_cache, "_read_cache_map",
+                      side_effect=[ValueError("Expecting ',' delimiter"), read_cache_map(cache_dir)]) as mock_read, \
+            patch.object(my_cache, "_cache_map_lock", wraps=my_cache._cache_map_lock) as mock_lock:
+        assert_equal(path, my_cache.get(101201))
+    assert_equal(2, mock_read.call_count)
+    assert_equal([{'shared': True}, {}], [kwargs for args, kwargs in mock_lock.call_args_list])
+
+
 def test_get_cache_dir():
     tmp_dir = tempfile.mkdtemp()
     my_cache = cache.Cache(cache_root_dir=tmp_dir)
@@ -301,3 +320,484 @@ def test_set_cache_root_dir():
     # test that manually assigning cache_root_dir expands the path
     my_cache.cache_root_dir = non_expanded_path + "2"
     assert_equal(expanded_path + "2", my_cache.cache_root_dir)
+
+
+def add_file_to_indexed_cache(i, cache_root_dir):
+    """
+    Helper function for use in test_sqlite_index_concurrent_access
+    """
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, index=cache.SQLITE_INDEX)
+    file_handle_ids = [1001, 1002, 1003, 1004, 1005]
+    random.shuffle(file_handle_ids)
+    for file_handle_id in file_handle_ids:
+        cache_dir = my_cache.get_cache_dir(file_handle_id)
+        file_path = os.path.join(cache_dir, "file_handle_%d_process_%02d.junk" % (file_handle_id, i))
+        utils.touch(file_path)
+        my_cache.add(file_handle_id, file_path)
+
+
+def test_sqlite_index_concurrent_access():
+    cache_root_dir = tempfile.mkdtemp()
+    processes = [Process(target=add_file_to_indexed_cache, args=(i, cache_root_dir)) for i in range(20)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, index=cache.SQLITE_INDEX)
+    for file_handle_id in [1001, 1002, 1003, 1004, 1005]:
+        process_ids = set()
+        for path in my_cache.index.get_cache_map(file_handle_id):
+            m = re.match("file_handle_%d_process_(\d+).junk" % file_handle_id, os.path.basename(path))
+            if m:
+                process_ids.add(int(m.group(1)))
+        assert_equal(process_ids, set(range(20)))
+
+
+def test_sqlite_index_store_get_remove():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+
+    new_time_stamp = cache._get_modified_time(path1) + 2
+    path2 = utils.touch(os.path.join(tmp_dir, "foo", "file1.ext"), (new_time_stamp, new_time_stamp))
+    my_cache.add(file_handle_id=101201, path=path2)
+
+    # nothing is written next to the cached files
+    assert_false(os.path.exists(os.path.join(my_cache.get_cache_dir(101201), my_cache.cache_map_file_name)))
+
+    assert utils.equal_paths(my_cache.get(file_handle_id=101201), path2)
+    assert utils.equal_paths(my_cache.get(file_handle_id=101201, path=os.path.dirname(path1)), path1)
+    assert_true(my_cache.contains(101201, path1))
+    assert_is_none(my_cache.get(file_handle_id=101202))
+
+    # modified files are dropped from the index when looking in their directory
+    utils.touch(path2, (new_time_stamp + 2, new_time_stamp + 2))
+    assert utils.equal_paths(my_cache.get(file_handle_id=101201, path=os.path.dirname(path2)), path1)
+    assert_false(utils.normalize_path(path2) in my_cache.index.get_cache_map(101201))
+
+    removed = my_cache.remove({'dataFileHandleId': 101201, 'path': path1}, delete=True)
+    assert_equal([utils.normalize_path(path1)], removed)
+    assert_false(os.path.exists(path1))
+    assert_is_none(my_cache.get(file_handle_id=101201))
+
+
+def test_sqlite_index_imports_cache_maps():
+    tmp_dir = tempfile.mkdtemp()
+    legacy_cache = cache.Cache(cache_root_dir=tmp_dir)
+    path1 = utils.touch(os.path.join(legacy_cache.get_cache_dir(101201), "file1.ext"))
+    legacy_cache.add(file_handle_id=101201, path=path1)
+    path2 = utils.touch(os.path.join(tmp_dir, "elsewhere", "file2.ext"))
+    legacy_cache.add(file_handle_id=101202, path=path2)
+
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+    assert utils.equal_paths(my_cache.get(file_handle_id=101201), path1)
+    assert utils.equal_paths(my_cache.get(file_handle_id=101202), path2)
+    assert_is_not_none(my_cache.index.get_metadata(cache.CACHE_MAPS_IMPORTED_KEY))
+
+    # the import only happens once, later changes to .cacheMap files are not picked up
+    legacy_cache.remove(101202)
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+    assert utils.equal_paths(my_cache.get(file_handle_id=101202), path2)
+
+
+def test_sqlite_index_purge():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+
+    assert_equal([], my_cache.purge(time.time() - 60).purged)
+    assert_equal([my_cache.get_cache_dir(101201)], my_cache.purge(time.time() + 60).purged)
+    assert_false(os.path.exists(path1))
+    assert_equal({}, my_cache.index.get_cache_map(101201))
+
+
+def test_unknown_cache_index():
+    assert_raises(ValueError, cache.Cache, cache_root_dir=tempfile.mkdtemp(), index="leveldb")
+
+
+def _test_get_many_add_many(index):
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index)
+
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    path2 = utils.touch(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"))
+    path3 = utils.touch(os.path.join(tmp_dir, "elsewhere", "file2.ext"))
+    my_cache.add_many([(101201, path1), ('101202', path2), (101202, path3)])
+
+    assert_equal(my_cache.get(101201), utils.normalize_path(path1))
+    assert_in(my_cache.get(101202), [utils.normalize_path(path2), utils.normalize_path(path3)])
+
+    # modified files are not returned
+    new_time_stamp = cache._get_modified_time(path1) + 2
+    utils.touch(path1, (new_time_stamp, new_time_stamp))
+
+    cached = my_cache.get_many(['101202', 101201, 101203, '101202'])
+    assert_equal(['101202'], list(cached.keys()))
+    assert_equal(my_cache.get(101202), cached['101202'])
+
+    assert_equal({}, my_cache.get_many([]))
+    assert_raises(ValueError, my_cache.add_many, [(101204, os.path.join(tmp_dir, "does_not_exist"))])
+
+
+def test_get_many_add_many():
+    for index in cache.INDEX_TYPES:
+        yield _test_get_many_add_many, index
+
+
+def _write_file(path, size):
+    utils.touch(path)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+
+def test_max_size_evicts_least_recently_used():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, max_size='250 bytes')
+    assert_is_not_none(my_cache.index)
+
+    path1 = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 100)
+    path2 = _write_file(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"), 100)
+    my_cache.add(101201, path1)
+    my_cache.add(101202, path2)
+    # files outside of the cache root are never evicted and don't count towards the max_size
+    path3 = _write_file(os.path.join(tempfile.mkdtemp(), "file3.ext"), 1000)
+    my_cache.add(101203, path3)
+
+    # reading the older file makes the other one the least recently used
+    with patch.object(time, "time", return_value=time.time() + 10):
+        assert_equal(my_cache.get(101201), utils.normalize_path(path1))
+
+    with patch.object(time, "time", return_value=time.time() + 20):
+        path4 = _write_file(os.path.join(my_cache.get_cache_dir(101204), "file4.ext"), 100)
+        my_cache.add(101204, path4)
+
+    assert_false(os.path.exists(path2))
+    assert_is_none(my_cache.get(101202))
+    for path in (path1, path3, path4):
+        assert_true(os.path.exists(path))
+
+    stats = my_cache.stats()
+    assert_equal(2, stats['file_count'])
+    assert_equal(200, stats['size'])
+    assert_equal(250, stats['max_size'])
+    assert_equal(cache.SQLITE_INDEX, stats['index'])
+
+    # a file bigger than the max_size is kept when it is added but is the first to go
+    path5 = _write_file(os.path.join(my_cache.get_cache_dir(101205), "file5.ext"), 300)
+    my_cache.add_many([(101205, path5)])
+    assert_true(os.path.exists(path5))
+    assert_equal(300, my_cache.stats()['size'])
+
+
+def test_max_size_evicts_by_accesses_made_before_it_was_set():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+    path1 = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 100)
+    path2 = _write_file(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"), 100)
+    my_cache.add(101201, path1)
+    my_cache.add(101202, path2)
+    with patch.object(time, "time", return_value=time.time() + 10):
+        assert_equal({101201: utils.normalize_path(path1)}, my_cache.get_many([101201]))
+
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, max_size='250 bytes')
+    with patch.object(time, "time", return_value=time.time() + 20):
+        path3 = _write_file(os.path.join(my_cache.get_cache_dir(101203), "file3.ext"), 100)
+        my_cache.add(101203, path3)
+
+    assert_false(os.path.exists(path2))
+    assert_true(os.path.exists(path1))
+    assert_true(os.path.exists(path3))
+
+
+def test_max_size_requires_sqlite_index():
+    assert_raises(ValueError, cache.Cache, cache_root_dir=tempfile.mkdtemp(), index=cache.CACHE_MAP_INDEX,
+                  max_size=1000)
+    assert_raises(ValueError, cache.Cache, cache_root_dir=tempfile.mkdtemp(), max_size="lots")
+
+
+def test_stats_counts_imported_files():
+    tmp_dir = tempfile.mkdtemp()
+    legacy_cache = cache.Cache(cache_root_dir=tmp_dir)
+    path1 = _write_file(os.path.join(legacy_cache.get_cache_dir(101201), "file1.ext"), 10)
+    legacy_cache.add(101201, path1)
+    legacy_stats = legacy_cache.stats()
+    assert_equal(cache.CACHE_MAP_INDEX, legacy_stats['index'])
+    assert_is_none(legacy_stats['size'])
+
+    stats = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX).stats()
+    assert_equal(1, stats['file_count'])
+    assert_equal(10, stats['size'])
+    assert_is_none(stats['max_size'])
+
+
+def test_get_by_md5():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX)
+    path1 = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, path1, md5="f00")
+    assert_equal(utils.normalize_path(path1), my_cache.get_by_md5("f00"))
+    assert_is_none(my_cache.get_by_md5("ba7"))
+    assert_is_none(my_cache.get_by_md5(None))
+
+    # entries added without an MD5 take the one already known for the file handle
+    path2 = _write_file(os.path.join(tmp_dir, "elsewhere", "file1.ext"), 10)
+    new_time_stamp = cache._get_modified_time(path1) + 2
+    utils.touch(path2, (new_time_stamp, new_time_stamp))
+    my_cache.add(101201, path2)
+    assert_equal(utils.normalize_path(path2), my_cache.get_by_md5("f00"))
+
+    # modified files are not returned
+    utils.touch(path2, (new_time_stamp + 2, new_time_stamp + 2))
+    assert_equal(utils.normalize_path(path1), my_cache.get_by_md5("f00"))
+
+    # the MD5 is only kept by the sqlite index
+    legacy_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    legacy_cache.add(101201, path1, md5="f00")
+    assert_is_none(legacy_cache.get_by_md5("f00"))
+
+
+def test_clone_file():
+    tmp_dir = tempfile.mkdtemp()
+    source = _write_file(os.path.join(tmp_dir, "source.ext"), 10)
+    destination = os.path.join(tmp_dir, "a", "b", "destination.ext")
+
+    with patch.object(cache, "_reflink", side_effect=OSError(95, "Operation not supported")):
+        assert_equal("copy", cache.clone_file(source, destination))
+        assert_false(os.path.samefile(source, destination))
+
+        if hasattr(os, 'link'):
+            assert_equal("hardlink", cache.clone_file(source, destination, hardlink=True))
+            assert_true(os.path.samefile(source, destination))
+
+    assert_in(cache.clone_file(source, destination), ["reflink", "copy"])
+    with open(destination, 'rb') as f:
+        assert_equal(b'x' * 10, f.read())
+
+
+def test_materialize():
+    tmp_dir = tempfile.mkdtemp()
+    source = _write_file(os.path.join(tmp_dir, "source.ext"), 10)
+    source_mtime = cache._get_modified_time(source)
+    destination = os.path.join(tmp_dir, "a", "destination.ext")
+
+    assert_equal("copy", cache.materialize(source, destination))
+    assert_false(os.path.samefile(source, destination))
+
+    if hasattr(os, 'symlink'):
+        assert_equal("symlink", cache.materialize(source, destination, "symlink"))
+        assert_true(os.path.islink(destination))
+        # the link stands in for the cached file when checking whether it was modified
+        assert_equal(source_mtime, cache._get_modified_time(destination))
+
+    if hasattr(os, 'link'):
+        assert_equal("hardlink", cache.materialize(source, destination, "hardlink"))
+        assert_false(os.path.islink(destination))
+        assert_true(os.path.samefile(source, destination))
+
+    # e.g. the cache and the destination are on different file systems
+    with patch.object(os, "link", side_effect=OSError(18, "Invalid cross-device link")):
+        assert_equal("copy", cache.materialize(source, destination, "hardlink"))
+        assert_false(os.path.samefile(source, destination))
+
+    assert_equal(source_mtime, cache._get_modified_time(source))
+    assert_raises(ValueError, cache.materialize, source, destination, "teleport")
+
+
+def _test_md5_for_file(index):
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index)
+    path = _write_file(os.path.join(tmp_dir, "elsewhere", "file.ext"), 10)
+    expected_md5 = utils.md5_for_file(path).hexdigest()
+
+    assert_is_none(my_cache.get_md5(path))
+    with patch.object(utils, "md5_for_file", wraps=utils.md5_for_file) as mocked_md5_for_file:
+        assert_equal(expected_md5, my_cache.md5_for_file(path))
+        assert_equal(expected_md5, my_cache.md5_for_file(path))
+        assert_equal(expected_md5, my_cache.get_md5(path))
+        assert_equal(1, mocked_md5_for_file.call_count)
+
+        # a new version of the file is hashed again
+        _write_file(path, 20)
+        new_time_stamp = cache._get_modified_time(path) + 2
+        utils.touch(path, (new_time_stamp, new_time_stamp))
+        assert_is_none(my_cache.get_md5(path))
+        assert_equal(utils.md5_for_file(path).hexdigest(), my_cache.md5_for_file(path))
+        assert_equal(3, mocked_md5_for_file.call_count)
+
+        # the MD5 of a file handle added with the file is taken as the MD5 of the file
+        my_cache.add(101201, path, md5="f00")
+        assert_equal("f00", my_cache.md5_for_file(path))
+        assert_equal(3, mocked_md5_for_file.call_count)
+
+    assert_is_none(my_cache.get_md5(os.path.join(tmp_dir, "does_not_exist")))
+
+
+def test_md5_for_file():
+    for index in cache.INDEX_TYPES:
+        yield _test_md5_for_file, index
+
+
+def test_sqlite_index_keeps_md5s():
+    tmp_dir = tempfile.mkdtemp()
+    path = _write_file(os.path.join(tmp_dir, "elsewhere", "file.ext"), 10)
+    md5 = cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX).md5_for_file(path)
+    assert_equal(md5, cache.Cache(cache_root_dir=tmp_dir, index=cache.SQLITE_INDEX).get_md5(path))
+
+
+def test_purge():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+    path2 = utils.touch(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"))
+    my_cache.add(file_handle_id=101202, path=path2)
+    old_time_stamp = time.time() - 3600
+    os.utime(os.path.join(my_cache.get_cache_dir(101202), my_cache.cache_map_file_name),
+             (old_time_stamp, old_time_stamp))
+    # not a cache directory
+    utils.touch(os.path.join(tmp_dir, "notes", "file3.ext"))
+    # an abandoned upload
+    journal = utils.touch(os.path.join(tmp_dir, ".uploads", "0123abcd.json"))
+    os.utime(journal, (old_time_stamp, old_time_stamp))
+
+    progress = []
+    results = my_cache.purge(time.time() - 60, dry_run=True, progress=lambda results: progress.append(results.scanned))
+    assert_true(results.dry_run)
+    assert_equal(2, results.scanned)
+    assert_equal([my_cache.get_cache_dir(101202)], results.purged)
+    assert_equal([], results.errors)
+    assert_equal([1, 2], progress)
+    assert_equal([journal], results.purged_journals)
+    assert_true(os.path.exists(path2))
+    assert_true(os.path.exists(journal))
+
+    results = my_cache.purge(time.time() - 60)
+    assert_equal([my_cache.get_cache_dir(101202)], results.purged)
+    assert_false(os.path.exists(path2))
+    assert_equal([journal], results.purged_journals)
+    assert_false(os.path.exists(journal))
+    assert_true(os.path.exists(path1))
+    assert_true(os.path.exists(os.path.join(tmp_dir, "notes", "file3.ext")))
+
+
+def _test_verify(index):
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index)
+    path1 = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, path1, md5=utils.md5_for_file(path1).hexdigest())
+    path2 = _write_file(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"), 10)
+    my_cache.add(101202, path2, md5="f00")
+    path3 = _write_file(os.path.join(tmp_dir, "elsewhere", "file3.ext"), 10)
+    my_cache.add(101202, path3)
+    path4 = _write_file(os.path.join(my_cache.get_cache_dir(101204), "file4.ext"), 10)
+    my_cache.add(101204, path4)
+
+    new_time_stamp = cache._get_modified_time(path3) + 2
+    utils.touch(path3, (new_time_stamp, new_time_stamp))
+    os.remove(path4)
+
+    results = my_cache.verify(dry_run=True)
+    assert_equal(4, results.scanned)
+    assert_equal(2, results.valid)
+    assert_equal({(utils.normalize_path(path3), 'modified'), (utils.normalize_path(path4), 'missing')},
+                 set((invalid.path, invalid.reason) for invalid in results.invalid))
+    assert_true(my_cache.contains(101204, path4) is False)
+    assert_in(utils.normalize_path(path4), my_cache._get_cache_map(101204))
+
+    results = my_cache.verify(check_md5=True)
+    expected_invalid = {utils.normalize_path(path3), utils.normalize_path(path4)}
+    if index == cache.SQLITE_INDEX:
+        # the MD5 of the file handle is only kept by the sqlite index
+        expected_invalid.add(utils.normalize_path(path2))
+    assert_equal(expected_invalid, set(invalid.path for invalid in results.invalid))
+    assert_equal({}, my_cache._get_cache_map(101204))
+
+    results = my_cache.verify()
+    assert_equal([], results.invalid)
+    assert_equal(results.scanned, results.valid)
+
+
+def test_verify():
+    for index in cache.INDEX_TYPES:
+        yield _test_verify, index
+
+
+def _test_counters(index):
+    tmp_dir = tempfile.mkdtemp()
+    metrics = []
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index,
+                           metrics_callback=lambda name, value: metrics.append((name, value)))
+    path1 = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, path1)
+    path2 = _write_file(os.path.join(tmp_dir, "elsewhere", "file1.ext"), 20)
+    new_time_stamp = cache._get_modified_time(path1) + 2
+    utils.touch(path2, (new_time_stamp, new_time_stamp))
+    my_cache.add(101201, path2)
+    utils.touch(path2, (new_time_stamp + 2, new_time_stamp + 2))
+
+    assert_equal(utils.normalize_path(path1), my_cache.get(101201))
+    assert_is_none(my_cache.get(101202))
+    my_cache.get_many([101201, 101203])
+
+    stats = my_cache.stats()
+    assert_equal(2, stats['hits'])
+    assert_equal(2, stats['misses'])
+    # the modified file is passed over by both hits
+    assert_equal(2, stats['stale_entries'])
+    assert_equal(20, stats['bytes_served'])
+    assert_true(stats['map_read_time'] > 0)
+    assert_true(stats['map_write_time'] > 0)
+    if index == cache.CACHE_MAP_INDEX:
+        assert_true(stats['lock_wait_time'] > 0)
+
+    for counter in cache.COUNTERS:
+        assert_equal(stats[counter], sum(value for name, value in metrics if name == counter))
+
+
+def test_counters():
+    for index in cache.INDEX_TYPES:
+        yield _test_counters, index
+
+
+def _test_read_only_tiers(index):
+    if index == cache.SQLITE_INDEX and sys.version_info < (3, 4):
+        raise SkipTest("Opening a cache index read-only requires Python 3.4")
+    shared_dir = tempfile.mkdtemp()
+    shared_cache = cache.Cache(cache_root_dir=shared_dir, index=index)
+    shared_path = _write_file(os.path.join(shared_cache.get_cache_dir(101201), "file1.ext"), 10)
+    shared_cache.add(101201, shared_path)
+    shared_path2 = _write_file(os.path.join(shared_cache.get_cache_dir(101202), "file2.ext"), 10)
+    shared_cache.add(101202, shared_path2)
+    files_before = sorted(os.listdir(shared_cache.get_cache_dir(101201)))
+
+    local_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=local_dir, read_only_roots=[tempfile.mkdtemp(), shared_dir])
+    assert_equal(utils.normalize_path(shared_path), my_cache.get(101201))
+    assert_equal({101202: utils.normalize_path(shared_path2)}, my_cache.get_many([101202, 101203]))
+    assert_is_none(my_cache.get(101203))
+
+    # the local tier is looked in first
+    local_path = _write_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, local_path)
+    assert_equal(utils.normalize_path(local_path), my_cache.get(101201))
+
+    # the read-only tier is left untouched
+    assert_equal(files_before, sorted(os.listdir(shared_cache.get_cache_dir(101201))))
+
+    promoting_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), read_only_roots=[shared_dir], promote=True)
+    promoted_path = promoting_cache.get(101202)
+    assert_true(promoted_path.startswith(utils.normalize_path(promoting_cache.cache_root_dir)))
+    assert_true(promoting_cache.contains(101202, promoted_path))
+    assert_equal(promoted_path, promoting_cache.get(101202))
+
+
+def test_read_only_tiers():
+    for index in cache.INDEX_TYPES:
+        yield _test_read_only_tiers, index
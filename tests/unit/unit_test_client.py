@@ -1,6 +1,8 @@
 import os
 import json
 import tempfile
+import threading
+import time
 import base64
 from mock import patch, call, create_autospec
 
@@ -146,7 +148,7 @@ class TestPrivateGetWithEntityBundle:
         if os.path.exists(cacheMap):
             os.remove(cacheMap)
 
-        def _downloadFileHandle(fileHandleId,  objectId, objectType, path, retries=5):
+        def _downloadFileHandle(fileHandleId,  objectId, objectType, path, retries=5, expected_md5=None):
             # touch file at path
             with open(path, 'a'):
                 os.utime(path, None)
@@ -1053,4 +1055,123 @@ class TestMembershipInvitation:
             patch_get_invites.assert_called_once_with(self.team.id)
             patch_delete.assert_called_once_with(open_invitations['id'])
             assert_equal(invite, self.response)
-            patch_invitation.assert_called_once()
\ No newline at end of file
+            patch_invitation.assert_called_once()
+
+class TestGetMany:
+    def setup(self):
+        self.bundles = {
+            'syn1': {'entity': {'id': 'syn1', 'name': 'file1', 'dataFileHandleId': '101', 'parentId': 'syn10',
+                                'concreteType': 'org.sagebionetworks.repo.model.FileEntity'},
+                     'fileHandles': [{'id': '101', 'fileName': 'file1', 'contentMd5': 'abc',
+                                      'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle'}],
+                     'annotations': {}, 'restrictionInformation': {'hasUnmetAccessRequirement': False}},
+            'syn2': {'entity': {'id': 'syn2', 'name': 'folder', 'parentId': 'syn10',
+                                'concreteType': 'org.sagebionetworks.repo.model.Folder'},
+                     'fileHandles': [], 'annotations': {},
+                     'restrictionInformation': {'hasUnmetAccessRequirement': False}}}
+        self.file_result = {'fileHandleId': '101', 'preSignedURL': 'https://foo.com/file1', 'fileHandle': {}}
+
+    def _getEntityBundle(self, entity):
+        if entity not in self.bundles:
+            raise SynapseHTTPError('404 Client Error: Not Found')
+        return self.bundles[entity]
+
+    def test_getMany(self):
+        with patch.object(syn, "_getEntityBundle", side_effect=self._getEntityBundle), \
+                patch.object(syn.cache, "get", return_value=None), \
+                patch.object(syn._download_urls, "resolve",
+                             return_value=[self.file_result]) as mock_resolve, \
+                patch.object(syn, "_download_file_entity") as mock_download_file_entity:
+            results = {result.id: result for result in syn.getMany(['syn1', 'syn2', 'syn3'], downloadLocation='/tmp')}
+
+        assert_equal({'syn1', 'syn2', 'syn3'}, set(results))
+        assert_is_none(results['syn1'].error)
+        assert_equal('file1', results['syn1'].entity.name)
+        assert_is_none(results['syn2'].error)
+        assert_equal('folder', results['syn2'].entity.name)
+        assert_is_none(results['syn3'].entity)
+        assert_true(isinstance(results['syn3'].error, SynapseHTTPError))
+
+        # the URLs of all files are fetched together and the folder isn't downloaded
+        mock_resolve.assert_called_once_with([('101', 'syn1', 'FileEntity')])
+        mock_download_file_entity.assert_called_once()
+        args = mock_download_file_entity.call_args[0]
+        assert_equal(('/tmp', results['syn1'].entity, None, None, 'copy'), args[:5])
+        # where the file goes is decided before it is downloaded
+        location, path, cached_path = args[5]
+        assert_equal('/tmp', location)
+        assert_equal(os.path.join('/tmp', 'file1'), os.path.splitext(path)[0].split('(')[0])
+        assert_is_none(cached_path)
+
+    def test_getMany__download_error(self):
+        with patch.object(syn, "_getEntityBundle", side_effect=self._getEntityBundle), \
+                patch.object(syn.cache, "get", return_value='/tmp/file1'), \
+                patch.object(syn, "_getFileHandleDownloads") as mock_get_file_handle_downloads, \
+                patch.object(syn, "_download_file_entity", side_effect=IOError("disk full")):
+            results = list(syn.getMany(['syn1'], downloadFile=True))
+
+        # a cached file doesn't need a URL
+        mock_get_file_handle_downloads.assert_not_called()
+        assert_equal(1, len(results))
+        assert_equal('syn1', results[0].entity.id)
+        assert_true(isinstance(results[0].error, IOError))
+
+    def _add_file_bundle(self, synapse_id, file_handle_id, file_name):
+        bundle = json.loads(json.dumps(self.bundles['syn1']))
+        bundle['entity'].update(id=synapse_id, dataFileHandleId=file_handle_id)
+        bundle['fileHandles'][0].update(id=file_handle_id, fileName=file_name)
+        self.bundles[synapse_id] = bundle
+
+    def test_getMany__files_with_the_same_name(self):
+        self._add_file_bundle('syn4', '104', 'README.txt')
+        self._add_file_bundle('syn5', '105', 'README.txt')
+        download_dir = tempfile.mkdtemp()
+
+        def download(file_handle_id, object_id, object_type, destination, expected_md5=None):
+            # let the downloads overlap
+            time.sleep(0.1)
+            with open(destination, 'w') as f:
+                f.write(object_id)
+            return destination
+
+        with patch.object(synapseclient.config, "single_threaded", False), \
+                patch.object(syn, "_getEntityBundle", side_effect=self._getEntityBundle), \
+                patch.object(syn.cache, "get", return_value=None), \
+                patch.object(syn._download_urls, "resolve"), \
+                patch.object(syn, "_downloadFileHandle", side_effect=download):
+            results = list(syn.getMany(['syn4', 'syn5'], downloadLocation=download_dir))
+
+        paths = {result.id: result.entity.path for result in results}
+        assert_equal({os.path.join(download_dir, 'README.txt'), os.path.join(download_dir, 'README(1).txt')},
+                     set(paths.values()))
+        for synapse_id, path in paths.items():
+            with open(path) as f:
+                assert_equal(synapse_id, f.read())
+
+    def test_getMany__fetches_while_downloading(self):
+        self._add_file_bundle('syn4', '104', 'file4')
+        self._add_file_bundle('syn5', '105', 'file5')
+        fetched = threading.Event()
+
+        def get_entity_bundle(entity):
+            if entity == 'syn5':
+                fetched.set()
+            return self._getEntityBundle(entity)
+
+        def download(downloadLocation, entity, ifcollision, submission, materialize, plan):
+            # the next entity is fetched while the first file is still downloading
+            if entity.id == 'syn4':
+                assert_true(fetched.wait(10))
+
+        with patch.object(synapseclient.config, "single_threaded", False), \
+                patch.object(synapseclient.client.download_urls, "MAX_BATCH_SIZE", 1), \
+                patch.object(syn, "_getEntityBundle", side_effect=get_entity_bundle), \
+                patch.object(syn.cache, "get", return_value=None), \
+                patch.object(syn._download_urls, "resolve"), \
+                patch.object(syn, "_download_file_entity", side_effect=download):
+            results = list(syn.getMany(['syn4', 'syn5'], downloadLocation=tempfile.mkdtemp()))
+
+        assert_equal([None, None], [result.error for result in results])
+
+    def test_getMany__unexpected_kwargs(self):
+        assert_raises(TypeError, next, syn.getMany(['syn1'], version=2))
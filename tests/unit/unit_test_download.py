@@ -7,6 +7,9 @@ import synapseclient
 import tempfile
 import os
 import hashlib
+import json
+import threading
+import time
 import unit
 from mock import MagicMock, patch, mock_open, call
 from nose.tools import assert_raises, assert_equals, assert_false
@@ -302,6 +305,86 @@ def test_download_end_early_retry():
         mocked_move.assert_called_once_with(temp_destination, destination)
 
 
+def _signed_url(signed_time, expires=3600):
+    return "https://foo.com/filerino.txt?X-Amz-Date=%s&X-Amz-Expires=%d" % (
+        time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(signed_time)), expires)
+
+
+def test_download_from_URL__refreshes_expired_url():
+    """
+    -------Test that a download resumes from a new URL when its URL has expired--------
+    """
+    contents = "\n".join(str(i) for i in range(1000))
+    contents_md5 = hashlib.md5(contents.encode('utf-8')).hexdigest()
+    destination = os.path.join(tempfile.mkdtemp(), "filerino.txt")
+    temp_destination = synapseclient.utils.temp_download_filename(destination, '42')
+    partial_content_break = len(contents) // 7 * 3
+    new_url = _signed_url(time.time())
+
+    # 1. refused with 403 Forbidden, which is retried with a new URL without counting as a failure
+    with open(temp_destination, 'w') as f:
+        f.write(contents[:partial_content_break])
+    mock_requests_get = MockRequestGetFunction([
+        create_mock_response(new_url, "error", status_code=403, reason="Request has expired"),
+        create_mock_response(new_url, "stream", contents=contents, buffer_size=1024,
+                             partial_start=partial_content_break, status_code=206)
+    ])
+    refresh_url = MagicMock(return_value=new_url)
+    with patch.object(syn._requests_session, 'get', side_effect=mock_requests_get) as mocked_get, \
+            patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h):
+        path = syn._download_from_URL("https://foo.com/filerino.txt", destination, '42', expected_md5=contents_md5,
+                                      refresh_url=refresh_url)
+
+    assert_equals(destination, path)
+    refresh_url.assert_called_once_with()
+    assert_equals(new_url, mocked_get.call_args[0][0])
+    assert_equals({'Range': 'bytes=%d-' % partial_content_break}, mocked_get.call_args[1]['headers'])
+    with open(destination) as f:
+        assert_equals(contents, f.read())
+
+    # 2. a URL that is about to expire is swapped for a new one before it is used
+    refresh_url = MagicMock(return_value=new_url)
+    mock_requests_get = MockRequestGetFunction([
+        create_mock_response(new_url, "stream", contents=contents, buffer_size=1024, status_code=200)
+    ])
+    with patch.object(syn._requests_session, 'get', side_effect=mock_requests_get) as mocked_get, \
+            patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h):
+        syn._download_from_URL(_signed_url(time.time() - 3500), destination, '42', expected_md5=contents_md5,
+                               refresh_url=refresh_url)
+
+    refresh_url.assert_called_once_with()
+    mocked_get.assert_called_once_with(new_url, headers={}, stream=True, allow_redirects=False)
+
+    # 3. without a way to get a new URL, 403 Forbidden fails the download
+    mock_requests_get = MockRequestGetFunction([create_mock_response(new_url, "error", status_code=403)])
+    with patch.object(syn._requests_session, 'get', side_effect=mock_requests_get), \
+            patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h):
+        assert_raises(SynapseHTTPError, syn._download_from_URL, new_url, destination, '42')
+
+
+def test_download_from_URL__short_lived_url():
+    """
+    -------Test that a URL valid for less than the expiry margin is used rather than refreshed straight away-------
+    """
+    contents = "\n".join(str(i) for i in range(1000))
+    contents_md5 = hashlib.md5(contents.encode('utf-8')).hexdigest()
+    destination = os.path.join(tempfile.mkdtemp(), "filerino.txt")
+    # AWS signature version 2, which only has the time the URL expires at
+    url = "https://foo.com/filerino.txt?AWSAccessKeyId=abc&Expires=%d&Signature=def" % (time.time() + 120)
+
+    refresh_url = MagicMock(return_value=_signed_url(time.time()))
+    mock_requests_get = MockRequestGetFunction([
+        create_mock_response(url, "stream", contents=contents, buffer_size=1024, status_code=200)
+    ])
+    with patch.object(syn._requests_session, 'get', side_effect=mock_requests_get) as mocked_get, \
+            patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h):
+        path = syn._download_from_URL(url, destination, '42', expected_md5=contents_md5, refresh_url=refresh_url)
+
+    assert_equals(destination, path)
+    refresh_url.assert_not_called()
+    mocked_get.assert_called_once_with(url, headers={}, stream=True, allow_redirects=False)
+
+
 def test_download_md5_mismatch__not_local_file():
     """
     --------Test to ensure file gets removed on md5 mismatch--------
@@ -339,8 +422,10 @@ def test_download_md5_mismatch__not_local_file():
         # assert shutil.move() called once
         mocked_move.assert_called_once_with(temp_destination, destination)
 
-        # assert file was removed
-        mocked_remove.assert_called_once_with(destination)
+        # assert any saved MD5 state was removed before the file was written, and after it was completed, and then
+        # the file was removed
+        assert_equals([call(temp_destination + '.md5state'), call(temp_destination + '.md5state'), call(destination)],
+                      mocked_remove.call_args_list)
 
 
 def test_download_md5_mismatch_local_file():
@@ -387,3 +472,80 @@ def test_getFileHandleDownload__error_NOT_FOUND():
     ret_val = {'requestedFiles': [{'failureCode': 'NOT_FOUND', }]}
     with patch.object(syn, "restPOST", return_value=ret_val):
         assert_raises(SynapseFileNotFoundError, syn._getFileHandleDownload, '123', 'syn456')
+
+
+def test_downloadFileHandle__clones_cached_copy_with_same_md5():
+    tmp_dir = tempfile.mkdtemp()
+    cached_path = os.path.join(tmp_dir, "cached", "file.txt")
+    os.makedirs(os.path.dirname(cached_path))
+    with open(cached_path, 'w') as f:
+        f.write("same content")
+    destination = os.path.join(tmp_dir, "download", "file.txt")
+    md5 = hashlib.md5(b"same content").hexdigest()
+
+    with patch.object(syn.cache, "get_by_md5", return_value=cached_path) as mocked_get_by_md5, \
+            patch.object(syn.cache, "add") as mocked_cache_add, \
+            patch.object(syn, "_getFileHandleDownload") as mocked_getFileHandleDownload:
+        path = syn._downloadFileHandle('456', 'syn123', 'FileEntity', destination, expected_md5=md5)
+
+        assert_equals(destination, path)
+        with open(path) as f:
+            assert_equals("same content", f.read())
+        mocked_get_by_md5.assert_called_once_with(md5)
+        mocked_cache_add.assert_called_once_with('456', destination, md5=md5)
+        assert_false(mocked_getFileHandleDownload.called)
+
+
+def test_downloadFileHandle__concurrent_requests_download_once():
+    tmp_dir = tempfile.mkdtemp()
+    destinations = [os.path.join(tmp_dir, "download%d" % i, "file.txt") for i in range(3)]
+    file_result = {'preSignedURL': 'https://foo.com/file.txt',
+                   'fileHandle': {'id': '456', 'concreteType': concrete_types.S3_FILE_HANDLE}}
+
+    def download_from_URL(url, destination, fileHandleId, expected_md5=None, expected_size=None, refresh_url=None):
+        time.sleep(0.2)
+        with open(destination, 'w') as f:
+            f.write("content")
+        return destination
+
+    def download(destination):
+        paths.append(syn._downloadFileHandle('456', 'syn123', 'FileEntity', destination))
+
+    paths = []
+    with patch.object(syn, "cache", synapseclient.cache.Cache(cache_root_dir=os.path.join(tmp_dir, "cache"))), \
+            patch.object(syn, "_getFileHandleDownload", return_value=file_result), \
+            patch.object(syn, "_download_from_URL", side_effect=download_from_URL) as mocked_download_from_URL:
+        threads = [threading.Thread(target=download, args=(destination,)) for destination in destinations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equals(1, mocked_download_from_URL.call_count)
+        assert_equals(sorted(destinations), sorted(paths))
+        for destination in destinations:
+            with open(destination) as f:
+                assert_equals("content", f.read())
+            assert_equals(destination, syn.cache.get('456', destination))
+
+
+def test_download_file_entity__materialize_cached_file():
+    tmp_dir = tempfile.mkdtemp()
+    cached_path = synapseclient.utils.normalize_path(os.path.join(tmp_dir, "cache", "file.txt"))
+    os.makedirs(os.path.dirname(cached_path))
+    with open(cached_path, 'w') as f:
+        f.write("cached content")
+    download_location = os.path.join(tmp_dir, "download")
+
+    file_entity = synapseclient.File(parentId="syn123")
+    file_entity.dataFileHandleId = 123
+    with patch.object(syn.cache, 'get', return_value=cached_path), \
+            patch.object(syn.cache, 'add') as mocked_cache_add, \
+            patch("synapseclient.cache.materialize") as mocked_materialize:
+        syn._download_file_entity(downloadLocation=download_location, entity=file_entity,
+                                  ifcollision="overwrite.local", submission=None, materialize="hardlink")
+
+        expected_path = synapseclient.utils.normalize_path(os.path.join(download_location, "file.txt"))
+        mocked_materialize.assert_called_once_with(cached_path, expected_path, "hardlink")
+        mocked_cache_add.assert_called_once_with(123, expected_path)
+        assert_equals(expected_path, file_entity.path)
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import os
+import tempfile
+import unit
+import requests
+from mock import patch, MagicMock, call
+from nose.tools import assert_equals, assert_raises, assert_false
+
+from synapseclient import File
+from synapseclient.download_stream import iter_url, IteratorReader
+from synapseclient.exceptions import SynapseMd5MismatchError
+
+
+def setup(module):
+    module.syn = unit.syn
+
+
+CONTENTS = b''.join(str(i).encode('utf-8') for i in range(1000))
+CONTENTS_MD5 = hashlib.md5(CONTENTS).hexdigest()
+URL = 'https://foo.com/file.txt'
+
+
+def _response(data, status_code=200, fail_after=None):
+    response = MagicMock()
+    response.status_code = status_code
+
+    def iter_content(chunk_size):
+        for i in range(0, len(data), chunk_size):
+            if fail_after is not None and i >= fail_after:
+                raise requests.exceptions.ChunkedEncodingError('Connection broken')
+            yield data[i:i + chunk_size]
+
+    response.iter_content = iter_content
+    return response
+
+
+def test_iter_url():
+    with patch.object(syn, '_get_url_range', return_value=_response(CONTENTS)) as mock_get_url_range:
+        chunks = list(iter_url(syn, URL, 100, size=len(CONTENTS), expected_md5=CONTENTS_MD5))
+    assert_equals(CONTENTS, b''.join(chunks))
+    assert_equals(100, max(len(chunk) for chunk in chunks))
+    mock_get_url_range.assert_called_once_with(URL, 0)
+
+
+def test_iter_url__resumes_lost_connection():
+    responses = [_response(CONTENTS, fail_after=500), _response(CONTENTS[500:], status_code=206)]
+    with patch.object(syn, '_get_url_range', side_effect=responses) as mock_get_url_range:
+        data = b''.join(iter_url(syn, URL, 100, size=len(CONTENTS), expected_md5=CONTENTS_MD5))
+    assert_equals(CONTENTS, data)
+    assert_equals([call(URL, 0), call(URL, 500)], mock_get_url_range.call_args_list)
+
+
+def test_iter_url__range_not_supported():
+    # the server sends the whole file again, the part that was already read is skipped
+    responses = [_response(CONTENTS, fail_after=500), _response(CONTENTS)]
+    with patch.object(syn, '_get_url_range', side_effect=responses):
+        data = b''.join(iter_url(syn, URL, 64, size=len(CONTENTS), expected_md5=CONTENTS_MD5))
+    assert_equals(CONTENTS, data)
+
+
+def test_iter_url__gives_up_without_progress():
+    responses = [_response(CONTENTS, fail_after=0) for i in range(3)]
+    with patch.object(syn, '_get_url_range', side_effect=responses):
+        assert_raises(requests.exceptions.ChunkedEncodingError, list, iter_url(syn, URL, 100, retries=2))
+
+
+def test_iter_url__md5_mismatch():
+    with patch.object(syn, '_get_url_range', return_value=_response(CONTENTS)):
+        assert_raises(SynapseMd5MismatchError, list, iter_url(syn, URL, 100, expected_md5='0' * 32))
+
+
+def test_iterator_reader():
+    iterator = iter([b'abc', b'', b'defg', b'h'])
+    with io.BufferedReader(IteratorReader(iterator), buffer_size=2) as reader:
+        assert_equals(b'ab', reader.read(2))
+        assert_equals(b'cdefgh', reader.read())
+        assert_equals(b'', reader.read())
+
+
+class TestStreamEntity:
+    def setup(self):
+        self.entity = File(id='syn123', parentId='syn1', name='file.txt', dataFileHandleId='456')
+        self.entity._update_file_handle({'id': '456', 'contentMd5': CONTENTS_MD5, 'contentSize': len(CONTENTS)})
+        self.file_result = {'fileHandleId': '456', 'preSignedURL': URL,
+                            'fileHandle': {'id': '456', 'contentMd5': CONTENTS_MD5, 'contentSize': len(CONTENTS)}}
+
+    def test_open(self):
+        with patch.object(syn.cache, 'get', return_value=None), \
+                patch.object(syn, '_getFileHandleDownload', return_value=self.file_result), \
+                patch.object(syn, '_get_url_range', return_value=_response(CONTENTS)), \
+                patch.object(syn.cache, 'add') as mock_cache_add:
+            with syn.open(self.entity, chunk_size=100) as f:
+                assert_equals(CONTENTS, f.read())
+            assert_false(mock_cache_add.called)
+
+    def test_iter_bytes__cached(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(CONTENTS)
+            with patch.object(syn.cache, 'get', return_value=path), \
+                    patch.object(syn, '_getFileHandleDownload') as mock_getFileHandleDownload:
+                assert_equals(CONTENTS, b''.join(syn.iter_bytes(self.entity, chunk_size=100)))
+                assert_false(mock_getFileHandleDownload.called)
+
+            # the cache can be skipped
+            with patch.object(syn.cache, 'get', return_value=path) as mock_cache_get, \
+                    patch.object(syn, '_getFileHandleDownload', return_value=self.file_result), \
+                    patch.object(syn, '_get_url_range', return_value=_response(CONTENTS)):
+                assert_equals(CONTENTS, b''.join(syn.iter_bytes(self.entity, use_cache=False)))
+                assert_false(mock_cache_get.called)
+        finally:
+            os.remove(path)
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import time
+import unit
+from mock import patch, call, MagicMock
+from nose.tools import assert_equals, assert_is_none, assert_raises, assert_true, assert_false
+
+from synapseclient import download_urls
+from synapseclient.download_urls import url_expiry, expires_soon, DownloadURLResolver, RefreshingURL
+from synapseclient.exceptions import SynapseFileNotFoundError
+
+
+def setup(module):
+    module.syn = unit.syn
+
+
+def test_url_expiry():
+    signed = calendar.timegm((2020, 10, 18, 12, 0, 0, 0, 0, 0))
+    assert_equals(signed + 900, url_expiry('https://bucket.s3.amazonaws.com/key?X-Amz-Algorithm=AWS4-HMAC-SHA256'
+                                           '&X-Amz-Date=20201018T120000Z&X-Amz-Expires=900&X-Amz-Signature=abc'))
+    assert_equals(signed + 60, url_expiry('https://storage.googleapis.com/bucket/key?x-goog-date=20201018T120000Z'
+                                          '&x-goog-expires=60'))
+    assert_equals(1603022400, url_expiry('https://bucket.s3.amazonaws.com/key?AWSAccessKeyId=a&Expires=1603022400'))
+    assert_is_none(url_expiry('https://example.com/file.txt'))
+    assert_is_none(url_expiry('https://example.com/file.txt?Expires=tomorrow'))
+
+
+def _file_result(fileHandleId, expires_in):
+    expires = int(time.time()) + expires_in
+    return {'fileHandleId': fileHandleId, 'fileHandle': {'id': fileHandleId},
+            'preSignedURL': 'https://bucket.s3.amazonaws.com/%s?Expires=%d' % (fileHandleId, expires)}
+
+
+def _fake_getFileHandleDownloads(expires_in):
+    return lambda associations: [_file_result(fileHandleId, expires_in) for fileHandleId, _, _ in associations]
+
+
+def test_resolve__batches():
+    resolver = DownloadURLResolver(syn)
+    associations = [(i, 'syn%d' % i, 'FileEntity') for i in range(250)]
+    with patch.object(syn, '_getFileHandleDownloads', side_effect=_fake_getFileHandleDownloads(3600)) as mock_get:
+        results = resolver.resolve(associations + associations[:10])
+        assert_equals([str(i) for i in range(250)] + [str(i) for i in range(10)],
+                      [result['fileHandleId'] for result in results])
+        assert_equals([call([(str(i), 'syn%d' % i, 'FileEntity') for i in range(start, min(start + 100, 250))])
+                       for start in (0, 100, 200)], mock_get.call_args_list)
+
+        # the results are reused while their URLs are valid
+        resolver.resolve(associations[5:10])
+        assert_equals(3, mock_get.call_count)
+
+        resolver.forget(5, 'syn5', 'FileEntity')
+        resolver.resolve(associations[5:10])
+        mock_get.assert_called_with([('5', 'syn5', 'FileEntity')])
+
+
+def _signed_url(expires_in, lifetime):
+    signed = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(time.time() + expires_in - lifetime))
+    return ('https://bucket.s3.amazonaws.com/key?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Date=%s&X-Amz-Expires=%d'
+            % (signed, lifetime))
+
+
+def test_resolve__expiring_urls_are_not_reused():
+    resolver = DownloadURLResolver(syn)
+    with patch.object(syn, '_getFileHandleDownloads',
+                      side_effect=_fake_getFileHandleDownloads(download_urls.EXPIRY_MARGIN - 1)) as mock_get:
+        resolver.resolve([('1', 'syn1', 'FileEntity')])
+        resolver.resolve([('1', 'syn1', 'FileEntity')])
+        # a URL that only has its expiry in it is valid for as long as it was when it was handed out
+        assert_equals(1, mock_get.call_count)
+
+    file_result = {'fileHandleId': '1', 'fileHandle': {'id': '1'},
+                   'preSignedURL': _signed_url(download_urls.EXPIRY_MARGIN - 10, 3600)}
+    with patch.object(syn, '_getFileHandleDownloads', return_value=[file_result]) as mock_get:
+        resolver.resolve([('2', 'syn2', 'FileEntity')])
+        resolver.resolve([('2', 'syn2', 'FileEntity')])
+        assert_equals(2, mock_get.call_count)
+
+
+def test_short_lived_urls():
+    # valid for less than twice the margin, counting half of its lifetime as the margin
+    url = _signed_url(240, 240)
+    assert_equals(120, download_urls.expiry_margin(url))
+    assert_false(expires_soon(url))
+    assert_true(expires_soon(_signed_url(100, 240)))
+    now = int(time.time())
+    assert_equals(30, download_urls.expiry_margin('https://bucket.s3.amazonaws.com/key?Expires=%d' % (now + 60),
+                                                  obtained=now))
+
+    resolver = DownloadURLResolver(syn)
+    file_result = {'fileHandleId': '1', 'fileHandle': {'id': '1'}, 'preSignedURL': url}
+    with patch.object(syn, '_getFileHandleDownloads', return_value=[file_result]) as mock_get:
+        resolver.resolve([('1', 'syn1', 'FileEntity')])
+        resolver.resolve([('1', 'syn1', 'FileEntity')])
+        assert_equals(1, mock_get.call_count)
+
+    refresh = MagicMock()
+    assert_equals(url, RefreshingURL(url, refresh).get())
+    assert_false(refresh.called)
+
+
+def test_resolve__failures_are_not_reused():
+    resolver = DownloadURLResolver(syn)
+    with patch.object(syn, '_getFileHandleDownloads',
+                      return_value=[{'fileHandleId': '1', 'failureCode': 'NOT_FOUND'}]) as mock_get:
+        assert_raises(SynapseFileNotFoundError, syn._getFileHandleDownload, '1', 'syn1')
+        assert_equals('NOT_FOUND', resolver.resolve([('1', 'syn1', 'FileEntity')])[0]['failureCode'])
+        assert_equals('NOT_FOUND', resolver.resolve([('1', 'syn1', 'FileEntity')])[0]['failureCode'])
+        assert_equals(3, mock_get.call_count)
+
+
+def test_refreshing_url():
+    expiring_url = 'https://bucket.s3.amazonaws.com/key?Expires=%d' % (time.time() + 60)
+    valid_url = 'https://bucket.s3.amazonaws.com/key?Expires=%d' % (time.time() + 3600)
+    assert_true(expires_soon(expiring_url))
+    assert_false(expires_soon(valid_url))
+    assert_false(expires_soon('https://example.com/file.txt'))
+
+    refresh = MagicMock(side_effect=[valid_url, 'https://bucket.s3.amazonaws.com/key?Expires=%d' % (time.time() + 7200)])
+    url = RefreshingURL(expiring_url, refresh)
+    assert_equals(valid_url, url.get())
+    assert_equals(valid_url, url.get())
+    assert_equals(1, refresh.call_count)
+
+    # the URL is only replaced once for each URL that was refused
+    assert_true(url.replace(valid_url))
+    assert_true(url.replace(valid_url))
+    assert_equals(2, refresh.call_count)
+
+    # without a way to refresh it, the URL stays as it is
+    url = RefreshingURL(expiring_url)
+    assert_equals(expiring_url, url.get())
+    assert_false(url.replace(expiring_url))
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import ctypes
+import hashlib
+import os
+import sys
+import tempfile
+from mock import MagicMock
+from nose.tools import assert_equals, assert_raises, assert_false
+
+from synapseclient.download_writer import DownloadWriter, preallocate, _load_fallocate
+
+
+CONTENTS = os.urandom(1000)
+
+
+def test_download_writer():
+    fd = MagicMock()
+    md5 = hashlib.md5(CONTENTS[:30])
+    on_written = MagicMock()
+    with DownloadWriter(fd, md5, 30, on_written=on_written, buffer_size=100, max_queued=1) as writer:
+        for i in range(30, 1000, 70):
+            writer.write(CONTENTS[i:i + 70], progress=i + 70)
+
+    # the first write ends on a multiple of the buffer size, the last one writes what is left
+    assert_equals([70] + [100] * 9, [len(args[0]) for args, kwargs in fd.write.call_args_list])
+    assert_equals(CONTENTS[30:], b''.join(args[0] for args, kwargs in fd.write.call_args_list))
+    assert_equals(hashlib.md5(CONTENTS).hexdigest(), md5.hexdigest())
+    assert_equals(1000, writer.offset)
+    # the progress of the last chunk written in full
+    assert_equals([(100, 100), (200, 170), (300, 240), (400, 380), (500, 450), (600, 590), (700, 660),
+                   (800, 800), (900, 870), (1000, 1010)],
+                  [args for args, kwargs in on_written.call_args_list])
+
+
+def test_download_writer__write_error():
+    fd = MagicMock()
+    fd.write.side_effect = IOError("No space left on device")
+    writer = DownloadWriter(fd, hashlib.md5(), 0, buffer_size=10, max_queued=1)
+
+    def write_all():
+        with writer:
+            for i in range(0, 1000, 10):
+                writer.write(CONTENTS[i:i + 10])
+    assert_raises(IOError, write_all)
+    assert_equals(0, writer.offset)
+
+
+def test_preallocate():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'abc')
+            allocated = preallocate(f, 10 * 1024 * 1024)
+        # the size is kept, since partial downloads are resumed from the end of the file
+        assert_equals(3, os.path.getsize(path))
+        if not sys.platform.startswith('linux'):
+            assert_false(allocated)
+    finally:
+        os.remove(path)
+    assert_false(preallocate(MagicMock(), 100))
+
+
+def test_load_fallocate():
+    class LibC(object):
+        pass
+
+    libc = LibC()
+    libc.fallocate, libc.fallocate64 = MagicMock(), MagicMock()
+    fallocate = _load_fallocate(libc)
+    assert_equals(libc.fallocate64, fallocate)
+    assert_equals([ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64], fallocate.argtypes)
+    assert_equals(2 ** 63 - 1, fallocate.max_offset)
+
+    # without fallocate64 the offsets are the size of a long, as off_t is on builds without 64 bit file offsets
+    del libc.fallocate64
+    fallocate = _load_fallocate(libc)
+    assert_equals(libc.fallocate, fallocate)
+    assert_equals([ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.c_long], fallocate.argtypes)
+    assert_equals(2 ** (8 * ctypes.sizeof(ctypes.c_long) - 1) - 1, fallocate.max_offset)
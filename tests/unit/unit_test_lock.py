@@ -1,9 +1,15 @@
+import errno
+import os
 import random
+import tempfile
 import time
 from threading import Thread
 from datetime import timedelta
-from synapseclient.lock import Lock
-from nose.tools import assert_true, assert_false, assert_less, assert_greater, assert_equals
+from mock import patch
+from synapseclient.lock import Lock, FlockLock, ExclusiveFileLock, get_lock, single_flight, _single_flight_locks
+from nose.tools import assert_true, assert_false, assert_less, assert_greater, assert_equals, assert_is_instance, \
+    assert_raises, assert_is_none
+from synapseclient.exceptions import SynapseFileCacheError
 
 
 def test_lock():
@@ -78,3 +84,188 @@ def test_multithreaded():
 
     for key in counts:
         assert_equals(counts[key], set(range(NUMBER_OF_TIMES_PER_THREAD)))
+
+
+def test_flock_lock():
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = FlockLock("foo", dir=lock_dir)
+    user2_lock = FlockLock("foo", dir=lock_dir)
+
+    assert_true(user1_lock.acquire())
+    assert_false(user2_lock.acquire())
+
+    user1_lock.release()
+
+    assert_true(user2_lock.acquire())
+    assert_false(user1_lock.acquire())
+
+    user2_lock.release()
+
+
+def test_flock_lock_shared():
+    lock_dir = tempfile.mkdtemp()
+    reader1_lock = FlockLock("foo", dir=lock_dir, shared=True)
+    reader2_lock = FlockLock("foo", dir=lock_dir, shared=True)
+    writer_lock = FlockLock("foo", dir=lock_dir)
+
+    with reader1_lock:
+        assert_true(reader2_lock.acquire())
+        assert_false(writer_lock.acquire())
+    reader2_lock.release()
+
+    with writer_lock:
+        assert_false(reader1_lock.acquire())
+
+
+def test_flock_lock_blocks_until_released():
+    lock_dir = os.path.join(tempfile.mkdtemp(), "not_yet_created")
+    user1_lock = FlockLock("foo", dir=lock_dir)
+    user2_lock = FlockLock("foo", dir=lock_dir)
+    event_log = []
+
+    def wait_for_lock():
+        with user2_lock:
+            event_log.append("user2")
+
+    with user1_lock:
+        thread = Thread(target=wait_for_lock)
+        thread.start()
+        time.sleep(0.2)
+        event_log.append("user1")
+    thread.join()
+
+    assert_equals(["user1", "user2"], event_log)
+
+
+def test_flock_lock_falls_back_to_directory_lock():
+    lock_dir = tempfile.mkdtemp()
+    with patch("synapseclient.lock.fcntl.flock", side_effect=IOError(errno.ENOLCK, "No locks available")):
+        user1_lock = FlockLock("foo", dir=lock_dir, shared=True)
+        user2_lock = FlockLock("foo", dir=lock_dir, shared=True)
+
+        assert_true(user1_lock.acquire())
+        assert_true(os.path.isdir(os.path.join(lock_dir, "foo.lock")))
+        assert_false(user2_lock.acquire())
+
+        user1_lock.release()
+        assert_false(os.path.exists(os.path.join(lock_dir, "foo.lock")))
+
+
+def test_flock_lock_falls_back_to_directory_lock__with():
+    lock_dir = tempfile.mkdtemp()
+    with patch("synapseclient.lock.fcntl.flock", side_effect=IOError(errno.ENOLCK, "No locks available")):
+        lock = FlockLock("foo", dir=lock_dir)
+        with lock:
+            assert_true(lock.held)
+            assert_true(os.path.isdir(os.path.join(lock_dir, "foo.lock")))
+        assert_false(lock.held)
+        assert_false(os.path.exists(os.path.join(lock_dir, "foo.lock")))
+
+
+def test_flock_lock_excludes_directory_locks():
+    lock_dir = tempfile.mkdtemp()
+    # the lock of a client that doesn't use flock
+    directory_lock = Lock("foo", dir=lock_dir)
+    writer_lock = FlockLock("foo", dir=lock_dir)
+    reader_lock = FlockLock("foo", dir=lock_dir, shared=True)
+
+    with directory_lock:
+        assert_false(writer_lock.acquire())
+        # the flock isn't kept when the directory lock isn't acquired
+        assert_true(reader_lock.acquire())
+        reader_lock.release()
+
+    with writer_lock:
+        assert_true(os.path.isdir(os.path.join(lock_dir, "foo.lock")))
+        assert_false(directory_lock.acquire())
+    assert_false(os.path.exists(os.path.join(lock_dir, "foo.lock")))
+
+
+def test_flock_lock_blocking_timeout():
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = FlockLock("foo", dir=lock_dir)
+    user2_lock = FlockLock("foo", dir=lock_dir)
+
+    with user1_lock:
+        start = time.time()
+        assert_raises(SynapseFileCacheError, user2_lock.blocking_acquire, timeout=timedelta(seconds=0.6))
+        assert_greater(time.time() - start, 0.5)
+        assert_false(user2_lock.held)
+    assert_true(user2_lock.blocking_acquire(timeout=timedelta(seconds=0.6)))
+    user2_lock.release()
+
+
+def test_get_lock():
+    assert_is_instance(get_lock("foo", dir=tempfile.mkdtemp()), FlockLock)
+    with patch("synapseclient.lock.fcntl", None):
+        assert_is_instance(get_lock("foo", dir=tempfile.mkdtemp()), Lock)
+
+
+def test_exclusive_file_lock():
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = ExclusiveFileLock("foo", dir=lock_dir)
+    user2_lock = ExclusiveFileLock("foo", dir=lock_dir)
+    event_log = []
+
+    def wait_for_lock():
+        assert_true(user2_lock.acquire(blocking=True))
+        event_log.append("user2")
+        user2_lock.release()
+
+    assert_true(user1_lock.acquire())
+    assert_false(user2_lock.acquire())
+    thread = Thread(target=wait_for_lock)
+    thread.start()
+    time.sleep(0.2)
+    event_log.append("user1")
+    user1_lock.release()
+    thread.join()
+
+    assert_equals(["user1", "user2"], event_log)
+    # the lock file is removed by whoever releases it last
+    assert_equals([], os.listdir(lock_dir))
+
+    with patch("synapseclient.lock.fcntl.flock", side_effect=IOError(errno.ENOLCK, "No locks available")):
+        unsupported_lock = ExclusiveFileLock("foo", dir=lock_dir)
+        assert_is_none(unsupported_lock.acquire(blocking=True))
+        assert_false(unsupported_lock.held)
+
+
+def test_single_flight():
+    lock_dir = tempfile.mkdtemp()
+    event_log = []
+
+    def wait_for_flight():
+        with single_flight("foo", lock_dir) as waited:
+            event_log.append(("thread", waited))
+
+    with single_flight("foo", lock_dir) as waited:
+        event_log.append(("main", waited))
+        thread = Thread(target=wait_for_flight)
+        thread.start()
+        time.sleep(0.2)
+        # another process holds the lock while this one is waiting on its thread lock
+        assert_false(ExclusiveFileLock("foo", dir=lock_dir).acquire())
+    thread.join()
+
+    assert_equals([("main", False), ("thread", True)], event_log)
+    assert_equals({}, _single_flight_locks)
+
+    # waiting on another process, which holds the lock for longer than a directory lock may be held
+    other_process_lock = ExclusiveFileLock("foo", dir=lock_dir)
+    other_process_lock.acquire()
+    thread = Thread(target=wait_for_flight)
+    with patch("synapseclient.lock.LOCK_DEFAULT_MAX_AGE", timedelta(seconds=0.1)):
+        thread.start()
+        time.sleep(0.3)
+    assert_equals(2, len(event_log))
+    other_process_lock.release()
+    thread.join()
+    assert_equals(("thread", True), event_log[-1])
+    assert_equals([], os.listdir(lock_dir))
+
+    # without a lock that the file system supports, only threads are kept out
+    with patch("synapseclient.lock.fcntl.flock", side_effect=IOError(errno.ENOLCK, "No locks available")):
+        with single_flight("foo", lock_dir) as waited:
+            assert_false(waited)
+    assert_equals([], os.listdir(lock_dir))
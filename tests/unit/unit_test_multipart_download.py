@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unit
+from mock import patch, MagicMock, ANY
+from nose.tools import assert_raises, assert_equals, assert_false, assert_true
+
+import synapseclient
+from synapseclient import multipart_download, utils
+from synapseclient.download_urls import RefreshingURL
+from synapseclient.resumable_md5 import checkpoint_filename
+from synapseclient.multipart_download import part_ranges, download_file, discard_partial_download, \
+    progress_filename, RangeRequestsNotSupportedError
+from synapseclient.exceptions import SynapseHTTPError
+
+
+def setup(module):
+    module.syn = unit.syn
+
+
+def test_part_ranges():
+    assert_equals([], part_ranges(0, 10))
+    assert_equals([(0, 9)], part_ranges(10, 10))
+    assert_equals([(0, 3), (4, 7), (8, 9)], part_ranges(10, 4))
+    assert_raises(ValueError, part_ranges, 10, 0)
+
+
+class TestDownloadFile:
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmp_dir, 'file.bin')
+        self.temp_destination = self.destination + '.synapse_download_42'
+        self.contents = os.urandom(5 * multipart_download.MIN_PART_SIZE + 123)
+        self.contents_md5 = hashlib.md5(self.contents).hexdigest()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _range_response(self, url, start, end, status_code=206, truncate=0):
+        response = MagicMock()
+        response.status_code = status_code
+        data = self.contents[start:end + 1 - truncate] if status_code == 206 else self.contents
+        response.iter_content = lambda buffer_size: (data[i:i + buffer_size] for i in range(0, len(data), buffer_size))
+        return response
+
+    def test_download_file(self):
+        with patch.object(syn, '_get_url_range', side_effect=self._range_response) as mock_get_url_range:
+            md5 = download_file(syn, RefreshingURL('https://foo.com/file.bin'), self.destination,
+                                self.temp_destination, len(self.contents), part_size=multipart_download.MIN_PART_SIZE)
+        assert_equals(self.contents_md5, md5)
+        assert_equals(6, mock_get_url_range.call_count)
+        with open(self.destination, 'rb') as f:
+            assert_equals(self.contents, f.read())
+        assert_false(os.path.exists(self.temp_destination))
+        assert_false(os.path.exists(progress_filename(self.temp_destination)))
+
+    def test_download_file_resume(self):
+        part_size = multipart_download.MIN_PART_SIZE
+        second_part = part_ranges(len(self.contents), part_size)[1]
+
+        def fail_second_part(url, start, end):
+            return self._range_response(url, start, end, truncate=1 if (start, end) == second_part else 0)
+
+        with patch.object(syn, '_get_url_range', side_effect=fail_second_part):
+            with assert_raises(IOError) as cm:
+                download_file(syn, RefreshingURL('https://foo.com/file.bin'), self.destination,
+                              self.temp_destination, len(self.contents), part_size=part_size)
+        assert_equals(len(self.contents) - part_size, cm.exception.progress)
+        assert_true(os.path.exists(progress_filename(self.temp_destination)))
+        assert_false(os.path.exists(self.destination))
+
+        # only the failed part is requested again
+        with patch.object(syn, '_get_url_range', side_effect=self._range_response) as mock_get_url_range:
+            md5 = download_file(syn, RefreshingURL('https://foo.com/file.bin'), self.destination,
+                                self.temp_destination, len(self.contents), part_size=part_size)
+        mock_get_url_range.assert_called_once_with('https://foo.com/file.bin', second_part[0], second_part[1])
+        assert_equals(self.contents_md5, md5)
+        with open(self.destination, 'rb') as f:
+            assert_equals(self.contents, f.read())
+
+    def test_download_file_refreshes_expired_url(self):
+        forbidden = MagicMock()
+        forbidden.status_code = 403
+
+        def expired_old_url(url, start, end):
+            if url == 'https://foo.com/old':
+                raise SynapseHTTPError('403 Forbidden', response=forbidden)
+            return self._range_response(url, start, end)
+
+        refresh_url = MagicMock(return_value='https://foo.com/new')
+        with patch.object(syn, '_get_url_range', side_effect=expired_old_url):
+            md5 = download_file(syn, RefreshingURL('https://foo.com/old', refresh_url), self.destination,
+                                self.temp_destination, len(self.contents), part_size=multipart_download.MIN_PART_SIZE)
+        assert_equals(self.contents_md5, md5)
+        # the parts refused at the same time get a single new URL between them
+        refresh_url.assert_called_once_with()
+
+    def test_download_file_range_not_supported(self):
+        with patch.object(syn, '_get_url_range',
+                          side_effect=lambda url, start, end: self._range_response(url, start, end, status_code=200)):
+            assert_raises(RangeRequestsNotSupportedError, download_file, syn, RefreshingURL('https://foo.com/file.bin'),
+                          self.destination, self.temp_destination, len(self.contents),
+                          multipart_download.MIN_PART_SIZE)
+        utils.touch(checkpoint_filename(self.temp_destination))
+        discard_partial_download(self.temp_destination)
+        assert_false(os.path.exists(self.temp_destination))
+        assert_false(os.path.exists(progress_filename(self.temp_destination)))
+        assert_false(os.path.exists(checkpoint_filename(self.temp_destination)))
+
+    def test_download_file_removes_md5_checkpoint(self):
+        # left by a sequential download of the same file
+        with open(self.temp_destination, 'wb') as f:
+            f.write(b'partial contents')
+        utils.touch(checkpoint_filename(self.temp_destination))
+
+        def take_over(url, start, end):
+            assert_false(os.path.exists(checkpoint_filename(self.temp_destination)))
+            return self._range_response(url, start, end)
+
+        with patch.object(syn, '_get_url_range', side_effect=take_over):
+            download_file(syn, RefreshingURL('https://foo.com/file.bin'), self.destination,
+                          self.temp_destination, len(self.contents), part_size=multipart_download.MIN_PART_SIZE)
+        assert_false(os.path.exists(checkpoint_filename(self.temp_destination)))
+
+    def test_download_from_URL_parallel(self):
+        url = 'https://foo.com/file.bin'
+        with patch.object(syn, 'parallel_download_threshold', len(self.contents)), \
+                patch.object(multipart_download, 'download_file',
+                             return_value=self.contents_md5) as mock_download_file, \
+                patch.object(syn._requests_session, 'get') as mock_get:
+            assert_equals(self.destination, syn._download_from_URL(url, self.destination, '42',
+                                                                   expected_md5=self.contents_md5,
+                                                                   expected_size=len(self.contents)))
+            mock_download_file.assert_called_once_with(syn, ANY, self.destination, self.temp_destination,
+                                                       len(self.contents), syn.parallel_download_part_size)
+            assert_equals(url, mock_download_file.call_args[0][1].get())
+            assert_false(mock_get.called)
+
+            # smaller files and downloads of an unknown size use a single connection
+            mock_get.side_effect = Exception("single connection")
+            assert_raises(Exception, syn._download_from_URL, url, self.destination, '42',
+                          expected_size=len(self.contents) - 1)
+            assert_raises(Exception, syn._download_from_URL, url, self.destination, '42')
+            assert_equals(1, mock_download_file.call_count)
+
+    def test_download_from_URL_falls_back_to_single_connection(self):
+        url = 'https://foo.com/file.bin'
+        response = MagicMock()
+        response.status_code = 200
+        response.headers = {'content-length': len(self.contents)}
+        response.iter_content = lambda buffer_size: iter([self.contents])
+        response.raw.tell = lambda: len(self.contents)
+
+        with patch.object(syn, 'parallel_download_threshold', len(self.contents)), \
+                patch.object(syn, '_get_url_range',
+                             side_effect=lambda url, start, end: self._range_response(url, start, end, status_code=200)), \
+                patch.object(syn._requests_session, 'get', return_value=response) as mock_get, \
+                patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', return_value={}):
+            syn._download_from_URL(url, self.destination, '42', expected_md5=self.contents_md5,
+                                   expected_size=len(self.contents))
+            assert_equals(1, mock_get.call_count)
+        with open(self.destination, 'rb') as f:
+            assert_equals(self.contents, f.read())
+        assert_false(os.path.exists(progress_filename(self.temp_destination)))
@@ -1,15 +1,24 @@
 import unit
 import filecmp
+import hashlib
 import math
 import os
+import requests
+import shutil
+import six
 import tempfile
-from nose.tools import assert_raises, assert_true, assert_greater_equal, assert_equals, assert_is_instance
+import time
+from nose.tools import assert_raises, assert_true, assert_greater_equal, assert_equals, assert_is_instance, \
+    assert_false
 from synapseclient.multipart_upload import find_parts_to_upload, count_completed_parts, calculate_part_size,\
-    get_file_chunk, _upload_chunk, _multipart_upload
+    get_file_chunk, get_data_chunk, _upload_chunk, _multipart_upload, md5s_for_file_and_parts
 from synapseclient.utils import MB, GB, make_bogus_binary_file, md5_for_file
 from synapseclient.exceptions import SynapseHTTPError
+from synapseclient import exceptions
 from synapseclient import multipart_upload
 from synapseclient import pool_provider
+from synapseclient.dict_object import DictObject
+from synapseclient.upload_journal import UploadJournal
 from multiprocessing import Value
 from multiprocessing.dummy import Pool
 from ctypes import c_bool
@@ -80,6 +89,63 @@ def test_chunks():
             os.remove(out.name)
 
 
+def test_get_data_chunk__is_a_view():
+    data = bytearray(b'abcdefgh')
+    chunk = get_data_chunk(data, 2, 3)
+    assert_equals(b'def', bytes(chunk))
+    assert_equals(hashlib.md5(b'def').hexdigest(), hashlib.md5(chunk).hexdigest())
+    # no copy was made
+    data[3] = ord('x')
+    assert_equals(b'xef', bytes(chunk))
+    assert_equals(b'gh', bytes(get_data_chunk(data, 3, 3)))
+
+
+def test_multipart_upload__parts_are_views_of_mapped_file():
+    filepath = make_bogus_binary_file(n=1*MB)
+    chunks = []
+
+    def upload(syn, filename, contentType, get_chunk_function, md5, fileSize, partSize, **kwargs):
+        chunk = get_chunk_function(2, 300*1024)
+        chunks.append((type(chunk), bytes(chunk)))
+        return {'resultFileHandleId': '123'}
+
+    try:
+        expected = get_file_chunk(filepath, 2, 300*1024)
+        with patch.object(multipart_upload, "_multipart_upload", side_effect=upload), \
+                patch.object(multipart_upload, "UploadJournal", return_value=MagicMock(md5=None)):
+            multipart_upload.multipart_upload(syn, filepath, md5='abc')
+            # files that can't be mapped are read
+            with patch.object(multipart_upload.mmap, "mmap", side_effect=ValueError("cannot mmap an empty file")):
+                multipart_upload.multipart_upload(syn, filepath, md5='abc')
+        (mapped_type, mapped_chunk), (read_type, read_chunk) = chunks
+        assert_false(issubclass(mapped_type, bytes))
+        assert_equals(expected, mapped_chunk)
+        assert_true(issubclass(read_type, bytes))
+        assert_equals(expected, read_chunk)
+    finally:
+        os.remove(filepath)
+
+
+
+def test_file_chunks__unmaps_the_file():
+    filepath = make_bogus_binary_file(n=1*MB)
+    try:
+        with multipart_upload._file_chunks(filepath) as get_chunk_function:
+            chunk = get_chunk_function(2, 300*1024)
+            assert_equals(get_file_chunk(filepath, 2, 300*1024), bytes(chunk))
+            if six.PY3:
+                chunk.release()
+        # the mapping is closed
+        assert_raises((ValueError, TypeError), lambda: bytes(get_chunk_function(1, 300*1024)))
+
+        if six.PY3:
+            # a view that is still referenced keeps the mapping open rather than failing the upload
+            with multipart_upload._file_chunks(filepath) as get_chunk_function:
+                chunk = get_chunk_function(2, 300*1024)
+            assert_equals(get_file_chunk(filepath, 2, 300*1024), bytes(chunk))
+    finally:
+        os.remove(filepath)
+
 def test_upload_chunk__expired_url():
     upload_parts = [{'uploadPresignedUrl': 'https://www.fake.url/fake/news',
                      'partNumber': 420},
@@ -132,3 +198,167 @@ def test_pool_provider_is_used_in__multipart_upload():
         mock_provider.assert_called()
         pool.map.assert_called()
 
+
+
+def test_md5s_for_file_and_parts():
+    file_size = 1*MB + 1234
+    part_size = 300*1024
+    filepath = make_bogus_binary_file(n=file_size)
+    try:
+        with patch.object(multipart_upload, "READ_BLOCK_SIZE", 100*1024):
+            md5, part_md5s = md5s_for_file_and_parts(filepath, part_size)
+        assert_equals(md5_for_file(filepath).hexdigest(), md5)
+        assert_equals([hashlib.md5(get_file_chunk(filepath, i, part_size)).hexdigest() for i in range(1, 5)],
+                      part_md5s)
+    finally:
+        os.remove(filepath)
+
+
+def test_multipart_upload__hashes_parts_with_file():
+    file_size = 1*MB
+    filepath = make_bogus_binary_file(n=file_size)
+    status = {'resultFileHandleId': '123'}
+    try:
+        with patch.object(multipart_upload, "_multipart_upload", return_value=status) as mocked_multipart_upload, \
+                patch.object(syn.cache, "get_md5", return_value=None), \
+                patch.object(multipart_upload, "UploadJournal", return_value=MagicMock(md5=None)):
+            multipart_upload.multipart_upload(syn, filepath)
+        kwargs = mocked_multipart_upload.call_args[1]
+        assert_equals(md5_for_file(filepath).hexdigest(), kwargs['md5'])
+        assert_equals([kwargs['md5']], kwargs['part_md5s'])
+        assert_equals(multipart_upload.MIN_PART_SIZE, kwargs['partSize'])
+
+        # a recorded or given MD5 is used without reading the file, the parts are hashed as they're uploaded then
+        for recorded_md5, md5 in (('abc', None), (None, 'def')):
+            with patch.object(multipart_upload, "_multipart_upload", return_value=status) as mocked_multipart_upload,\
+                    patch.object(syn.cache, "get_md5", return_value=recorded_md5), \
+                    patch.object(multipart_upload, "UploadJournal", return_value=MagicMock(md5=None)), \
+                    patch.object(multipart_upload, "md5s_for_file_and_parts") as mocked_md5s:
+                multipart_upload.multipart_upload(syn, filepath, md5=md5)
+            assert_equals(recorded_md5 or md5, mocked_multipart_upload.call_args[1]['md5'])
+            assert_equals([], mocked_multipart_upload.call_args[1]['part_md5s'])
+            assert_false(mocked_md5s.called)
+    finally:
+        os.remove(filepath)
+
+
+def test_multipart_upload__resumes_from_journal():
+    cache_root_dir = tempfile.mkdtemp()
+    filepath = make_bogus_binary_file(n=1*MB)
+    md5 = md5_for_file(filepath).hexdigest()
+    parts = [{'partNumber': 1, 'uploadPresignedUrl': 'https://foo.com/1'}]
+    try:
+        # the first upload is interrupted after it started
+        with patch.object(syn.cache, "cache_root_dir", cache_root_dir), \
+                patch.object(syn.cache, "get_md5", return_value=None), \
+                patch.object(multipart_upload, "_start_multipart_upload",
+                             return_value=DictObject(uploadId='7', partsState='0', state='UPLOADING')), \
+                patch.object(multipart_upload, "_get_presigned_urls", side_effect=KeyboardInterrupt):
+            assert_raises(KeyboardInterrupt, multipart_upload.multipart_upload, syn, filepath)
+
+        journal = UploadJournal(cache_root_dir, filepath)
+        assert_equals(md5, journal.md5)
+        assert_equals([md5], journal.part_md5s)
+        assert_equals('7', journal.upload_id)
+
+        # the next one starts uploading without hashing the file and removes the journal entry when it completes
+        with patch.object(syn.cache, "cache_root_dir", cache_root_dir), \
+                patch.object(syn.cache, "get_md5", return_value=None), \
+                patch.object(multipart_upload, "md5s_for_file_and_parts") as mocked_md5s, \
+                patch.object(multipart_upload, "_start_multipart_upload",
+                             side_effect=[DictObject(uploadId='7', partsState='0', state='UPLOADING'),
+                                          DictObject(uploadId='7', partsState='1', state='UPLOADING')]), \
+                patch.object(multipart_upload, "_get_presigned_urls", return_value=iter(parts)), \
+                patch.object(multipart_upload, "_put_chunk"), \
+                patch.object(multipart_upload, "_add_part", return_value={'addPartState': 'ADD_SUCCESS'}) \
+                as mocked_add_part, \
+                patch.object(multipart_upload, "_complete_multipart_upload",
+                             return_value=DictObject(state='COMPLETED', resultFileHandleId='123')):
+            assert_equals('123', multipart_upload.multipart_upload(syn, filepath))
+        assert_false(mocked_md5s.called)
+        mocked_add_part.assert_called_once_with(syn, uploadId='7', partNumber=1, partMD5Hex=md5)
+        assert_equals(None, UploadJournal(cache_root_dir, filepath).md5)
+    finally:
+        os.remove(filepath)
+
+
+def test_multipart_upload_stream():
+    cache_root_dir = tempfile.mkdtemp()
+    contents = os.urandom(2*MB + 100)
+    uploads = []
+
+    def upload(syn, filename, contentType, get_chunk_function, md5, fileSize, partSize, part_md5s, **kwargs):
+        parts = [bytes(get_chunk_function(n, partSize)) for n in range(1, len(part_md5s) + 1)]
+        uploads.append(dict(filename=filename, contentType=contentType, md5=md5, fileSize=fileSize, partSize=partSize,
+                            part_md5s=part_md5s, parts=parts))
+        return {'resultFileHandleId': '123'}
+
+    def generate():
+        # blocks that don't line up with the parts, and text
+        for i in range(0, len(contents), 300*1024):
+            yield contents[i:i + 300*1024]
+        yield u'\xe9'
+
+    try:
+        with patch.object(syn.cache, "cache_root_dir", cache_root_dir), \
+                patch.object(multipart_upload, "MIN_PART_SIZE", 1*MB), \
+                patch.object(multipart_upload, "_multipart_upload", side_effect=upload):
+            assert_equals('123', multipart_upload.multipart_upload_stream(syn, generate(), 'data.csv'))
+            assert_equals('123', multipart_upload.multipart_upload_stream(syn, six.BytesIO(contents), 'data',
+                                                                          contentType='text/plain'))
+        expected = contents + u'\xe9'.encode('utf-8')
+        generated, read = uploads
+        assert_equals('data.csv', generated['filename'])
+        assert_equals('text/csv', generated['contentType'])
+        assert_equals(hashlib.md5(expected).hexdigest(), generated['md5'])
+        assert_equals(len(expected), generated['fileSize'])
+        assert_equals(1*MB, generated['partSize'])
+        assert_equals([expected[:MB], expected[MB:2*MB], expected[2*MB:]], generated['parts'])
+        assert_equals([hashlib.md5(part).hexdigest() for part in generated['parts']], generated['part_md5s'])
+
+        assert_equals('text/plain', read['contentType'])
+        assert_equals(hashlib.md5(contents).hexdigest(), read['md5'])
+        assert_equals([hashlib.md5(part).hexdigest() for part in read['parts']], read['part_md5s'])
+        assert_equals(contents, b''.join(read['parts']))
+        # the spooled data is removed
+        assert_equals([], os.listdir(cache_root_dir))
+    finally:
+        shutil.rmtree(cache_root_dir)
+
+
+def test_multipart_upload_stream__longer_than_expected():
+    cache_root_dir = tempfile.mkdtemp()
+    try:
+        with patch.object(syn.cache, "cache_root_dir", cache_root_dir), \
+                patch.object(multipart_upload, "MIN_PART_SIZE", 10), \
+                patch.object(multipart_upload, "MAX_NUMBER_OF_PARTS", 3), \
+                patch.object(multipart_upload, "_multipart_upload",
+                             return_value={'resultFileHandleId': '123'}) as mocked_multipart_upload:
+            multipart_upload.multipart_upload_stream(syn, [b'a' * 50], 'data', expected_size=20)
+        kwargs = mocked_multipart_upload.call_args[1]
+        assert_equals(50, kwargs['fileSize'])
+        assert_equals(17, kwargs['partSize'])
+        # the parts are hashed when they are uploaded instead
+        assert_equals([], kwargs['part_md5s'])
+    finally:
+        shutil.rmtree(cache_root_dir)
+
+
+def test_new_upload_session():
+    session = multipart_upload.new_upload_session(pool_size=3)
+    adapter = session.get_adapter('https://s3.amazonaws.com/bucket/key')
+    assert_equals(3, adapter._pool_maxsize)
+    assert_equals(3, adapter.poolmanager.connection_pool_kw['maxsize'])
+    assert_is_instance(syn._upload_session, requests.Session)
+
+
+def test_upload_chunk__puts_with_upload_session():
+    status = DictObject(uploadId='7')
+    completed = Value('d', 0)
+    with patch.object(syn, "_upload_session") as mocked_session, \
+            patch.object(exceptions, "_raise_for_status"), \
+            patch.object(multipart_upload, "_add_part", return_value={'addPartState': 'ADD_SUCCESS'}):
+        _upload_chunk({'partNumber': 1, 'uploadPresignedUrl': 'https://s3.amazonaws.com/bucket/key'}, completed,
+                      status, syn, 'data', lambda n, partSize: b'abc', 3, 3, time.time(), Value(c_bool, False))
+    mocked_session.put.assert_called_once_with('https://s3.amazonaws.com/bucket/key', data=b'abc')
+    assert_equals(3, completed.value)
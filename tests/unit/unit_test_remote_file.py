@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import unit
+from mock import patch, MagicMock, call
+from nose.tools import assert_equals, assert_raises, assert_true, assert_is_instance
+
+from synapseclient import File
+from synapseclient.exceptions import SynapseHTTPError
+from synapseclient.remote_file import RemoteFile
+
+
+def setup(module):
+    module.syn = unit.syn
+
+
+CONTENTS = bytes(bytearray(i % 256 for i in range(1000)))
+URL = 'https://foo.com/file.bin'
+
+
+class TestRemoteFile:
+    def setup(self):
+        self.get_url = MagicMock(return_value=URL)
+        self.get_url_range_patcher = patch.object(syn, '_get_url_range', side_effect=self._range_response)
+        self.mock_get_url_range = self.get_url_range_patcher.start()
+
+    def teardown(self):
+        self.get_url_range_patcher.stop()
+
+    def _range_response(self, url, start, end, status_code=206):
+        response = MagicMock()
+        response.status_code = status_code
+        response.content = CONTENTS[start:end + 1] if status_code == 206 else CONTENTS
+        return response
+
+    def _requested_ranges(self):
+        return [args[1:] for args, kwargs in self.mock_get_url_range.call_args_list]
+
+    def test_sequential_reads_fetch_ahead(self):
+        f = RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100, read_ahead=2)
+        assert_equals(CONTENTS[:50], f.read(50))
+        assert_equals(CONTENTS[50:250], f.read(200))
+        assert_equals([(0, 299)], self._requested_ranges())
+        assert_equals(CONTENTS[250:], f.read())
+        assert_equals(b'', f.read(10))
+        assert_equals([(0, 299), (300, 599), (600, 899), (900, 999)], self._requested_ranges())
+
+    def test_seek(self):
+        f = RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100, read_ahead=2)
+        assert_equals(990, f.seek(-10, io.SEEK_END))
+        assert_equals(CONTENTS[990:], f.read())
+        assert_equals(1000, f.tell())
+        f.seek(420)
+        f.seek(5, io.SEEK_CUR)
+        assert_equals(CONTENTS[425:430], f.read(5))
+        # neither is a sequential read, so only their own blocks are fetched
+        assert_equals([(900, 999), (400, 499)], self._requested_ranges())
+        assert_raises(ValueError, f.seek, -1)
+
+    def test_least_recently_used_blocks_are_dropped(self):
+        f = RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100, cache_blocks=2, read_ahead=0)
+        for position in (0, 500, 0, 800, 0, 500):
+            f.seek(position)
+            f.read(1)
+        assert_equals([(0, 99), (500, 599), (800, 899), (500, 599)], self._requested_ranges())
+
+    def test_expired_url_is_refreshed(self):
+        forbidden = MagicMock()
+        forbidden.status_code = 403
+        self.mock_get_url_range.side_effect = [SynapseHTTPError('403 Forbidden', response=forbidden),
+                                               self._range_response(URL, 0, 99)]
+        f = RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100, read_ahead=0)
+        assert_equals(CONTENTS[:10], f.read(10))
+        assert_equals([call(), call(refresh=True)], self.get_url.call_args_list)
+
+    def test_range_not_supported(self):
+        self.mock_get_url_range.side_effect = lambda url, start, end: self._range_response(url, start, end, 200)
+        f = RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100)
+        f.seek(150)
+        assert_equals(CONTENTS[150:160], f.read(10))
+
+    def test_buffered_and_closed(self):
+        with io.BufferedReader(RemoteFile(syn, self.get_url, len(CONTENTS), block_size=100)) as f:
+            assert_equals(CONTENTS[:10], f.read(10))
+            f.seek(500)
+            assert_equals(CONTENTS[500:], f.read())
+        assert_true(f.closed)
+        assert_raises(ValueError, f.read)
+
+
+def test_open_seekable():
+    entity = File(id='syn123', parentId='syn1', name='file.bin', dataFileHandleId='456')
+    entity._update_file_handle({'id': '456', 'fileName': 'file.bin', 'contentSize': len(CONTENTS)})
+    file_result = {'fileHandleId': '456', 'preSignedURL': URL, 'fileHandle': {'id': '456'}}
+    with patch.object(syn.cache, 'get', return_value=None), \
+            patch.object(syn, '_getFileHandleDownload', return_value=file_result), \
+            patch.object(syn, '_get_url_range') as mock_get_url_range:
+        mock_get_url_range.return_value.status_code = 206
+        mock_get_url_range.return_value.content = CONTENTS[900:]
+        with syn.open(entity, seekable=True, block_size=100) as f:
+            assert_is_instance(f, RemoteFile)
+            assert_equals('file.bin', f.name)
+            f.seek(900)
+            assert_equals(CONTENTS[900:], f.read())
+        mock_get_url_range.assert_called_once_with(URL, 900, 999)
+    assert_raises(ValueError, syn.open, entity, 'w')
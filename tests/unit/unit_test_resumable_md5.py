@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unit
+from mock import patch, MagicMock
+from nose.tools import assert_equals, assert_is_none, assert_false, assert_raises
+
+import synapseclient
+from synapseclient import resumable_md5, utils
+from synapseclient.resumable_md5 import ResumableMD5, save_checkpoint, load_checkpoint, remove_checkpoint, \
+    checkpoint_filename
+
+
+def setup(module):
+    module.syn = unit.syn
+
+
+CONTENTS = os.urandom(100000)
+
+
+class TestResumableMD5:
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'file.bin.synapse_download_42')
+
+    def teardown(self):
+        remove_checkpoint(self.path)
+        shutil.rmtree(self.tmp_dir)
+
+    def _forget_checkpoints(self):
+        # as if the download were resumed by another process
+        resumable_md5._md5s.clear()
+
+    def test_chunk_digests(self):
+        md5 = ResumableMD5(10000)
+        md5.update(CONTENTS[:12345])
+        copy = md5.copy()
+        md5.update(CONTENTS[12345:15000])
+        md5.update(CONTENTS[15000:])
+        assert_equals(hashlib.md5(CONTENTS).hexdigest(), md5.hexdigest())
+        assert_equals(hashlib.md5(CONTENTS).digest(), md5.digest())
+        assert_equals([hashlib.md5(CONTENTS[start:start + 10000]).hexdigest() for start in range(0, 100000, 10000)],
+                      md5.chunk_digests)
+        # the copy isn't changed by updating the original
+        assert_equals(1, len(copy.chunk_digests))
+        copy.update(CONTENTS[12345:])
+        assert_equals(md5.chunk_digests, copy.chunk_digests)
+        assert_equals(md5.hexdigest(), copy.hexdigest())
+
+    def test_checkpoint_in_same_process(self):
+        with open(self.path, 'wb') as f:
+            f.write(CONTENTS[:60000])
+        md5 = ResumableMD5(10000)
+        md5.update(CONTENTS[:55555])
+        save_checkpoint(self.path, md5, 55555)
+        md5.update(b'more')
+
+        with patch.object(resumable_md5, 'open', create=True) as mock_open:
+            mock_open.side_effect = open
+            checkpoint = load_checkpoint(self.path)
+        # the file isn't read again
+        assert_equals(1, mock_open.call_count)
+        assert_equals(55555, checkpoint.offset)
+        assert_equals(hashlib.md5(CONTENTS[:55555]).hexdigest(), checkpoint.md5.hexdigest())
+
+        # a checkpoint that another process saved since is verified instead
+        with open(checkpoint_filename(self.path), 'w') as f:
+            json.dump({'chunk_size': 10000, 'chunks': md5.chunk_digests[:2]}, f)
+        assert_equals(20000, load_checkpoint(self.path).offset)
+
+    def test_checkpoint_in_another_process(self):
+        with open(self.path, 'wb') as f:
+            f.write(CONTENTS[:60000])
+        md5 = ResumableMD5(10000)
+        md5.update(CONTENTS[:55555])
+        save_checkpoint(self.path, md5, 55555)
+        self._forget_checkpoints()
+
+        # only the chunks in the checkpoint are verified, the rest of the file is left to the caller
+        checkpoint = load_checkpoint(self.path)
+        assert_equals(50000, checkpoint.offset)
+        assert_equals(hashlib.md5(CONTENTS[:50000]).hexdigest(), checkpoint.md5.hexdigest())
+        checkpoint.md5.update(CONTENTS[50000:])
+        assert_equals(hashlib.md5(CONTENTS).hexdigest(), checkpoint.md5.hexdigest())
+        assert_equals(60000, os.path.getsize(self.path))
+
+        # the file is truncated at the first chunk that doesn't match
+        with open(self.path, 'r+b') as f:
+            f.seek(25000)
+            f.write(b'x')
+        checkpoint = load_checkpoint(self.path)
+        assert_equals(20000, checkpoint.offset)
+        assert_equals(hashlib.md5(CONTENTS[:20000]).hexdigest(), checkpoint.md5.hexdigest())
+        assert_equals(20000, os.path.getsize(self.path))
+
+        # a file shorter than its checkpoint
+        checkpoint = load_checkpoint(self.path)
+        assert_equals(20000, checkpoint.offset)
+
+    def test_invalid_checkpoints_are_ignored(self):
+        utils.touch(self.path)
+        assert_is_none(load_checkpoint(self.path))
+        for contents in ('not json', '{"chunks": []}', '{"chunk_size": 10, "chunks": 3}'):
+            with open(checkpoint_filename(self.path), 'w') as f:
+                f.write(contents)
+            assert_is_none(load_checkpoint(self.path))
+        # hashes that can't be checkpointed are ignored
+        save_checkpoint(self.path, hashlib.md5(), 0)
+        assert_is_none(load_checkpoint(self.path))
+
+    def test_remove_checkpoint(self):
+        utils.touch(self.path)
+        save_checkpoint(self.path, ResumableMD5(), 0)
+        remove_checkpoint(self.path)
+        assert_is_none(load_checkpoint(self.path))
+        assert_false(os.path.exists(checkpoint_filename(self.path)))
+        # removing it again is fine
+        remove_checkpoint(self.path)
+
+    def test_resume_download_hashes_only_new_bytes(self):
+        url = 'https://foo.com/file.bin'
+        destination = os.path.join(self.tmp_dir, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(CONTENTS[:60000])
+        # the state was saved before the last bytes that made it to disk
+        md5 = ResumableMD5()
+        md5.update(CONTENTS[:50000])
+        save_checkpoint(self.path, md5, 50000)
+
+        response = MagicMock()
+        response.status_code = 206
+        response.headers = {'content-length': len(CONTENTS) - 60000}
+        response.iter_content = lambda buffer_size: iter([CONTENTS[60000:]])
+        response.raw.tell = lambda: len(CONTENTS) - 60000
+
+        with patch.object(syn._requests_session, 'get', return_value=response) as mock_get, \
+                patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h), \
+                patch.object(utils, 'md5_for_file', side_effect=utils.md5_for_file) as mock_md5_for_file:
+            path = syn._download_from_URL(url, destination, '42', expected_md5=hashlib.md5(CONTENTS).hexdigest())
+
+        assert_equals(destination, path)
+        assert_equals({'Range': 'bytes=60000-'}, mock_get.call_args[1]['headers'])
+        assert_equals(50000, mock_md5_for_file.call_args[1]['offset'])
+        with open(destination, 'rb') as f:
+            assert_equals(CONTENTS, f.read())
+        assert_false(os.path.exists(checkpoint_filename(self.path)))
+
+    def test_resume_download_in_another_process(self):
+        url = 'https://foo.com/file.bin'
+        destination = os.path.join(self.tmp_dir, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(CONTENTS[:60000])
+        md5 = ResumableMD5(10000)
+        md5.update(CONTENTS[:50000])
+        save_checkpoint(self.path, md5, 50000)
+        self._forget_checkpoints()
+        # the partial download was damaged after it was checkpointed
+        with open(self.path, 'r+b') as f:
+            f.seek(45000)
+            f.write(b'x')
+
+        response = MagicMock()
+        response.status_code = 206
+        response.headers = {'content-length': len(CONTENTS) - 40000}
+        response.iter_content = lambda buffer_size: iter([CONTENTS[40000:]])
+        response.raw.tell = lambda: len(CONTENTS) - 40000
+
+        with patch.object(syn._requests_session, 'get', return_value=response) as mock_get, \
+                patch.object(synapseclient.client.Synapse, '_generateSignedHeaders', side_effect=lambda url, h: h):
+            path = syn._download_from_URL(url, destination, '42', expected_md5=hashlib.md5(CONTENTS).hexdigest())
+
+        assert_equals(destination, path)
+        assert_equals({'Range': 'bytes=40000-'}, mock_get.call_args[1]['headers'])
+        with open(destination, 'rb') as f:
+            assert_equals(CONTENTS, f.read())
+        assert_false(os.path.exists(checkpoint_filename(self.path)))
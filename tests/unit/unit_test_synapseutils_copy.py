@@ -11,6 +11,7 @@ import uuid
 
 from synapseclient import Project, File
 import synapseutils
+from synapseutils.copy import _copy_cached_file_handles
 
 def setup(module):
     module.syn = unit.syn
@@ -134,3 +135,15 @@ class TestCopy:
             patch_get_children.assert_called_once_with(self.project_entity,
                                                        includeTypes=['folder', 'file',
                                                                      'table', 'link'])
+
+
+def test_copy_cached_file_handles():
+    copied_file_handles = {'copyResults': [
+        {'originalFileHandleId': '101', 'newFileHandle': {'id': '201'}},
+        {'originalFileHandleId': '102', 'newFileHandle': {'id': '202'}},
+        {'originalFileHandleId': '103', 'failureCode': 'UNAUTHORIZED'}]}
+    with patch.object(syn.cache, "get_many", return_value={'101': '/tmp/file1.txt'}) as mock_get_many, \
+            patch.object(syn.cache, "add_many") as mock_add_many:
+        _copy_cached_file_handles(syn.cache, copied_file_handles)
+        assert_equals(['101', '102'], list(mock_get_many.call_args[0][0]))
+        assert_equals([('201', '/tmp/file1.txt')], list(mock_add_many.call_args[0][0]))
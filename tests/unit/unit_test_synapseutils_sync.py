@@ -150,8 +150,10 @@ def test_syncFromSynapse__project_contains_empty_folder():
         expected_get_children_agrs = [call(project['id']), call(folder['id'])]
         assert_list_equal(expected_get_children_agrs, patch_syn_get_children.call_args_list)
         expected_get_args = [
-            call(folder['id'], downloadLocation=None, ifcollision='overwrite.local', followLink=False),
-            call(file['id'], downloadLocation=None, ifcollision='overwrite.local', followLink=False)]
+            call(folder['id'], downloadLocation=None, ifcollision='overwrite.local', followLink=False,
+                 materialize='copy'),
+            call(file['id'], downloadLocation=None, ifcollision='overwrite.local', followLink=False,
+                 materialize='copy')]
         assert_list_equal(expected_get_args, patch_syn_get.call_args_list)
 
 
@@ -10,6 +10,8 @@ import math
 import os
 import sys
 import tempfile
+import threading
+import zipfile
 from builtins import zip
 from mock import MagicMock
 from nose.tools import assert_raises, assert_not_equals, assert_false, assert_not_in, assert_in, assert_sequence_equal,\
@@ -530,6 +532,48 @@ def test_build_table_download_file_handle_list__repeated_file_handles():
     assert_equals(0, len(file_handle_to_path_map))
 
 
+def test_downloadTableColumns__concurrent_batches():
+    syn = synapseclient.client.Synapse(debug=True, skip_checks=True)
+    tmp_dir = tempfile.mkdtemp()
+    syn.cache = synapseclient.cache.Cache(cache_root_dir=os.path.join(tmp_dir, "cache"))
+    table = MagicMock(tableId='syn123')
+    associations = [dict(associateObjectType="TableEntity", fileHandleId=str(i), associateObjectId='syn123')
+                    for i in range(5)]
+    second_batch_requested = threading.Event()
+
+    def wait_for_async(uri, request, endpoint):
+        file_handle_ids = [association['fileHandleId'] for association in request['requestedFiles']]
+        if '2' in file_handle_ids:
+            second_batch_requested.set()
+        # file handle 4 fails for good
+        return {'resultZipFileHandleId': 'zip' + file_handle_ids[0],
+                'fileSummary': [{'fileHandleId': i, 'status': 'SUCCESS', 'zipEntryName': '%s/file%s.txt' % (i, i)}
+                                if i != '4' else {'fileHandleId': i, 'status': 'FAILURE', 'failureCode': 'NOT_FOUND'}
+                                for i in file_handle_ids]}
+
+    def download_zip(zip_file_handle_id, objectId, objectType, destination):
+        # the zip of the first batch is only downloaded once the next one is being built
+        if zip_file_handle_id == 'zip0':
+            assert_true(second_batch_requested.wait(5))
+        with zipfile.ZipFile(destination, 'w') as zf:
+            for i in range(5):
+                zf.writestr('%d/file%d.txt' % (i, i), 'content %d' % i)
+        return destination
+
+    with patch.object(synapseclient.config, 'single_threaded', False), \
+            patch.object(syn, '_build_table_download_file_handle_list', return_value=(associations, OrderedDict())), \
+            patch.object(syn, '_waitForAsync', side_effect=wait_for_async) as mocked_wait_for_async, \
+            patch.object(syn, '_downloadFileHandle', side_effect=download_zip):
+        file_map = syn.downloadTableColumns(table, ['filehandle'], max_files_per_request=2, max_concurrent_batches=2)
+
+    assert_equals(3, mocked_wait_for_async.call_count)
+    assert_equals(['0', '1', '2', '3'], sorted(file_map))
+    for file_handle_id, path in file_map.items():
+        with open(path) as f:
+            assert_equals('content %s' % file_handle_id, f.read())
+        assert_equals(path, syn.cache.get(file_handle_id))
+
+
 def test_EntityViewSchema__default_params():
     entity_view = EntityViewSchema(parent="idk")
     assert_equals(EntityViewType.FILE.value, entity_view.viewTypeMask)
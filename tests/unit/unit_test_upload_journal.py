@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+import tempfile
+import time
+from mock import patch
+from nose.tools import assert_equals, assert_is_none, assert_false
+
+from synapseclient import upload_journal
+from synapseclient.upload_journal import UploadJournal
+
+
+class TestUploadJournal:
+    def setup(self):
+        self.cache_root_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_root_dir, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(b'contents')
+
+    def teardown(self):
+        shutil.rmtree(self.cache_root_dir)
+
+    def test_record_and_load(self):
+        journal = UploadJournal(self.cache_root_dir, self.path)
+        assert_is_none(journal.md5)
+        journal.record_digests('abc', 5, ['a', 'b'])
+        journal.started('42')
+        journal.part_completed(1, 'a')
+        with patch.object(upload_journal.time, 'time', return_value=time.time() + upload_journal.SAVE_INTERVAL):
+            journal.part_completed(2, 'b')
+
+        loaded = UploadJournal(self.cache_root_dir, self.path)
+        assert_equals('abc', loaded.md5)
+        assert_equals(5, loaded.part_size)
+        assert_equals(['a', 'b'], loaded.part_md5s)
+        assert_equals('42', loaded.upload_id)
+        assert_equals({1: 'a', 2: 'b'}, loaded.completed_parts)
+
+        # a different upload was started, e.g. because the last one expired
+        loaded.started('43')
+        assert_equals({}, UploadJournal(self.cache_root_dir, self.path).completed_parts)
+
+        loaded.remove()
+        assert_is_none(UploadJournal(self.cache_root_dir, self.path).md5)
+        # removing it again is fine
+        loaded.remove()
+
+    def test_modified_file_is_not_resumed(self):
+        UploadJournal(self.cache_root_dir, self.path).record_digests('abc', 5, ['a', 'b'])
+        with open(self.path, 'ab') as f:
+            f.write(b' and more')
+        journal = UploadJournal(self.cache_root_dir, self.path)
+        assert_is_none(journal.md5)
+        assert_equals([], journal.part_md5s)
+
+    def test_save_failure_is_ignored(self):
+        journal = UploadJournal(self.cache_root_dir, self.path)
+        with patch.object(upload_journal.os, 'makedirs', side_effect=OSError('Permission denied')):
+            journal.record_digests('abc', 5, ['a', 'b'])
+        assert_equals('abc', journal.md5)
+        assert_false(os.path.exists(os.path.join(self.cache_root_dir, upload_journal.JOURNAL_DIR_NAME)))
+
+    def test_remove_failure_is_ignored(self):
+        journal = UploadJournal(self.cache_root_dir, self.path)
+        journal.record_digests('abc', 5, ['a', 'b'])
+        with patch.object(upload_journal.os, 'remove', side_effect=OSError(errno.EACCES, 'Permission denied')):
+            journal.remove()
+        assert_is_none(journal.md5)
+
+    def test_prune(self):
+        UploadJournal(self.cache_root_dir, self.path).record_digests('abc', 5, ['a', 'b'])
+        other_path = os.path.join(self.cache_root_dir, 'other.bin')
+        with open(other_path, 'wb') as f:
+            f.write(b'other contents')
+        UploadJournal(self.cache_root_dir, other_path).record_digests('def', 5, ['d', 'e', 'f'])
+        # the upload of the first file was abandoned a day ago
+        abandoned = UploadJournal(self.cache_root_dir, self.path)._filename
+        old_time_stamp = time.time() - 24 * 3600
+        os.utime(abandoned, (old_time_stamp, old_time_stamp))
+
+        assert_equals([abandoned], upload_journal.prune(self.cache_root_dir, time.time() - 3600, dry_run=True))
+        assert_equals('abc', UploadJournal(self.cache_root_dir, self.path).md5)
+        assert_equals([abandoned], upload_journal.prune(self.cache_root_dir, time.time() - 3600))
+        assert_is_none(UploadJournal(self.cache_root_dir, self.path).md5)
+        assert_equals('def', UploadJournal(self.cache_root_dir, other_path).md5)
+
+        assert_equals([], upload_journal.prune(tempfile.mkdtemp(), time.time()))
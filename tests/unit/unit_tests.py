@@ -451,3 +451,14 @@ def test_calling_module():
     # since both _calling_module_test_helper and test_calling_module are a part of the unit_test module,
     # we can test that callers of the same module do indeed are skipped
     assert_equals("case", _calling_module_test_helper())
+
+
+def test_parse_size():
+    assert_equals(1000, utils.parse_size(1000))
+    assert_equals(1000, utils.parse_size("1000"))
+    assert_equals(512, utils.parse_size("512 bytes"))
+    assert_equals(100 * utils.MB, utils.parse_size("100MB"))
+    assert_equals(int(1.5 * utils.GB), utils.parse_size(" 1.5 gb "))
+    assert_equals(2 * 2**40, utils.parse_size("2T"))
+    assert_raises(ValueError, utils.parse_size, "lots")
+    assert_raises(ValueError, utils.parse_size, "10 furlongs")